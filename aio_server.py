@@ -0,0 +1,724 @@
+"""
+asyncio receive server, an alternative to the one-thread-per-connection
+`SSL_ThreadingTCPServer`.
+
+Connections are cheap here; what's limited is the number of snapshots being
+received at once, each of which needs a `btrfs receive` process (or a spool
+file). A 'send' request that arrives while the server is at one of its
+limits waits in a queue (see receive_scheduler), and clients that understand
+it are told their queue position in 'queued' control messages before the
+usual 'ready'. Streams are never buffered beyond a frame or two per connection:
+we only read the next frame once `btrfs receive` has taken the previous one,
+so a slow disk pushes back all the way to the sender through TCP flow
+control.
+"""
+import asyncio
+from asyncio.subprocess import PIPE
+from functools import partial
+from pathlib import Path
+import ssl
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional
+
+from btrfs_incremental_send import (
+    BTRFS_RECEIVE_COMMAND,
+    CONTROL_PORT,
+    deserialize_json,
+    serialize_json,
+)
+from compression import COMPRESSION_NONE, choose_codec
+from copy_engine import CopyResult
+from digest import StreamDigest, choose_digest
+from inventory import SnapshotInventory
+from link_tuning import LinkSettings, LinkTuner
+from meter import TransferMeter, status_board
+from protocol import (
+    COMPRESSED_HEADER,
+    FRAME_COMPRESSED,
+    FRAME_CONTROL,
+    FRAME_DATA,
+    FRAME_END,
+    FRAME_HEADER,
+    HELLO_TIMEOUT,
+    MAX_FRAME_SIZE,
+    PROTOCOL_MULTIPLEXED,
+    PROTOCOL_TWO_PORT,
+    ConnectionClosed,
+    ProtocolError,
+    ReceivedStream,
+    choose_protocol,
+    decompress_block,
+)
+from receive_scheduler import ReceiveScheduler, Ticket
+from resume import CHECKPOINT_INTERVAL, Spool, remove_stale_spools, transfer_id
+from server import (
+    DATA_CONNECTION_TIMEOUT,
+    check_end_summary,
+    get_common_name,
+    receive_result,
+)
+from ssl_socketserver import make_server_context
+from tls import HandshakeStats, ReloadingContext
+from tracing import new_transfer_id, tracer
+
+DEFAULT_MAX_CONCURRENT_RECEIVES = 4
+DEFAULT_MAX_CONCURRENT_RECEIVES_PER_CLIENT = 1
+
+# Bytes a StreamReader buffers before it stops reading from the socket
+STREAM_READER_LIMIT = MAX_FRAME_SIZE
+# Chunk size when copying a two-port data connection into `btrfs receive`
+DATA_CHUNK_SIZE = 1 << 20
+# Blocks up to this size are hashed on the event loop: that takes a fraction
+# of a millisecond, less than a round trip through the executor costs
+INLINE_HASH_SIZE = 1 << 18
+
+class QueueWaiter:
+    __slots__ = ['ticket', 'admitted', 'moved']
+
+    def __init__(self, ticket: Ticket, admitted: asyncio.Future):
+        self.ticket = ticket
+        self.admitted = admitted
+        # Set whenever this waiter's queue position may have changed
+        self.moved = asyncio.Event()
+
+class AdmissionController:
+    """
+    Asyncio front end for a ReceiveScheduler, which decides who's admitted
+    next (overall, per-client and per-device limits, priorities); this just
+    does the waiting.
+    """
+    def __init__(self, scheduler: Optional[ReceiveScheduler] = None):
+        if scheduler is None:
+            scheduler = ReceiveScheduler(
+                DEFAULT_MAX_CONCURRENT_RECEIVES,
+                DEFAULT_MAX_CONCURRENT_RECEIVES_PER_CLIENT,
+            )
+        self.scheduler = scheduler
+        self.waiters: List[QueueWaiter] = []
+
+    @classmethod
+    def from_config(cls, config, paths: Mapping[str, Path]) -> 'AdmissionController':
+        """
+        :param config: Server config; see ReceiveScheduler.from_config
+        :param paths: Client CN -> destination path
+        """
+        return cls(
+            ReceiveScheduler.from_config(
+                config,
+                paths,
+                DEFAULT_MAX_CONCURRENT_RECEIVES,
+                DEFAULT_MAX_CONCURRENT_RECEIVES_PER_CLIENT,
+            )
+        )
+
+    def _notify(self):
+        for waiter in self.waiters:
+            waiter.moved.set()
+
+    def _wake(self):
+        admitted = set(self.scheduler.admit_waiting())
+        if not admitted:
+            return
+        for waiter in list(self.waiters):
+            if waiter.ticket in admitted:
+                waiter.admitted.set_result(None)
+                self.waiters.remove(waiter)
+                waiter.moved.set()
+        self._notify()
+
+    async def acquire(
+            self,
+            client: str,
+            report: Optional[Callable[[Ticket, int], Awaitable]] = None,
+    ) -> Ticket:
+        """
+        Wait for a slot for `client`.
+
+        :param report: Called with the ticket and its 1-based queue position
+        whenever the latter changes while waiting
+        """
+        ticket = self.scheduler.enqueue(client)
+        waiter = QueueWaiter(ticket, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        # Anyone already waiting is blocked by a limit, so admitting this one
+        # straight away (if it fits) doesn't jump the queue
+        self._wake()
+        try:
+            last_position = None
+            while not waiter.admitted.done():
+                position = self.scheduler.position(ticket)
+                if report is not None and position != last_position:
+                    await report(ticket, position)
+                    last_position = position
+                    # Things may have moved while we were reporting
+                    continue
+                waiter.moved.clear()
+                await waiter.moved.wait()
+        except BaseException:
+            if waiter.admitted.done():
+                self.release(ticket)
+            else:
+                self.waiters.remove(waiter)
+                self.scheduler.cancel(ticket)
+                self._wake()
+                self._notify()
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        self.scheduler.release(ticket)
+        self._wake()
+
+    def slot(
+            self,
+            client: str,
+            report: Optional[Callable[[Ticket, int], Awaitable]] = None,
+    ) -> 'AdmissionSlot':
+        return AdmissionSlot(self, client, report)
+
+class AdmissionSlot:
+    """
+    `async with admission.slot(client) as ticket:` around a receive
+    """
+    __slots__ = ['admission', 'client', 'report', 'ticket']
+
+    def __init__(self, admission: AdmissionController, client: str, report):
+        self.admission = admission
+        self.client = client
+        self.report = report
+        self.ticket: Optional[Ticket] = None
+
+    async def __aenter__(self) -> Ticket:
+        self.ticket = await self.admission.acquire(self.client, self.report)
+        return self.ticket
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.admission.release(self.ticket)
+
+async def read_exactly(reader: asyncio.StreamReader, size: int) -> bytes:
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionClosed(
+            'Connection closed after {} of {} bytes'.format(len(e.partial), size)
+        )
+
+async def send_message(writer: asyncio.StreamWriter, message: dict):
+    payload = serialize_json(message)
+    writer.write(FRAME_HEADER.pack(FRAME_CONTROL, len(payload)) + payload)
+    await writer.drain()
+
+async def recv_frame(reader: asyncio.StreamReader):
+    """
+    :return: Frame type and payload
+    """
+    frame_type, length = FRAME_HEADER.unpack(await read_exactly(reader, FRAME_HEADER.size))
+    # Payloads are read into memory whole, so don't trust the length blindly
+    if length > MAX_FRAME_SIZE + COMPRESSED_HEADER.size:
+        raise ProtocolError('Frame too large: {}'.format(length))
+    return frame_type, await read_exactly(reader, length)
+
+async def recv_message(reader: asyncio.StreamReader) -> dict:
+    frame_type, payload = await recv_frame(reader)
+    if frame_type != FRAME_CONTROL:
+        raise ProtocolError('Expected control frame, got type {}'.format(frame_type))
+    return deserialize_json(payload)
+
+async def receive_stream(
+        reader: asyncio.StreamReader,
+        write: Callable[[bytes], Awaitable],
+        meter: Optional[TransferMeter] = None,
+) -> ReceivedStream:
+    """
+    Pass DATA and COMPRESSED frames to `write` until an END frame arrives.
+    The next frame isn't read until `write` returns, which is where the
+    backpressure comes from.
+    """
+    loop = asyncio.get_running_loop()
+    received = 0
+    wire_bytes = 0
+    decompress_seconds = 0.0
+    strategy = None
+    while True:
+        frame_type, payload = await recv_frame(reader)
+        if frame_type == FRAME_END:
+            return ReceivedStream(
+                CopyResult(strategy or 'asyncio', received),
+                deserialize_json(payload),
+                wire_bytes,
+                decompress_seconds,
+            )
+        if frame_type == FRAME_DATA:
+            await write(payload)
+            strategy = strategy or 'asyncio'
+            received += len(payload)
+            if meter is not None:
+                meter.update(len(payload))
+        elif frame_type == FRAME_COMPRESSED:
+            codec_id, = COMPRESSED_HEADER.unpack_from(payload)
+            start = perf_counter()
+            # Keep other connections moving while we decompress
+            data = await loop.run_in_executor(
+                None,
+                decompress_block,
+                codec_id,
+                memoryview(payload)[COMPRESSED_HEADER.size:],
+            )
+            decompress_seconds += perf_counter() - start
+            await write(data)
+            strategy = 'asyncio+decompress'
+            received += len(data)
+            if meter is not None:
+                meter.update(len(data))
+        else:
+            raise ProtocolError('Unexpected frame type {} in stream'.format(frame_type))
+        wire_bytes += len(payload)
+
+def receive_command(path: Path) -> List[str]:
+    return [
+        piece.format(path=path)
+        for piece in BTRFS_RECEIVE_COMMAND
+    ]
+
+async def receive_snapshot(path: Path, feed, digest: Optional[StreamDigest] = None) -> dict:
+    """
+    Asynchronous counterpart of `server.receive_snapshot`: run
+    `btrfs receive` in `path`, feeding it with `await feed(write)`.
+
+    :param feed: Returns a CopyResult
+    :param digest: If given, everything written into `btrfs receive` is
+    hashed with it, and the result includes the digest
+    """
+    with tracer.span('spawn_receive'):
+        proc = await asyncio.create_subprocess_exec(
+            *receive_command(path),
+            stdin=PIPE,
+            cwd=str(path),
+        )
+
+    loop = asyncio.get_running_loop()
+
+    async def write(data):
+        if digest is not None:
+            if len(data) > INLINE_HASH_SIZE:
+                # Long enough to hold up other connections; off the event
+                # loop, like decompression
+                await loop.run_in_executor(None, digest.update, data)
+            else:
+                digest.update(data)
+        proc.stdin.write(data)
+        # Returns once the pipe has room again, i.e. at the pace
+        # `btrfs receive` reads
+        await proc.stdin.drain()
+
+    copy_result = None
+    stream_error = None
+    with tracer.span('copy') as span:
+        try:
+            copy_result = await feed(write)
+            span['bytes'] = copy_result.bytes_copied
+            span['strategy'] = copy_result.strategy
+        except (OSError, ProtocolError) as e:
+            stream_error = e
+            span['error'] = repr(e)
+        finally:
+            proc.stdin.close()
+    with tracer.span('receive_wait') as span:
+        return_code = await proc.wait()
+        span['return_code'] = return_code
+    return receive_result(return_code, copy_result, stream_error, digest)
+
+class BtrfsReceiveServer:
+    """
+    Same behavior as `server.get_handler_class`, but each connection is a
+    coroutine rather than a thread.
+    """
+    def __init__(
+            self,
+            paths: Mapping[str, Path],
+            ssl_contexts: ReloadingContext,
+            admission: AdmissionController,
+            spool_root: Optional[Path] = None,
+            checkpoint_interval: int = CHECKPOINT_INTERVAL,
+            link: Optional[LinkSettings] = None,
+    ):
+        self.paths = paths
+        self.ssl_contexts = ssl_contexts
+        self.handshake_stats = HandshakeStats()
+        self.admission = admission
+        self.spool_root = spool_root
+        self.checkpoint_interval = checkpoint_interval
+        # No lock needed; only touched from the event loop
+        self.active_spools = set()
+        self.inventory = SnapshotInventory()
+        self.link = link or LinkSettings()
+        # Client CN -> throughput of its last transfer
+        self.link_rates: Dict[str, float] = {}
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        return self.ssl_contexts.get()
+
+    def _use_current_context(self, ssl_object: ssl.SSLObject, server_name, context: ssl.SSLContext):
+        # The listening socket's context is fixed, but the server name
+        # callback can still hand each connection the latest one
+        current = self.ssl_context
+        if current is not context:
+            ssl_object.context = current
+
+    async def serve_forever(self, host: str = '0.0.0.0', port: int = CONTROL_PORT):
+        listen_context = self.ssl_context
+        listen_context.sni_callback = self._use_current_context
+        server = await asyncio.start_server(
+            self.handle,
+            host,
+            port,
+            ssl=listen_context,
+            limit=STREAM_READER_LIMIT,
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await self.handle_connection(reader, writer)
+        except (OSError, ProtocolError) as e:
+            print('connection failed:', repr(e))
+        finally:
+            writer.close()
+
+    def record_link(self, cn: str, tuner: LinkTuner, meter: TransferMeter):
+        tuner.record_throughput(meter.bytes, monotonic() - meter.started)
+        if tuner.measured is not None:
+            self.link_rates[cn] = tuner.measured
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cn = get_common_name(writer.get_extra_info('peercert'))
+        # asyncio does the handshake for us, so there's no duration to record
+        self.handshake_stats.record(None, writer.get_extra_info('ssl_object').session_reused)
+        print('TLS handshakes:', self.handshake_stats)
+        if cn not in self.paths:
+            writer.write(serialize_json({'success': False, 'reason': 'bad_hostname'}))
+            await writer.drain()
+            return
+        path = self.paths[cn]
+        print('Path:', path)
+
+        try:
+            line = await asyncio.wait_for(reader.readline(), HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            hello = None
+        else:
+            if not line:
+                return
+            hello = deserialize_json(line)
+        protocol = choose_protocol(hello)
+        print('Client {} using protocol {}'.format(cn, protocol))
+        if protocol == PROTOCOL_MULTIPLEXED:
+            tuner = LinkTuner(self.link, sending=False, bandwidth=self.link_rates.get(cn))
+            tuner.start(writer.get_extra_info('socket'))
+            await self.handle_multiplexed(reader, writer, cn, path, hello, tuner)
+        else:
+            await self.handle_two_port(writer, cn, path)
+
+    async def handle_multiplexed(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            cn: str,
+            path: Path,
+            hello: dict,
+            tuner: LinkTuner,
+    ):
+        sock = writer.get_extra_info('socket')
+        codec = choose_codec(hello.get('compression', []))
+        print('Compression:', codec or COMPRESSION_NONE)
+        digest_algorithm = choose_digest(hello.get('digests', []))
+        writer.write(
+            serialize_json(
+                {
+                    'success': True,
+                    'protocol': PROTOCOL_MULTIPLEXED,
+                    'compression': codec,
+                    'compression_level': hello.get('compression_level'),
+                    'digest': digest_algorithm,
+                }
+            )
+        )
+        await writer.drain()
+
+        async def report_position(ticket, position):
+            print('{} queued at position {} for {}'.format(cn, position, ticket.device))
+            await send_message(
+                writer,
+                {
+                    'type': 'queued',
+                    'success': True,
+                    'position': position,
+                    'device': ticket.device,
+                },
+            )
+
+        # Older clients would take any successful reply for 'ready'
+        report = report_position if hello.get('queue_position') else None
+
+        while True:
+            try:
+                message = await recv_message(reader)
+            except ConnectionClosed:
+                return
+
+            if message.get('type') == 'inventory':
+                loop = asyncio.get_running_loop()
+                await send_message(writer, await loop.run_in_executor(None, self.inventory.reply, path))
+                continue
+            if message.get('type') == 'ping':
+                await send_message(writer, {'type': 'pong', 'success': True})
+                continue
+            if message.get('type') != 'send':
+                await send_message(
+                    writer,
+                    {
+                        'success': False,
+                        'reason': 'unknown_message_type',
+                    },
+                )
+                continue
+
+            print('receiving snapshot {} (parent {})'.format(
+                message.get('snapshot'),
+                message.get('parent'),
+            ))
+            # Older clients don't send one
+            tid = message.get('transfer_id') or new_transfer_id()
+            with tracer.transfer(tid), tracer.span('transfer', client=cn, snapshot=message.get('snapshot')) as span:
+                async with self.admission.slot(cn, report) as ticket:
+                    tracer.record('admission', ticket.wait_seconds, device=ticket.device)
+                    meter = status_board.start('{}:{}'.format(cn, message.get('snapshot')), 'receive')
+                    tuner.start(sock)
+                    print('Link tuning:', tuner.format())
+                    meter.on_first_rate = partial(tuner.early_rate, sock)
+                    self.inventory.start_receive(path, message.get('snapshot'))
+                    try:
+                        if message.get('resumable') and self.spool_root is not None:
+                            data = await self.receive_spooled(reader, writer, cn, path, message, meter)
+                        else:
+                            data = await self.receive_direct(reader, writer, path, meter, digest_algorithm)
+                    finally:
+                        self.inventory.finish_receive(path, message.get('snapshot'))
+                        meter.finish()
+                    data['link'] = span['link'] = tuner.describe()
+                    self.record_link(cn, tuner, meter)
+                    data['scheduling'] = self.admission.scheduler.describe(ticket)
+            data['type'] = 'result'
+            if data.get('stream_broken'):
+                data['session_closed'] = True
+                try:
+                    await send_message(writer, data)
+                except OSError:
+                    pass
+                return
+            await send_message(writer, data)
+
+    async def receive_direct(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            path: Path,
+            meter: TransferMeter,
+            digest_algorithm: Optional[str] = None,
+    ) -> dict:
+        await send_message(writer, {'type': 'ready', 'success': True})
+        received_streams = []
+
+        async def feed(write):
+            received = await receive_stream(reader, write, meter)
+            received_streams.append(received)
+            return received.copy_result
+
+        digest = None if digest_algorithm is None else StreamDigest(digest_algorithm)
+        data = await receive_snapshot(path, feed, digest)
+        if received_streams:
+            received = received_streams[0]
+            data['wire_bytes'] = received.wire_bytes
+            data['decompress_seconds'] = received.decompress_seconds
+            check_end_summary(data, received.end_summary)
+        return data
+
+    async def receive_spooled(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            cn: str,
+            path: Path,
+            message: dict,
+            meter: TransferMeter,
+    ) -> dict:
+        loop = asyncio.get_running_loop()
+        spool_dir = self.spool_root / cn
+        tid = transfer_id(message['snapshot'], message.get('parent'))
+        if tid in self.active_spools:
+            data = {
+                'type': 'ready',
+                'success': False,
+                'reason': 'transfer_in_progress',
+            }
+            await send_message(writer, data)
+            return data
+        self.active_spools.add(tid)
+
+        spool = Spool(spool_dir, tid, self.checkpoint_interval)
+        try:
+            # Spool I/O (including fsync at checkpoints) happens in the
+            # default executor so it doesn't stall other connections
+            await loop.run_in_executor(None, remove_stale_spools, spool_dir)
+            offset = await loop.run_in_executor(None, spool.open)
+            if offset:
+                print('resuming {} at offset {}'.format(message['snapshot'], offset))
+            await send_message(
+                writer,
+                {
+                    'type': 'ready',
+                    'success': True,
+                    'resumable': True,
+                    'offset': offset,
+                },
+            )
+
+            async def write(data):
+                await loop.run_in_executor(None, spool.write, data)
+
+            try:
+                with tracer.span('spool', offset=offset):
+                    received = await receive_stream(reader, write, meter)
+            except (OSError, ProtocolError) as e:
+                print('stream interrupted at {} bytes: {!r}'.format(spool.size, e))
+                await loop.run_in_executor(None, spool.checkpoint)
+                return {
+                    'success': False,
+                    'stream_broken': True,
+                    'resumable': True,
+                    'offset': spool.committed,
+                    'reason': repr(e),
+                }
+            await loop.run_in_executor(None, spool.checkpoint)
+
+            reason = spool.verify(received.end_summary)
+            if reason is not None:
+                print('spooled stream rejected:', reason)
+                await loop.run_in_executor(None, spool.remove)
+                return {
+                    'success': False,
+                    'reason': reason,
+                }
+
+            # `btrfs receive` can read the spool file itself
+            with tracer.span('spawn_receive'):
+                proc = await asyncio.create_subprocess_exec(
+                    *receive_command(path),
+                    stdin=spool.reader(),
+                    cwd=str(path),
+                )
+            with tracer.span('receive_wait') as span:
+                return_code = await proc.wait()
+                span['return_code'] = return_code
+            data = receive_result(return_code, CopyResult('stdin', spool.size), None)
+            data['wire_bytes'] = received.wire_bytes
+            data['decompress_seconds'] = received.decompress_seconds
+            data['resumed_from'] = offset
+            if data['success']:
+                data['stream_digest'] = spool.hasher.summary()
+            await loop.run_in_executor(None, spool.remove)
+            return data
+        finally:
+            spool.close()
+            self.active_spools.discard(tid)
+
+    async def handle_two_port(self, writer: asyncio.StreamWriter, cn: str, path: Path):
+        # No way to report a queue position to these clients; they just
+        # wait a little longer for the data port
+        with tracer.transfer(new_transfer_id()), tracer.span('transfer', client=cn):
+            async with self.admission.slot(cn) as ticket:
+                tracer.record('admission', ticket.wait_seconds, device=ticket.device)
+                connected = asyncio.get_running_loop().create_future()
+
+                def accept(data_reader, data_writer):
+                    if connected.done():
+                        data_writer.close()
+                    else:
+                        connected.set_result((data_reader, data_writer))
+
+                data_server = await asyncio.start_server(
+                    accept,
+                    '0.0.0.0',
+                    0,
+                    ssl=self.ssl_context,
+                    limit=STREAM_READER_LIMIT,
+                )
+                try:
+                    new_addr, new_port = data_server.sockets[0].getsockname()[:2]
+                    print('bound new socket to {}:{}'.format(new_addr, new_port))
+                    writer.write(
+                        serialize_json(
+                            {
+                                'success': True,
+                                'protocol': PROTOCOL_TWO_PORT,
+                                'new_port': new_port,
+                            }
+                        )
+                    )
+                    await writer.drain()
+                    try:
+                        data_reader, data_writer = await asyncio.wait_for(connected, DATA_CONNECTION_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        print('client never connected to data port')
+                        return
+                finally:
+                    data_server.close()
+
+                print('accepted connection from {}:{}'.format(*data_writer.get_extra_info('peername')[:2]))
+                data_socket = data_writer.get_extra_info('socket')
+                tuner = LinkTuner(self.link, sending=False, bandwidth=self.link_rates.get(cn))
+                tuner.start(data_socket)
+                print('Link tuning:', tuner.format())
+                chunk_size = tuner.chunk_size or DATA_CHUNK_SIZE
+
+                # Old clients don't tell us which snapshot this is
+                meter = status_board.start('{}:two-port'.format(cn), 'receive')
+                meter.on_first_rate = partial(tuner.early_rate, data_socket)
+
+                async def feed(write):
+                    received = 0
+                    while True:
+                        chunk = await data_reader.read(chunk_size)
+                        if not chunk:
+                            return CopyResult('asyncio', received)
+                        await write(chunk)
+                        received += len(chunk)
+                        meter.update(len(chunk))
+
+                try:
+                    data = await receive_snapshot(path, feed)
+                finally:
+                    self.inventory.finish_receive(path, None)
+                    meter.finish()
+                    data_writer.close()
+                data['link'] = tuner.describe()
+                self.record_link(cn, tuner, meter)
+                data['scheduling'] = self.admission.scheduler.describe(ticket)
+                writer.write(serialize_json(data))
+                await writer.drain()
+
+def serve(
+        paths: Mapping[str, Path],
+        key_paths: Mapping[str, Path],
+        admission: AdmissionController,
+        spool_root: Optional[Path] = None,
+        checkpoint_interval: int = CHECKPOINT_INTERVAL,
+        port: int = CONTROL_PORT,
+        link: Optional[LinkSettings] = None,
+):
+    files = [str(key_paths[k]) for k in ['server_cert', 'server_key', 'ca_cert']]
+    contexts = ReloadingContext(partial(make_server_context, *files), files)
+    server = BtrfsReceiveServer(paths, contexts, admission, spool_root, checkpoint_interval, link)
+    asyncio.run(server.serve_forever(port=port))
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the transfer data path, without btrfs or a second machine.
+
+`btrfs send` and `btrfs receive` are replaced by the `fake-send` and
+`fake-receive` subcommands of this script: a synthetic stream of a given
+size and compressibility, and a sink that consumes at a given rate. Each
+benchmark case runs in its own process (so peak RSS means something), which
+starts a real server engine on a loopback port with throwaway certificates
+and sends the stream with the real `client.backup_snapshot`.
+
+Example:
+
+    ./benchmark.py --size 1G --buffer-sizes 1M,16M --strategies auto,readinto \\
+        --output results.json
+
+Results are written as JSON, one entry per case, so that runs from
+different versions can be compared.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import itertools
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import socket
+import ssl
+from subprocess import DEVNULL, PIPE, check_call, run
+import sys
+from tempfile import TemporaryDirectory
+import threading
+from time import perf_counter, sleep
+from typing import List, Mapping, Optional
+
+SCRIPT_PATH = Path(__file__).resolve()
+
+FAKE_BLOCK_SIZE = 1 << 20
+# Distinct blocks in the fake stream, so that compression can't just find
+# the previous block
+FAKE_BLOCK_COUNT = 8
+
+DEFAULT_SIZE = '256M'
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+CERT_SUBJECTS = {
+    'ca': '/CN=btrfs-syncd benchmark CA',
+    'server': '/CN=localhost',
+    'client': '/CN=benchmark',
+}
+
+def parse_size(s: str) -> int:
+    s = s.strip().upper()
+    if s and s[-1] in SIZE_SUFFIXES:
+        return int(float(s[:-1]) * SIZE_SUFFIXES[s[-1]])
+    return int(s)
+
+def parse_list(s: str, convert=str) -> list:
+    return [convert(piece) for piece in s.split(',') if piece]
+
+def fake_blocks(compressibility: float) -> List[bytes]:
+    """
+    :param compressibility: Fraction of each block that is zeros, 0 to 1
+    """
+    random_size = int(FAKE_BLOCK_SIZE * (1 - compressibility))
+    return [
+        os.urandom(random_size) + bytes(FAKE_BLOCK_SIZE - random_size)
+        for _ in range(FAKE_BLOCK_COUNT)
+    ]
+
+def fake_send(args):
+    """
+    Stands in for `btrfs send`: writes `--size` bytes to stdout
+    """
+    blocks = fake_blocks(args.compressibility)
+    fd = sys.stdout.fileno()
+    remaining = args.size
+    for block in itertools.cycle(blocks):
+        if not remaining:
+            break
+        view = memoryview(block)[:min(remaining, len(block))]
+        while view:
+            view = view[os.write(fd, view):]
+        remaining -= min(remaining, len(block))
+
+def fake_receive(args):
+    """
+    Stands in for `btrfs receive`: consumes stdin, at most `--rate` bytes per
+    second if that's nonzero
+    """
+    fd = sys.stdin.fileno()
+    buffer = memoryview(bytearray(FAKE_BLOCK_SIZE))
+    start = perf_counter()
+    received = 0
+    while True:
+        n = os.readv(fd, [buffer])
+        if not n:
+            break
+        received += n
+        if args.rate:
+            ahead = received / args.rate - (perf_counter() - start)
+            if ahead > 0:
+                sleep(ahead)
+
+def make_certificates(directory: Path, clients: Optional[Mapping[str, str]] = None):
+    """
+    Throwaway CA, server and client certificates, made with `openssl`
+
+    :param clients: File name prefix -> subject of each client certificate;
+    defaults to one, 'client'
+    """
+    def openssl(*args):
+        check_call(['openssl'] + list(args), stdout=DEVNULL, stderr=DEVNULL)
+
+    if clients is None:
+        clients = {'client': CERT_SUBJECTS['client']}
+    subjects = {'ca': CERT_SUBJECTS['ca'], 'server': CERT_SUBJECTS['server']}
+    subjects.update(clients)
+    for name in subjects:
+        openssl(
+            'req', '-new', '-newkey', 'rsa:2048', '-nodes',
+            '-subj', subjects[name],
+            '-keyout', str(directory / (name + '.key.pem')),
+            '-out', str(directory / (name + '.csr.pem')),
+        )
+    openssl(
+        'x509', '-req', '-days', '1',
+        '-in', str(directory / 'ca.csr.pem'),
+        '-signkey', str(directory / 'ca.key.pem'),
+        '-out', str(directory / 'ca.crt.pem'),
+    )
+    for name in ['server'] + list(clients):
+        openssl(
+            'x509', '-req', '-days', '1',
+            '-in', str(directory / (name + '.csr.pem')),
+            '-CA', str(directory / 'ca.crt.pem'),
+            '-CAkey', str(directory / 'ca.key.pem'),
+            '-CAcreateserial',
+            '-out', str(directory / (name + '.crt.pem')),
+        )
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def cpu_seconds(who) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def start_server(case: dict, key_dir: Path, destination: Path):
+    """
+    :return: Port, and an object with `handshake_stats`
+    """
+    files = [str(key_dir / name) for name in ['server.crt.pem', 'server.key.pem', 'ca.crt.pem']]
+    paths = {'benchmark': destination}
+    if case['engine'] == 'asyncio':
+        import asyncio
+        from functools import partial
+        import aio_server
+        from ssl_socketserver import make_server_context
+        from tls import ReloadingContext
+        server = aio_server.BtrfsReceiveServer(
+            paths,
+            ReloadingContext(partial(make_server_context, *files), files),
+            aio_server.AdmissionController(),
+        )
+        port = free_port()
+        threading.Thread(
+            target=asyncio.run,
+            args=(server.serve_forever('127.0.0.1', port),),
+            daemon=True,
+        ).start()
+        # Wait for the listening socket
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                sleep(0.05)
+        return port, server
+
+    import server as threaded_server
+    from ssl_socketserver import SSL_ThreadingTCPServer
+    server = SSL_ThreadingTCPServer(
+        ('127.0.0.1', 0),
+        threaded_server.get_handler_class(paths),
+        *files
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1], server
+
+def run_case(args):
+    """
+    Run one benchmark case in this process, and write its result to
+    `args.result`
+    """
+    case = json.loads(args.case)
+
+    import btrfs_incremental_send
+    import client
+    import client_session
+    import copy_engine
+    import protocol
+    from btrfs_incremental_send import Subvolume
+    from compression import CompressionSettings, offered_codecs
+    from digest import offered_digests
+    from link_tuning import LinkSettings
+    from meter import status_board
+
+    # Same list objects everywhere they've been imported
+    btrfs_incremental_send.BTRFS_SEND_COMMAND[:] = [
+        sys.executable, str(SCRIPT_PATH), 'fake-send',
+        '--size', str(case['size']),
+        '--compressibility', str(case['compressibility']),
+    ]
+    btrfs_incremental_send.BTRFS_RECEIVE_COMMAND[:] = [
+        sys.executable, str(SCRIPT_PATH), 'fake-receive',
+        '--rate', str(case['receive_rate']),
+        '{path}',
+    ]
+    # Frames are the buffers of the multiplexed protocol
+    copy_engine.BUFFER_SIZE = case['buffer_size']
+    protocol.MAX_FRAME_SIZE = case['buffer_size']
+    if case['strategy'] == 'readinto':
+        copy_engine.splice_available = False
+        copy_engine.sendfile_available = False
+    client_session.SUPPORTED_PROTOCOLS = [case['protocol']]
+    # Progress reports would only slow things down
+    status_board.report_interval = float('inf')
+
+    key_dir = Path(args.key_dir)
+    with TemporaryDirectory() as temp:
+        temp = Path(temp)
+        port, server = start_server(case, key_dir, temp)
+        options = client_session.TransferOptions(
+            CompressionSettings(offered_codecs(case['compression'])),
+            use_inventory=False,
+            digests=offered_digests(case['digest']),
+            # The buffer size is what's being compared, so don't let link
+            # tuning pick one
+            link=LinkSettings(chunk_size=case['buffer_size']),
+        )
+        sessions = client_session.SessionPool(
+            '127.0.0.1',
+            client_session.make_client_contexts(
+                {
+                    'ca_cert': key_dir / 'ca.crt.pem',
+                    'client_cert': key_dir / 'client.crt.pem',
+                    'client_key': key_dir / 'client.key.pem',
+                }
+            ),
+            options,
+            port,
+        )
+
+        runs = []
+        self_cpu = cpu_seconds(resource.RUSAGE_SELF)
+        children_cpu = cpu_seconds(resource.RUSAGE_CHILDREN)
+        for i in range(case['repeat']):
+            snapshot = Subvolume()
+            snapshot.newest = 'benchmark@{}'.format(i)
+            snapshot.cwd = temp
+            start = perf_counter()
+            response = client.backup_snapshot(snapshot, sessions)
+            seconds = perf_counter() - start
+            if not response['success']:
+                raise RuntimeError('Transfer failed: {}'.format(response))
+            runs.append(
+                {
+                    'seconds': seconds,
+                    'copy_strategy': response.get('copy_strategy'),
+                    'wire_bytes': response.get('wire_bytes'),
+                    # Hashing time on each end, if the stream was hashed
+                    'digest_algorithm': response.get('sent_digest', {}).get('algorithm'),
+                    'client_digest_seconds': response.get('sent_digest', {}).get('seconds'),
+                    'server_digest_seconds': response.get('stream_digest', {}).get('seconds'),
+                }
+            )
+        self_cpu = cpu_seconds(resource.RUSAGE_SELF) - self_cpu
+        children_cpu = cpu_seconds(resource.RUSAGE_CHILDREN) - children_cpu
+        sessions.close_all()
+
+    gigabytes = case['size'] * case['repeat'] / 1e9
+    seconds = sorted(run['seconds'] for run in runs)
+    result = {
+        'case': case,
+        'runs': runs,
+        'throughput_mb_per_second': {
+            'best': case['size'] / seconds[0] / 1e6,
+            'median': case['size'] / seconds[len(seconds) // 2] / 1e6,
+        },
+        # Client and server together; the fake send/receive processes are
+        # counted separately
+        'cpu_seconds_per_gb': self_cpu / gigabytes,
+        'stand_in_cpu_seconds_per_gb': children_cpu / gigabytes,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'client_handshakes': sessions.handshake_stats.summary(),
+        'server_handshakes': server.handshake_stats.summary(),
+    }
+    with open(args.result, 'w') as f:
+        json.dump(result, f)
+
+def version_info() -> dict:
+    from copy_engine import ktls_available, sendfile_available, splice_available
+    git = run(
+        ['git', 'describe', '--always', '--dirty'],
+        cwd=str(SCRIPT_PATH.parent),
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    return {
+        'git': git.stdout.strip() or None,
+        'python': platform.python_version(),
+        'openssl': ssl.OPENSSL_VERSION,
+        'platform': platform.platform(),
+        'splice_available': splice_available,
+        'sendfile_available': sendfile_available,
+        'ktls_available': ktls_available,
+    }
+
+def benchmark(args):
+    cases = [
+        {
+            'size': args.size,
+            'compressibility': compressibility,
+            'receive_rate': args.receive_rate,
+            'buffer_size': buffer_size,
+            'strategy': strategy,
+            'protocol': protocol,
+            'compression': compression,
+            'engine': engine,
+            'digest': digest,
+            'repeat': args.repeat,
+        }
+        for compressibility, buffer_size, strategy, protocol, compression, engine, digest in itertools.product(
+            args.compressibility,
+            args.buffer_sizes,
+            args.strategies,
+            args.protocols,
+            args.compression,
+            args.engines,
+            args.digests,
+        )
+    ]
+
+    results = []
+    with TemporaryDirectory() as temp:
+        key_dir = Path(temp)
+        make_certificates(key_dir)
+        for i, case in enumerate(cases, 1):
+            print('[{}/{}] {}'.format(i, len(cases), case), flush=True)
+            result_path = key_dir / 'result.json'
+            completed = run(
+                [
+                    sys.executable, str(SCRIPT_PATH), 'run-case',
+                    '--key-dir', str(key_dir),
+                    '--result', str(result_path),
+                    json.dumps(case),
+                ],
+                stdout=None if args.verbose else DEVNULL,
+            )
+            if completed.returncode:
+                print('  failed with return code', completed.returncode)
+                results.append({'case': case, 'error': completed.returncode})
+                continue
+            with result_path.open() as f:
+                result = json.load(f)
+            print(
+                '  {:.1f} MB/s (best of {}), {:.2f} CPU s/GB, peak RSS {:.1f} MB'.format(
+                    result['throughput_mb_per_second']['best'],
+                    case['repeat'],
+                    result['cpu_seconds_per_gb'],
+                    result['peak_rss_bytes'] / 1e6,
+                ),
+                flush=True,
+            )
+            results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(
+            {
+                'started': datetime.now().isoformat(),
+                'version': version_info(),
+                'results': results,
+            },
+            f,
+            indent=2,
+        )
+    print('Results written to', args.output)
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('fake-send')
+    p.add_argument('--size', type=parse_size, required=True)
+    p.add_argument('--compressibility', type=float, default=0.0)
+    p.add_argument('-p', dest='parent')
+    p.add_argument('snapshot')
+    p.set_defaults(func=fake_send)
+
+    p = subparsers.add_parser('fake-receive')
+    p.add_argument('--rate', type=parse_size, default=0)
+    p.add_argument('path')
+    p.set_defaults(func=fake_receive)
+
+    p = subparsers.add_parser('run-case')
+    p.add_argument('--key-dir', required=True)
+    p.add_argument('--result', required=True)
+    p.add_argument('case')
+    p.set_defaults(func=run_case)
+
+    # Benchmarking is the default when no subcommand is given
+    parser.add_argument('--size', type=parse_size, default=parse_size(DEFAULT_SIZE))
+    parser.add_argument(
+        '--compressibility',
+        type=lambda s: parse_list(s, float),
+        default=[0.0],
+        help='Comma-separated fractions of each block that is zeros',
+    )
+    parser.add_argument(
+        '--receive-rate',
+        type=parse_size,
+        default=0,
+        help='Bytes per second the fake `btrfs receive` consumes; 0 for unlimited',
+    )
+    parser.add_argument('--buffer-sizes', type=lambda s: parse_list(s, parse_size), default=[1 << 24])
+    parser.add_argument(
+        '--strategies',
+        type=parse_list,
+        default=['auto'],
+        help="'auto' (kernel copies where possible) and/or 'readinto'",
+    )
+    parser.add_argument('--protocols', type=parse_list, default=['multiplexed'])
+    parser.add_argument('--compression', type=parse_list, default=['none'])
+    parser.add_argument('--engines', type=parse_list, default=['threading'])
+    parser.add_argument(
+        '--digests',
+        type=parse_list,
+        default=['auto'],
+        help="Stream digest algorithms to compare, e.g. 'blake2b,sha256'; 'auto' or 'none'",
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--verbose', action='store_true', help='Show client and server output')
+
+    args = parser.parse_args()
+    if args.command is None:
+        benchmark(args)
+    else:
+        args.func(args)
+
+if __name__ == '__main__':
+    main()
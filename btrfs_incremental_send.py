@@ -1,15 +1,14 @@
-from collections import defaultdict
-from datetime import datetime
 import io
 import json
+import os
 from pathlib import Path
 import re
 from subprocess import PIPE, Popen, check_call
-from typing import Mapping
+from typing import List, Mapping, Optional, Set, Tuple
 
-KEEP_FILE_EXTENSION = '.keep'
-
-SNAPSHOT_DATETIME_FORMAT = '%Y%m%d-%H%M%S%z'
+from copy_engine import CopyResult, bulk_copy
+from snapshot_catalog import catalog_snapshots
+from subvolume import KEEP_FILE_EXTENSION, Subvolume, keep_file_name, parse_keep_file_name
 
 BTRFS_SEND_COMMAND = [
     'btrfs',
@@ -24,6 +23,10 @@ BTRFS_DELETE_COMMAND = [
     'subvolume',
     'delete',
 ]
+BTRFS_DELETE_COMMIT_FLAGS = {
+    'after': '--commit-after',
+    'each': '--commit-each',
+}
 BTRFS_RECEIVE_COMMAND = [
     'btrfs',
     'receive',
@@ -36,97 +39,145 @@ PV_COMMAND = [
 
 CONTROL_PORT = 35104
 
-# 16 MB seems okay
-BUFFER_SIZE = 1 << 24
-
 PATH_CONFIG_KEY_PATTERN = re.compile(r'path/(.+)')
 
-def bulk_copy(read_from: io.RawIOBase, write_to: io.RawIOBase):
-    while True:
-        chunk = read_from.read(BUFFER_SIZE)
-        if not chunk:
-            break
-        write_to.write(chunk)
-
 def serialize_json(obj) -> bytes:
     return json.dumps(obj).encode('utf-8') + b'\n'
 
 def deserialize_json(b: bytes):
     return json.loads(b.decode('utf-8'))
 
-class Subvolume:
-    __slots__ = ['all', 'base', 'extra', 'newest', 'cwd']
-
-    def __init__(self):
-        # All snapshots of this subvolume
-        self.all = []
-        # The snapshot with a '.keep' file, used as the '-p' argument to
-        # `btrfs send`
-        self.base = None
-        # Snapshots that are safe to delete after the newest one is
-        # sent elsewhere
-        self.extra = None
-        # Newest snapshot
-        self.newest = None
-
-def parse_datetime(snapshot_name: str) -> datetime:
-    name, timestamp = snapshot_name.split('@')
-    return datetime.strptime(timestamp, SNAPSHOT_DATETIME_FORMAT)
+def snapshots_with_keep_files(path: Path) -> Set[str]:
+    """
+    :return: Names of the snapshots in `path` that are the base for any
+    destination
+    """
+    with os.scandir(str(path)) as entries:
+        return {
+            parse_keep_file_name(entry.name)[0]
+            for entry in entries
+            if entry.name.endswith(KEEP_FILE_EXTENSION)
+        }
 
 def search_snapshots(path: Path) -> Mapping[str, Subvolume]:
-    subvolumes_by_name = defaultdict(Subvolume)
-
-    for entry in path.iterdir():
-        name, timestamp = entry.name.split('@')
-        subvolume = subvolumes_by_name[name]
-        if entry.is_file():
-            if entry.name.endswith('.keep'):
-                # TODO figure out how important this is
-                if subvolume.base is not None:
-                    raise ValueError('Multiple base snapshots')
-                subvolume.base = entry.stem
-        else:
-            subvolume.all.append(entry.name)
-
-    # Found all snapshots; assign some bookkeeping data to each
-    for subvolume in subvolumes_by_name.values():
-        subvolume.cwd = path
-        subvolume.newest = max(subvolume.all, key=parse_datetime)
-        subvolume.extra = set(subvolume.all) - {subvolume.newest}
-
-    return subvolumes_by_name
-
-def send_snapshot(socket: io.RawIOBase, snapshot: Subvolume):
+    """
+    Scan `path` for snapshots, without using or updating the cached catalog
+    (see snapshot_catalog.catalog_snapshots)
+    """
+    return catalog_snapshots(path, cache_dir=None)
+
+def send_snapshot(
+        socket: io.RawIOBase,
+        snapshot: Subvolume,
+        copy=bulk_copy,
+        use_pv: bool = False,
+) -> Tuple[CopyResult, int]:
+    """
+    Run `btrfs send` for the newest snapshot (incremental from the parent
+    snapshot if there is one) and copy the stream into `socket`.
+
+    :param copy: Called as `copy(read_from, socket)`; defaults to a raw copy,
+    but protocol.send_stream can be used to frame the stream
+    :param use_pv: Pipe the stream through PV_COMMAND, for a progress display
+    on a terminal. Otherwise, progress comes from the meter (if any) that
+    `copy` updates.
+    :return: The copy result, and the return code of `btrfs send`
+    """
     command = BTRFS_SEND_COMMAND[:]
-    if snapshot.base is not None:
+    if snapshot.parent is not None:
         command.extend(
             [
-                piece.format(parent=snapshot.base)
+                piece.format(parent=snapshot.parent)
                 for piece in BTRFS_SEND_PARENT_ADDITION
             ]
         )
     command.append(snapshot.newest)
     print('Running', ' '.join(command))
-    btrfs_proc = Popen(command, stdout=PIPE, cwd=str(snapshot.cwd))
-    pv_proc = Popen(PV_COMMAND, stdin=btrfs_proc.stdout, stdout=PIPE)
-    bulk_copy(pv_proc.stdout, socket)
+    # Unbuffered, so that the copy engine can splice straight from the pipe
+    btrfs_proc = Popen(command, stdout=PIPE, cwd=str(snapshot.cwd), bufsize=0)
+    procs = [btrfs_proc]
+    read_from = btrfs_proc.stdout
+    if use_pv:
+        pv_proc = Popen(PV_COMMAND, stdin=btrfs_proc.stdout, stdout=PIPE, bufsize=0)
+        procs.append(pv_proc)
+        read_from = pv_proc.stdout
+    try:
+        copy_result = copy(read_from, socket)
+    except BaseException:
+        # Don't leave `btrfs send` blocked on a pipe nobody reads
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    print('Sent {} bytes using {}'.format(copy_result.bytes_copied, copy_result.strategy))
     # TODO see if this is necessary
     btrfs_proc.stdout.close()
     return_code = btrfs_proc.wait()
     print('`btrfs send` command returned {}'.format(return_code))
-    pv_proc.wait()
-
-def prune_old_snapshots(snapshot: Subvolume):
-    if snapshot.extra:
-        command = BTRFS_DELETE_COMMAND[:]
-        command.extend(snapshot.extra)
-        print('Running', ' '.join(command))
-        check_call(command, cwd=str(snapshot.cwd))
-        if snapshot.base is not None:
-            old_keep_file = snapshot.cwd / (snapshot.base + KEEP_FILE_EXTENSION)
-            old_keep_file.unlink()
-        new_keep_file = snapshot.cwd / (snapshot.newest + KEEP_FILE_EXTENSION)
+    for proc in procs[1:]:
+        proc.stdout.close()
+        proc.wait()
+    return copy_result, return_code
+
+def fsync_directory(path: Path):
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def update_keep_file(snapshot: Subvolume):
+    """
+    Mark the newest snapshot as the base for the next incremental send.
+
+    The old `.keep` file is renamed to the new name rather than created and
+    deleted separately, so a crash can't leave two of them (which makes the
+    path unusable) or none (which makes the next send a full one).
+    """
+    new_keep_file = snapshot.cwd / keep_file_name(snapshot.newest, snapshot.destination)
+    if snapshot.base == snapshot.newest:
+        return
+    if snapshot.base is not None:
+        old_keep_file = snapshot.cwd / keep_file_name(snapshot.base, snapshot.destination)
+        old_keep_file.rename(new_keep_file)
+    else:
         with new_keep_file.open('w'):
             pass
+    fsync_directory(snapshot.cwd)
+    snapshot.base = snapshot.newest
+    snapshot.bases[snapshot.destination] = snapshot.newest
+
+def delete_snapshots(cwd: Path, snapshots: List[str], commit: Optional[str] = None):
+    """
+    :param commit: None, or 'after' or 'each' to wait for the transaction
+    to commit after the last or after every deletion
+    """
+    command = BTRFS_DELETE_COMMAND[:]
+    if commit is not None:
+        command.append(BTRFS_DELETE_COMMIT_FLAGS[commit])
+    command.extend(snapshots)
+    print('Running', ' '.join(command))
+    check_call(command, cwd=str(cwd))
+
+def prunable_snapshots(snapshot: Subvolume) -> List[str]:
+    """
+    :return: The extra snapshots, less any that are still the base for some
+    destination
+    """
+    if not snapshot.extra:
+        return []
+    bases = set(snapshot.bases.values())
+    return [name for name in snapshot.extra if name not in bases]
+
+def prune_old_snapshots(snapshot: Subvolume):
+    """
+    Synchronous pruning: move the `.keep` file, then delete the extra
+    snapshots. See prune_queue.PruneQueue for doing the latter in the
+    background.
+    """
+    update_keep_file(snapshot)
+    extra = prunable_snapshots(snapshot)
+    if extra:
+        delete_snapshots(snapshot.cwd, extra)
     else:
-        print('Nothing to delete for subvolume', snapshot.base)
+        print('Nothing to delete for subvolume', snapshot.newest)
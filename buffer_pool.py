@@ -0,0 +1,167 @@
+"""
+Process-wide pool of reusable copy buffers, with a cap on their total size.
+
+Every copy loop (see copy_engine.py and protocol.py) leases its buffer from
+here instead of allocating one per call, and gives it back when it's done, so
+a process that moves one stream after another keeps reusing the same few
+buffers. Buffers are rounded up to a multiple of SIZE_GRANULARITY and kept
+in a free list per size; a free buffer of another size is dropped when a new
+one is needed and there's no room for both.
+
+The total size of the buffers in use at once is capped at `memory_limit`. A
+copy that would go over it waits in `acquire` until another one gives its
+buffer back, so more concurrent transfers mean more waiting rather than more
+memory. One buffer is always allowed, however large, so a lone transfer never
+waits. Staging buffers (see staging.py) only take memory that's left over,
+and never wait for it.
+
+`summary` describes the pool's occupancy; it's included in the status file
+(see meter.py).
+"""
+from contextlib import contextmanager
+from threading import Condition
+from time import monotonic
+from typing import Dict, Iterator, List, Optional
+
+# 256 MiB: sixteen copies at copy_engine.BUFFER_SIZE, or many more protocol
+# frames
+DEFAULT_MEMORY_LIMIT = 1 << 28
+# Buffer sizes are rounded up to a multiple of this, so that e.g. a frame
+# with or without its header fits in the same buffer
+SIZE_GRANULARITY = 1 << 16
+
+def size_class(size: int) -> int:
+    return max(-(-size // SIZE_GRANULARITY), 1) * SIZE_GRANULARITY
+
+class BufferPool:
+    def __init__(self, memory_limit: int = DEFAULT_MEMORY_LIMIT):
+        # 0 for no limit
+        self.memory_limit = memory_limit
+        self.cond = Condition()
+        self.free: Dict[int, List[bytearray]] = {}
+        # Size of every buffer we hold, in use or free
+        self.allocated = 0
+        self.in_use = 0
+        self.buffers_in_use = 0
+        self.peak_in_use = 0
+        self.allocations = 0
+        self.waiting = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def configure(self, config):
+        """
+        :param config: Client or server config; reads the optional [buffers]
+        section
+        """
+        if 'buffers' not in config:
+            return
+        with self.cond:
+            self.memory_limit = config['buffers'].getint('memory limit', DEFAULT_MEMORY_LIMIT)
+            self.cond.notify_all()
+
+    def _has_room(self, size: int) -> bool:
+        return not self.memory_limit or not self.in_use or self.in_use + size <= self.memory_limit
+
+    def _make_room(self, size: int):
+        # Free buffers of other sizes are only worth keeping while they fit
+        # under the limit alongside this one
+        if not self.memory_limit:
+            return
+        for free in self.free.values():
+            while free and self.allocated + size > self.memory_limit:
+                self.allocated -= len(free.pop())
+
+    def acquire(self, size: int, wait: bool = True, over_limit: bool = False) -> Optional[bytearray]:
+        """
+        :param size: Smallest usable size; the buffer may be bigger
+        :param wait: If false and there's no room, return None rather than
+        waiting for it
+        :param over_limit: Take a buffer even if that goes over the limit
+        (counted as in use all the same); for callers that can't wait and
+        can't do without
+
+        :return: A buffer that the caller has to `release` again
+        """
+        size = size_class(size)
+        wait_start = None
+        with self.cond:
+            while not (over_limit or self._has_room(size)):
+                if not wait:
+                    return None
+                if wait_start is None:
+                    wait_start = monotonic()
+                    self.waits += 1
+                    print(
+                        'Waiting for buffer memory: {} of {} bytes in use'.format(
+                            self.in_use,
+                            self.memory_limit,
+                        )
+                    )
+                self.waiting += 1
+                try:
+                    self.cond.wait()
+                finally:
+                    self.waiting -= 1
+            if wait_start is not None:
+                self.wait_seconds += monotonic() - wait_start
+            free = self.free.get(size)
+            if free:
+                buffer = free.pop()
+            else:
+                self._make_room(size)
+                buffer = bytearray(size)
+                self.allocated += size
+                self.allocations += 1
+            self.in_use += size
+            self.buffers_in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return buffer
+
+    def release(self, buffer: bytearray):
+        """
+        Give back a buffer from `acquire`. It mustn't be used afterwards,
+        including through any memoryview of it.
+        """
+        size = len(buffer)
+        with self.cond:
+            self.in_use -= size
+            self.buffers_in_use -= 1
+            if self.memory_limit and self.allocated > self.memory_limit:
+                # Left over from going over the limit (or lowering it)
+                self.allocated -= size
+            else:
+                self.free.setdefault(size, []).append(buffer)
+            self.cond.notify_all()
+
+    @contextmanager
+    def lease(self, size: int) -> Iterator[memoryview]:
+        """
+        `acquire` a buffer (waiting for room if need be) for the duration of
+        a `with` block
+
+        :return: A view of exactly `size` bytes of it
+        """
+        buffer = self.acquire(size)
+        try:
+            yield memoryview(buffer)[:size]
+        finally:
+            self.release(buffer)
+
+    def summary(self) -> dict:
+        with self.cond:
+            return {
+                'memory_limit': self.memory_limit,
+                'allocated_bytes': self.allocated,
+                'in_use_bytes': self.in_use,
+                'free_bytes': self.allocated - self.in_use,
+                'peak_in_use_bytes': self.peak_in_use,
+                'buffers_in_use': self.buffers_in_use,
+                'allocations': self.allocations,
+                'waiting': self.waiting,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+            }
+
+# Shared by everything in this process
+buffer_pool = BufferPool()
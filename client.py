@@ -1,38 +1,46 @@
 #!/usr/bin/env python3
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from fnmatch import fnmatch
 from functools import partial
 import ipaddress
+import re
 from os.path import ismount
 from pathlib import Path
-from pprint import pprint
 import socket
 from subprocess import Popen, check_call
-import ssl
 import sys
-from typing import Mapping
+from time import monotonic, sleep, time
+import traceback
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Union
 
 from btrfs_incremental_send import (
-    CONTROL_PORT,
     PATH_CONFIG_KEY_PATTERN,
     Subvolume,
-    deserialize_json,
     prune_old_snapshots,
-    search_snapshots,
-    send_snapshot,
+    update_keep_file,
 )
+from buffer_pool import buffer_pool
+from client_session import SessionPool, TransferOptions, make_client_contexts
+from fanout import DestinationDropped, FanoutSettings, fanout_transfer
+from idle_check import IdleCheckSettings, IdleState, path_signature
+from inventory import list_subvolume_uuids, reconcile
+from meter import status_board
 from network_utils import fix_long_ipv6_netmask
-from notify import Notifier
-
-netifaces_available = False
-IP_ADDRESS_FAMILIES = frozenset()
-
-try:
-    import netifaces
-    IP_ADDRESS_FAMILIES = frozenset({netifaces.AF_INET, netifaces.AF_INET6})
-    netifaces_available = True
-except ImportError:
-    pass
+from protocol import ProtocolError
+from prune_queue import PruneQueue, PruneSettings, has_pending_deletions
+from snapshot_catalog import CATALOG_CACHE_DIR, catalog_snapshots
+from planner import (
+    PlannedTransfer,
+    PlanSettings,
+    TransferHistory,
+    export_plan,
+    make_plan,
+    print_plan,
+)
+from tracing import PROFILE_CPROFILE, PROFILE_SAMPLING, new_transfer_id, tracer
+from transfer_queue import QueuedTransfer, TransferQueue, TransferResult
 
 MOUNT_COMMAND = [
     'mount',
@@ -43,14 +51,58 @@ UMOUNT_COMMAND = [
     '{path}'
 ]
 
-class BackupPath:
-    __slots__ = ['name', 'path', 'automount', 'mount_path']
+SERVER_CONFIG_KEY_PATTERN = re.compile(r'server/(.+)')
+
+# Transfers are sequential unless configured otherwise
+DEFAULT_MAX_CONCURRENT_TRANSFERS = 1
 
-    def __init__(self, name, path, automount, mount_path):
+class BackupPath:
+    __slots__ = [
+        'name',
+        'path',
+        'automount',
+        'mount_path',
+        'max_concurrent_transfers',
+        'priority',
+        'subvolume_priorities',
+        'change_marker',
+    ]
+
+    def __init__(
+            self,
+            name,
+            path,
+            automount,
+            mount_path,
+            max_concurrent_transfers,
+            priority=0,
+            subvolume_priorities=None,
+            change_marker=None,
+    ):
         self.name = name
         self.path = path
         self.automount = automount
         self.mount_path = mount_path
+        self.max_concurrent_transfers = max_concurrent_transfers
+        # For [plan] order = priority; higher goes first
+        self.priority = priority
+        self.subvolume_priorities = subvolume_priorities or {}
+        # Its mtime changes whenever a snapshot is taken; see idle_check.py
+        self.change_marker = change_marker
+
+    def subvolume_priority(self, subvolume_name: str) -> int:
+        return self.subvolume_priorities.get(subvolume_name, self.priority)
+
+def parse_subvolume_priorities(value: str) -> Dict[str, int]:
+    """
+    :param value: e.g. 'home:10, var:-1'
+    """
+    priorities = {}
+    for item in value.split(','):
+        if item.strip():
+            name, priority = item.rsplit(':', 1)
+            priorities[name.strip()] = int(priority)
+    return priorities
 
 CONFIG_FILE_PATH = Path('/etc/btrfs-syncd/client.conf')
 def parse_config():
@@ -69,8 +121,27 @@ def parse_config():
             if 'automount' in config[key]:
                 automount = config[key].getboolean('automount')
                 mount_path = config[key]['mount path']
+            max_concurrent_transfers = config[key].getint(
+                'max concurrent transfers',
+                DEFAULT_MAX_CONCURRENT_TRANSFERS,
+            )
 
-            bp = BackupPath(name, path, automount, mount_path)
+            priority = config[key].getint('priority', 0)
+            subvolume_priorities = parse_subvolume_priorities(config[key].get('subvolume priorities', ''))
+            change_marker = None
+            if 'change marker' in config[key]:
+                change_marker = Path(config[key]['change marker'])
+
+            bp = BackupPath(
+                name,
+                path,
+                automount,
+                mount_path,
+                max_concurrent_transfers,
+                priority,
+                subvolume_priorities,
+                change_marker,
+            )
             paths[name] = bp
 
     if 'key_dir' in config['keys']:
@@ -83,67 +154,267 @@ def parse_config():
 
     return config, paths, key_paths
 
-def backup_snapshot(snapshot: Subvolume, host: str, key_paths: Mapping[str, Path]):
+def server_has_snapshot(
+        snapshot: Subvolume,
+        sessions: SessionPool,
+        local_uuids: Optional[Mapping[str, Optional[str]]] = None,
+) -> bool:
     """
-    Connect to the sync daemon on the remote server, and then call the
-    btrfs-specific functionality in this code to:
+    Ask the server which snapshots it holds (if enabled), and pick the
+    parent accordingly; see inventory.reconcile
+
+    :return: Whether the server already has the newest snapshot
+    """
+    if not sessions.options.use_inventory:
+        return False
+    try:
+        inventory = sessions.get().inventory()
+    except BaseException:
+        sessions.discard()
+        raise
+    return inventory is not None and reconcile(snapshot, inventory, local_uuids)
+
+def send_to_server(snapshot: Subvolume, sessions: SessionPool) -> dict:
+    """
+    Send the newest snapshot, reconnecting and resuming if the transfer is
+    resumable and the connection drops
+
+    :return: The last JSON message received from the server
+    """
+    options = sessions.options
+    attempts = options.resume_attempts if options.resumable else 1
+    for attempt in range(1, attempts + 1):
+        try:
+            response = sessions.get().transfer(snapshot)
+            break
+        except (OSError, ProtocolError) as e:
+            sessions.discard()
+            if attempt >= attempts:
+                raise
+            print(
+                'Transfer interrupted ({!r}); reconnecting in {} seconds to resume'.format(
+                    e,
+                    options.resume_delay,
+                )
+            )
+            sleep(options.resume_delay)
+        except BaseException:
+            sessions.discard()
+            raise
+
+    print('Response from server:')
+    print(response)
+    return response
+
+def backup_snapshot(
+        snapshot: Subvolume,
+        sessions: SessionPool,
+        pruner: Optional[PruneQueue] = None,
+        local_uuids: Optional[Mapping[str, Optional[str]]] = None,
+) -> dict:
+    """
+    Connect to the sync daemon on the remote server (or reuse this thread's
+    existing connection), and then call the btrfs-specific functionality in
+    this code to:
      * actually send the snapshot to the remote server
      * clean up previous snapshots
      * mark the most recent snapshot as the next base
 
-    :param host: Hostname to connect to
     :param snapshot:
-    :return:
+    :param sessions: Connections to the server
+    :param pruner: If given, old snapshots are deleted in the background
+    rather than before this returns
+    :param local_uuids: UUIDs of the snapshots in this path, for matching
+    against the server's inventory
+    :return: The last JSON message received from the server, which has
+    a 'success' key in all cases
     """
-    sock_control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-    context.verify_mode = ssl.CERT_REQUIRED
-    context.check_hostname = False
-    context.load_verify_locations(str(key_paths['ca_cert']))
-    context.load_cert_chain(
-        str(key_paths['client_cert']),
-        keyfile=str(key_paths['client_key']),
-    )
+    if server_has_snapshot(snapshot, sessions, local_uuids):
+        print('Server already has {}; not sending it'.format(snapshot.newest))
+        prune_after_transfer(snapshot, pruner)
+        return {'success': True, 'skipped': True}
+
+    response = send_to_server(snapshot, sessions)
+    if response['success'] and response.get('digest_unverified') and sessions.options.require_digest:
+        print("Snapshot sent, but not verified; keeping old snapshots ('require stream digest' is set)")
+        update_keep_file(snapshot)
+    elif response['success']:
+        print('Snapshot sent successfully; cleaning up old ones')
+        prune_after_transfer(snapshot, pruner)
+    elif response.get('digest_mismatch'):
+        # `btrfs receive` was happy, but it didn't get what we sent
+        print('Stream was corrupted in transit; keeping old snapshots')
+    else:
+        print('Server returned failure')
+    return response
+
+def backup_snapshot_fanout(
+        snapshot: Subvolume,
+        destinations: List[SessionPool],
+        fanout_settings: FanoutSettings,
+        pruner: Optional[PruneQueue] = None,
+        local_uuids: Optional[Mapping[str, Optional[str]]] = None,
+) -> Dict[SessionPool, Union[dict, Exception]]:
+    """
+    `backup_snapshot` for several destinations. Destinations that need the
+    same stream share one `btrfs send` (see fanout.py); any that drop out
+    of it are then sent to on their own. Each destination's '.keep' file
+    moves as soon as it has the snapshot, but old snapshots are only deleted
+    once every destination has it.
+
+    :return: Destination -> the server's last message, or the exception
+    that ended its transfer
+    """
+    views = {sessions: snapshot.for_destination(sessions.name) for sessions in destinations}
+    results: Dict[SessionPool, Union[dict, Exception]] = {}
+    # Parent -> the destinations that need a stream from it
+    groups: Dict[Optional[str], Dict[SessionPool, Subvolume]] = {}
+    for sessions, view in views.items():
+        if view.base == view.newest:
+            # Sent there by an earlier run that couldn't reach the others
+            results[sessions] = {'success': True, 'skipped': True}
+            continue
+        try:
+            if server_has_snapshot(view, sessions, local_uuids):
+                print('{} already has {}; not sending it'.format(sessions.host, view.newest))
+                results[sessions] = {'success': True, 'skipped': True}
+                continue
+        except Exception as e:
+            traceback.print_exc()
+            results[sessions] = e
+            continue
+        groups.setdefault(view.parent, {})[sessions] = view
+
+    for group in groups.values():
+        shared = {}
+        if len(group) > 1:
+            print('Sending {} to {} destinations with one `btrfs send`'.format(snapshot.newest, len(group)))
+            shared = fanout_transfer(group, fanout_settings)
+        for sessions, view in group.items():
+            result = shared.get(sessions)
+            if isinstance(result, dict):
+                print('Response from {}:'.format(sessions.host))
+                print(result)
+            elif result is None or isinstance(result, (OSError, ProtocolError, DestinationDropped)):
+                if result is not None:
+                    print('Sending to {} on its own after: {!r}'.format(sessions.host, result))
+                try:
+                    result = send_to_server(view, sessions)
+                except Exception as e:
+                    traceback.print_exc()
+                    result = e
+            results[sessions] = result
+
+    confirmed = [
+        sessions for sessions, result in results.items()
+        if isinstance(result, dict) and result['success']
+    ]
+    for sessions in confirmed:
+        update_keep_file(views[sessions])
+    unverified = [
+        sessions for sessions in confirmed
+        if results[sessions].get('digest_unverified') and sessions.options.require_digest
+    ]
+    if unverified:
+        print("Not deleting old snapshots of {}: not verified by {} ('require stream digest' is set)".format(
+            snapshot.newest,
+            ', '.join(sessions.host for sessions in unverified),
+        ))
+    elif len(confirmed) == len(destinations):
+        print('Snapshot sent to every destination; cleaning up old ones')
+        prune_after_transfer(views[destinations[0]], pruner)
+    else:
+        print('Not deleting old snapshots of {} until every destination has it'.format(snapshot.newest))
+    return results
 
-    conn_control = context.wrap_socket(sock_control)
+def prune_after_transfer(snapshot: Subvolume, pruner: Optional[PruneQueue]):
+    with tracer.span('prune', background=pruner is not None):
+        if pruner is None:
+            prune_old_snapshots(snapshot)
+        else:
+            pruner.schedule(snapshot)
+
+def describe_failure(response: dict) -> Optional[str]:
+    reason = response.get('reason')
+    if reason is None and 'return_code' in response:
+        reason = '`btrfs receive` returned {}'.format(response['return_code'])
+    return reason
+
+def _transfer_subvolume(
+        path_name: str,
+        name: str,
+        snapshot: Subvolume,
+        destinations: List[SessionPool],
+        fanout_settings: FanoutSettings,
+        pruner: Optional[PruneQueue] = None,
+        local_uuids: Optional[Mapping[str, Optional[str]]] = None,
+) -> TransferResult:
+    if len(destinations) > 1:
+        try:
+            results = backup_snapshot_fanout(snapshot, destinations, fanout_settings, pruner, local_uuids)
+        except Exception as e:
+            traceback.print_exc()
+            return TransferResult(path_name, name, snapshot.newest, False, repr(e))
+        failures = []
+        sizes = []
+        for sessions, result in results.items():
+            if isinstance(result, Exception):
+                failures.append('{}: {!r}'.format(sessions.name or sessions.host, result))
+                continue
+            if not result['success']:
+                failures.append('{}: {}'.format(sessions.name or sessions.host, describe_failure(result)))
+            if result.get('stream_bytes') is not None:
+                sizes.append(result['stream_bytes'])
+        return TransferResult(
+            path_name,
+            name,
+            snapshot.newest,
+            not failures,
+            '; '.join(failures) or None,
+            max(sizes, default=None),
+        )
 
     try:
-        # Connect to server and send data
-        print('Connecting to server', host, 'port', CONTROL_PORT)
-        conn_control.connect((host, CONTROL_PORT))
-
-        # Receive data from the server and shut down
-        received = deserialize_json(conn_control.recv(1024))
-
-        if received['success']:
-            print('Server returned success')
-            new_port = received['new_port']
-            print('New port:', new_port)
-            sock_data = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            conn_data = context.wrap_socket(sock_data)
-            try:
-                print('Connecting to new port')
-                conn_data.connect((host, new_port))
-                print('Sending data')
-                send_snapshot(conn_data, snapshot)
-
-            finally:
-                conn_data.close()
-
-            send_result = deserialize_json(conn_control.recv(1024))
-            print('Response from server:')
-            print(send_result)
-            if send_result['success']:
-                print('Snapshot sent successfully; cleaning up old ones')
-                prune_old_snapshots(snapshot)
-
-        else:
-            print('Server returned failure')
-            pprint(received)
+        response = backup_snapshot(snapshot, destinations[0], pruner, local_uuids)
+    except Exception as e:
+        traceback.print_exc()
+        return TransferResult(path_name, name, snapshot.newest, False, repr(e))
+    return TransferResult(
+        path_name,
+        name,
+        snapshot.newest,
+        response['success'],
+        describe_failure(response),
+        response.get('stream_bytes'),
+    )
 
-    finally:
-        conn_control.close()
+def transfer_subvolume(
+        path_name: str,
+        name: str,
+        snapshot: Subvolume,
+        destinations: List[SessionPool],
+        fanout_settings: FanoutSettings,
+        pruner: Optional[PruneQueue] = None,
+        local_uuids: Optional[Mapping[str, Optional[str]]] = None,
+) -> TransferResult:
+    """
+    Run `backup_snapshot` (or `backup_snapshot_fanout`) for one subvolume,
+    turning any failure into a TransferResult so that other transfers can
+    carry on.
+    """
+    with tracer.transfer(new_transfer_id()):
+        with tracer.span('transfer', path=path_name, subvolume=name, snapshot=snapshot.newest) as span:
+            result = _transfer_subvolume(
+                path_name,
+                name,
+                snapshot,
+                destinations,
+                fanout_settings,
+                pruner,
+                local_uuids,
+            )
+            span['success'] = result.success
+    return result
 
 def mount_path_if_necessary(path: Path):
     if not ismount(str(path)):
@@ -163,9 +434,13 @@ def check_should_backup_network(config):
     if 'network' not in config:
         # No network configuration. Allow backups.
         return
-    if not netifaces_available:
+    # Imported here, so that idle runs (see idle_check.py) don't pay for it
+    try:
+        import netifaces
+    except ImportError:
         print("Can't query network status; `netifaces` package not available")
         return
+    ip_address_families = {netifaces.AF_INET, netifaces.AF_INET6}
 
     # This config key can be a fnmatch pattern, so check all interfaces
     # matched by the required interface name. Allow backups if any of them
@@ -182,7 +457,7 @@ def check_should_backup_network(config):
 
     for interface in matching_interfaces:
         interface_addresses = netifaces.ifaddresses(interface)
-        interface_address_families = set(interface_addresses) & IP_ADDRESS_FAMILIES
+        interface_address_families = set(interface_addresses) & ip_address_families
         for address_family in interface_address_families:
             any_matching_interface_has_ip = True
             for address_data in interface_addresses[address_family]:
@@ -225,26 +500,126 @@ def check_should_backup(config):
     check_should_backup_network(config)
     check_should_backup_power(config)
 
-def main():
-    config, backup_paths, key_paths = parse_config()
+def make_destinations(config, key_paths: Mapping[str, Path]) -> List[SessionPool]:
+    """
+    :return: Sessions for [server], then for each [server/NAME] section. The
+    latter need only set 'host'; everything else defaults to [server]'s
+    setting.
+    """
+    contexts = make_client_contexts(key_paths)
+    # Defaults for link tuning; see link_tuning.py
+    network = config['network'] if 'network' in config else None
+    destinations = [
+        SessionPool(
+            config['server']['host'],
+            contexts,
+            TransferOptions.from_config(config['server'], network),
+        )
+    ]
+    for key in config:
+        m = SERVER_CONFIG_KEY_PATTERN.match(key)
+        if m:
+            name = m.group(1)
+            if '.' in name or '@' in name:
+                # These would make its '.keep' files ambiguous
+                raise ValueError("Destination name can't contain '.' or '@': {}".format(name))
+            merged = ConfigParser(interpolation=None)
+            merged.read_dict({'server': dict(config['server'])})
+            merged['server'].update(config[key])
+            destinations.append(
+                SessionPool(
+                    merged['server']['host'],
+                    contexts,
+                    TransferOptions.from_config(merged['server'], network),
+                    name=name,
+                )
+            )
+    return destinations
 
+def start_prune_queue(config) -> Optional[PruneQueue]:
+    """
+    :return: A running PruneQueue, or None if old snapshots should be deleted
+    synchronously after each transfer
+    """
+    prune_settings = PruneSettings.from_config(config)
+    if not prune_settings.background:
+        return None
+    pruner = PruneQueue(prune_settings)
+    pruner.load()
+    pruner.start()
+    return pruner
+
+def get_catalog_cache_dir(config) -> Path:
+    if 'cache' in config:
+        return Path(config['cache']['path'])
+    return CATALOG_CACHE_DIR
+
+def run_transfers(
+        backup_paths: Iterable[BackupPath],
+        executor: ThreadPoolExecutor,
+        destinations: List[SessionPool],
+        fanout_settings: FanoutSettings,
+        pruner: Optional[PruneQueue],
+        catalog_cache_dir: Path,
+        mounted: Optional[List[BackupPath]] = None,
+        plan_settings: Optional[PlanSettings] = None,
+        busy: Optional[Set[str]] = None,
+) -> List[TransferResult]:
+    """
+    Send the newest snapshot of every subvolume in `backup_paths` that the
+    server doesn't have yet, and wait for all of those transfers. They're
+    planned first (see planner.py): put in order, and cut down to the run's
+    budget if there is one.
+
+    :param mounted: If given, automounted paths are left mounted and added
+    to this list, for the caller to unmount later (e.g. once background
+    deletions are done). Otherwise each is unmounted when its transfers are.
+    :param busy: If given, the names of paths that had anything to send
+    (sent, deferred or failed) or couldn't be read are added to it
+    """
+    if plan_settings is None:
+        plan_settings = PlanSettings()
+    history = TransferHistory(plan_settings.history_path)
+    history.load()
+    started = monotonic()
+    results: List[TransferResult] = []
+    # Paths that have been mounted (if necessary) and cataloged
+    ready: List[BackupPath] = []
+    pending: List[PlannedTransfer] = []
+    # PlannedTransfer.key -> job
+    jobs = {}
+    queue = None
     try:
-        check_should_backup(config)
-    except BackupPrerequisiteFailed as e:
-        print('Not backing up, for reason:')
-        print(e.args[0])
-        sys.exit(1)
-
-    notifier = Notifier()
-    notifier.notify('Starting backup')
-
-    for bp in backup_paths.values():
-        if bp.automount:
-            mount_path_if_necessary(bp.mount_path)
-
-        try:
-            for name, snapshot in search_snapshots(bp.path).items():
-                if snapshot.newest == snapshot.base:
+        for bp in backup_paths:
+            try:
+                if bp.automount:
+                    with tracer.span('mount', path=bp.name):
+                        mount_path_if_necessary(bp.mount_path)
+                    if pruner is not None:
+                        # Deletions left over from a previous run may be
+                        # waiting for it
+                        pruner.recheck_directories()
+                    if mounted is not None and bp not in mounted:
+                        mounted.append(bp)
+                with tracer.span('catalog', path=bp.name):
+                    subvolumes = catalog_snapshots(bp.path, catalog_cache_dir)
+                local_uuids = None
+                if any(sessions.options.use_inventory for sessions in destinations):
+                    local_uuids = list_subvolume_uuids(bp.path, 'uuid')
+            except Exception as e:
+                traceback.print_exc()
+                results.append(TransferResult(bp.name, None, None, False, repr(e)))
+                if busy is not None:
+                    busy.add(bp.name)
+                if bp.automount:
+                    umount_path(bp.mount_path)
+                    if mounted is not None and bp in mounted:
+                        mounted.remove(bp)
+                continue
+            ready.append(bp)
+
+            for name, snapshot in subvolumes.items():
+                if all(snapshot.bases.get(sessions.name) == snapshot.newest for sessions in destinations):
                     message = "Most recent snapshot for '{}' ({}) already on remote system".format(
                         name,
                         snapshot.newest,
@@ -259,13 +634,186 @@ def main():
                         snapshot.newest,
                     )
                     print(message)
-                    backup_snapshot(snapshot, config['server']['host'], key_paths)
+                    if busy is not None:
+                        busy.add(bp.name)
+                    planned = PlannedTransfer(
+                        bp.name,
+                        name,
+                        snapshot,
+                        [sessions.name for sessions in destinations],
+                        bp.subvolume_priority(name),
+                    )
+                    pending.append(planned)
+                    jobs[planned.key] = partial(
+                        transfer_subvolume,
+                        bp.name,
+                        name,
+                        snapshot,
+                        destinations,
+                        fanout_settings,
+                        pruner,
+                        local_uuids,
+                    )
+
+        plan = make_plan(pending, plan_settings, history)
+        print_plan(plan, plan_settings)
+        export_plan(plan, plan_settings)
+        for planned in plan:
+            if planned.deferred:
+                history.record_deferred(planned.key)
+        deadline = None
+        if plan_settings.time_budget:
+            deadline = started + plan_settings.time_budget
+        queue = TransferQueue(
+            executor,
+            {bp.name: bp.max_concurrent_transfers for bp in ready},
+            [
+                QueuedTransfer(planned.path_name, planned.subvolume_name, planned.snapshot.newest, jobs[planned.key])
+                for planned in plan
+                if not planned.deferred
+            ],
+            deadline,
+        )
+        queue.start()
 
-        finally:
-            if bp.automount:
+    finally:
+        for bp in ready:
+            try:
+                if queue is not None:
+                    results.extend(queue.wait(bp.name))
+            finally:
+                if bp.automount and mounted is None:
+                    umount_path(bp.mount_path)
+        if queue is not None:
+            for transfer in queue.skipped:
+                history.record_deferred('{}/{}'.format(transfer.path_name, transfer.subvolume_name))
+            sent = 0
+            for result in results:
+                if result.success and result.subvolume_name is not None:
+                    history.record_sent('{}/{}'.format(result.path_name, result.subvolume_name), result.size)
+                    sent += result.size or 0
+            history.record_run(sent, monotonic() - started)
+            history.save()
+    return results
+
+def report_results(results: List[TransferResult], destinations: List[SessionPool]) -> List[TransferResult]:
+    """
+    :return: The failed ones; deferred ones don't count
+    """
+    if results:
+        print('Transfer results:')
+        for result in results:
+            print(' ', result)
+        if len(destinations) == 1:
+            print('TLS handshakes:', destinations[0].handshake_stats)
+        else:
+            for sessions in destinations:
+                print('TLS handshakes ({}):'.format(sessions.host), sessions.handshake_stats)
+    return [result for result in results if not (result.success or result.deferred)]
+
+def main(profile: Optional[str] = None):
+    """
+    :param profile: From --profile; see tracing.py
+    """
+    config, backup_paths, key_paths = parse_config()
+    tracer.configure(config, 'client', profile)
+    with tracer.profiling():
+        run_backup(config, backup_paths, key_paths)
+
+def run_backup(config, backup_paths: Mapping[str, BackupPath], key_paths: Mapping[str, Path]):
+    # Before anything slow (see idle_check.py)
+    idle_settings = IdleCheckSettings.from_config(config)
+    idle_state = IdleState(idle_settings.state_path)
+    if idle_settings.enabled:
+        idle_state.load()
+        reason = idle_state.reason_to_run(
+            idle_settings,
+            CONFIG_FILE_PATH,
+            backup_paths.values(),
+            has_pending_deletions(PruneSettings.from_config(config).journal_path),
+        )
+        if reason is None:
+            idle_state.record_idle_run()
+            print('Nothing to send since the last run; done in {:.3f}s'.format(idle_state.last_idle_run_seconds))
+            return
+        print('Checking every path:', reason)
+    signatures_taken = time()
+    signatures = {name: path_signature(bp) for name, bp in backup_paths.items()}
+
+    try:
+        check_should_backup(config)
+    except BackupPrerequisiteFailed as e:
+        print('Not backing up, for reason:')
+        print(e.args[0])
+        sys.exit(1)
+
+    # Imported here since it's slow (gi), and idle runs don't notify
+    from notify import Notifier
+
+    status_board.configure(config)
+    buffer_pool.configure(config)
+    notifier = Notifier()
+    notifier.notify('Starting backup')
+
+    destinations = make_destinations(config, key_paths)
+    max_concurrent_transfers = config['server'].getint(
+        'max concurrent transfers',
+        DEFAULT_MAX_CONCURRENT_TRANSFERS,
+    )
+    pruner = start_prune_queue(config)
+    # Only filled in if there's a prune queue: paths stay mounted until its
+    # deletions are done
+    mounted: Optional[List[BackupPath]] = None if pruner is None else []
+    busy: Set[str] = set()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrent_transfers) as executor:
+            results = run_transfers(
+                backup_paths.values(),
+                executor,
+                destinations,
+                FanoutSettings.from_config(config),
+                pruner,
+                get_catalog_cache_dir(config),
+                mounted,
+                PlanSettings.from_config(config),
+                busy,
+            )
+    finally:
+        for sessions in destinations:
+            sessions.close_all()
+        if pruner is not None:
+            pruner.close()
+            for bp in mounted:
                 umount_path(bp.mount_path)
 
+    failures = report_results(results, destinations)
+    if idle_settings.enabled:
+        idle_state.record_full_run(CONFIG_FILE_PATH, signatures, signatures_taken, busy)
+        print('Done in {:.3f}s'.format(idle_state.last_full_run_seconds))
+    if failures:
+        notifier.notify('Backup finished with {} failure(s)'.format(len(failures)))
+        sys.exit(1)
     notifier.notify('Backup complete')
 
 if __name__ == '__main__':
-    main()
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help=(
+            'Keep running, and send new snapshots as they appear instead of '
+            'checking once'
+        ),
+    )
+    parser.add_argument(
+        '--profile',
+        choices=[PROFILE_CPROFILE, PROFILE_SAMPLING],
+        help='Profile the whole run; see tracing.py',
+    )
+    args = parser.parse_args()
+    if args.daemon:
+        from client_daemon import run_daemon
+        run_daemon(args.profile)
+    else:
+        main(args.profile)
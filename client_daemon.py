@@ -0,0 +1,472 @@
+"""
+Daemon mode for the client: `client.py --daemon`.
+
+Instead of checking every path once per timer run, stay running and send new
+snapshots soon after they appear. Each snapshot directory is watched with
+inotify; once a directory has had no new entries for 'debounce' seconds
+(snapshot tools often create several subvolumes in a row), that path is
+backed up like in a normal run. Everything a run would otherwise set up from
+scratch stays around between backups: the parsed config, the TLS context
+and session, a connected control session (pinged every 'keepalive interval'
+seconds so it isn't dropped), the snapshot catalogs and the prune queue.
+Automounted paths are mounted when the daemon starts and stay mounted, since
+an unmounted directory can't be watched.
+
+The [network] and [power] prerequisites are checked again only when the
+kernel reports a change to a network interface or address (rtnetlink) or to
+a power supply (uevents), rather than before every backup. Where inotify or
+netlink isn't available, directories are polled and the prerequisites
+checked every 'poll interval' seconds instead. All paths are also checked
+every 'rescan interval' seconds whether or not anything happened, which
+retries failed transfers and catches anything the watches missed.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import selectors
+import signal
+import socket
+import struct
+from time import monotonic
+from typing import Dict, List, Mapping, Optional, Set
+
+from buffer_pool import buffer_pool
+from client import (
+    DEFAULT_MAX_CONCURRENT_TRANSFERS,
+    BackupPath,
+    BackupPrerequisiteFailed,
+    check_should_backup,
+    get_catalog_cache_dir,
+    make_destinations,
+    mount_path_if_necessary,
+    parse_config,
+    report_results,
+    run_transfers,
+    start_prune_queue,
+    umount_path,
+)
+from client_session import SessionPool
+from fanout import FanoutSettings
+from meter import status_board
+from notify import Notifier
+from planner import PlanSettings
+from protocol import ProtocolError
+from prune_queue import PruneQueue
+from tracing import tracer
+
+inotify_available = False
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    inotify_available = True
+except (OSError, AttributeError):
+    pass
+
+# From <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+INOTIFY_EVENT = struct.Struct('iIII')
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+INOTIFY_READ_SIZE = 1 << 16
+
+# From <linux/netlink.h> and <linux/rtnetlink.h>
+NETLINK_ROUTE = 0
+NETLINK_KOBJECT_UEVENT = 15
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+UEVENT_KERNEL_GROUP = 1
+NETLINK_READ_SIZE = 1 << 16
+
+DEFAULT_DEBOUNCE = 30.0
+DEFAULT_KEEPALIVE_INTERVAL = 60.0
+DEFAULT_RESCAN_INTERVAL = 6 * 60 * 60.0
+DEFAULT_POLL_INTERVAL = 60.0
+# Seconds to let a burst of network or power events settle before checking
+# the prerequisites again
+PREREQUISITE_SETTLE_TIME = 2.0
+
+class DaemonSettings:
+    __slots__ = ['debounce', 'keepalive_interval', 'rescan_interval', 'poll_interval']
+
+    def __init__(
+            self,
+            debounce: float = DEFAULT_DEBOUNCE,
+            keepalive_interval: float = DEFAULT_KEEPALIVE_INTERVAL,
+            rescan_interval: float = DEFAULT_RESCAN_INTERVAL,
+            poll_interval: float = DEFAULT_POLL_INTERVAL,
+    ):
+        self.debounce = debounce
+        # 0 to let idle sessions close instead
+        self.keepalive_interval = keepalive_interval
+        self.rescan_interval = rescan_interval
+        self.poll_interval = poll_interval
+
+    @classmethod
+    def from_config(cls, config) -> 'DaemonSettings':
+        """
+        :param config: Client config; reads the optional [daemon] section
+        """
+        if 'daemon' not in config:
+            return cls()
+        section = config['daemon']
+        return cls(
+            section.getfloat('debounce', DEFAULT_DEBOUNCE),
+            section.getfloat('keepalive interval', DEFAULT_KEEPALIVE_INTERVAL),
+            section.getfloat('rescan interval', DEFAULT_RESCAN_INTERVAL),
+            section.getfloat('poll interval', DEFAULT_POLL_INTERVAL),
+        )
+
+class DirectoryWatcher:
+    """
+    inotify watches on snapshot directories
+    """
+    def __init__(self):
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # Watch descriptor -> path name
+        self.watches: Dict[int, str] = {}
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def watch(self, name: str, path: Path):
+        wd = _inotify_add_watch(self.fd, os.fsencode(str(path)), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        self.watches[wd] = name
+
+    def read(self) -> Set[str]:
+        """
+        :return: Names of the paths with new snapshots, or whose watch went
+        away (the directory was removed or unmounted); the caller can tell
+        those apart with `watching`
+        """
+        try:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; assume everything changed
+                changed.update(self.watches.values())
+                continue
+            name = self.watches.get(wd)
+            if name is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                changed.add(name)
+            elif mask & IN_ISDIR:
+                # Only directories can be snapshots; this also skips our own
+                # '.keep' files
+                changed.add(name)
+        return changed
+
+    def watching(self, name: str) -> bool:
+        return name in self.watches.values()
+
+    def close(self):
+        os.close(self.fd)
+
+class SystemEventMonitor:
+    """
+    Netlink sockets that report network and power supply changes
+    """
+    def __init__(self):
+        self.sockets: List[socket.socket] = []
+        sources = [
+            ('network', socket.SOCK_RAW, NETLINK_ROUTE, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR),
+            ('power', socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT, UEVENT_KERNEL_GROUP),
+        ]
+        for description, sock_type, protocol, groups in sources:
+            try:
+                sock = socket.socket(socket.AF_NETLINK, sock_type, protocol)
+            except (AttributeError, OSError) as e:
+                print("Can't monitor {} changes: {!r}".format(description, e))
+                continue
+            try:
+                sock.bind((0, groups))
+            except OSError as e:
+                print("Can't monitor {} changes: {!r}".format(description, e))
+                sock.close()
+                continue
+            sock.setblocking(False)
+            self.sockets.append(sock)
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether both kinds of change are reported
+        """
+        return len(self.sockets) == 2
+
+    def read(self, sock: socket.socket) -> bool:
+        """
+        :return: Whether the prerequisites might have changed
+        """
+        relevant = False
+        while True:
+            try:
+                data = sock.recv(NETLINK_READ_SIZE)
+            except BlockingIOError:
+                return relevant
+            if sock.proto == NETLINK_KOBJECT_UEVENT:
+                # Every other device's uevents come through here too
+                relevant = relevant or b'SUBSYSTEM=power_supply' in data
+            else:
+                relevant = True
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+class ClientDaemon:
+    def __init__(
+            self,
+            config,
+            backup_paths: Mapping[str, BackupPath],
+            destinations: List[SessionPool],
+            pruner: Optional[PruneQueue],
+            executor: ThreadPoolExecutor,
+            catalog_cache_dir: Path,
+            settings: DaemonSettings,
+            notifier: Notifier,
+    ):
+        self.config = config
+        self.backup_paths = backup_paths
+        self.destinations = destinations
+        self.fanout_settings = FanoutSettings.from_config(config)
+        self.plan_settings = PlanSettings.from_config(config)
+        self.pruner = pruner
+        self.executor = executor
+        self.catalog_cache_dir = catalog_cache_dir
+        self.settings = settings
+        self.notifier = notifier
+
+        self.selector = selectors.DefaultSelector()
+        self.watcher: Optional[DirectoryWatcher] = None
+        if inotify_available:
+            try:
+                self.watcher = DirectoryWatcher()
+                self.selector.register(self.watcher, selectors.EVENT_READ, self._read_watcher)
+            except OSError as e:
+                print("Can't use inotify; polling snapshot directories instead:", repr(e))
+        self.monitor = SystemEventMonitor()
+        for sock in self.monitor.sockets:
+            self.selector.register(sock, selectors.EVENT_READ, self._read_monitor)
+
+        now = monotonic()
+        # Path name -> time of the last change that hasn't been backed up
+        # yet; everything is checked once at startup
+        self.dirty: Dict[str, float] = {name: now - settings.debounce for name in backup_paths}
+        self.mounted: List[BackupPath] = []
+        # For polling, when there's no inotify: path name -> directory mtime
+        self.mtimes: Dict[str, int] = {}
+        # Reason backups aren't allowed right now, if any
+        self.blocked: Optional[str] = None
+        self.next_check = now
+        self.next_rescan = now + settings.rescan_interval
+        self.next_poll = now + settings.poll_interval
+        self.next_keepalive = now
+
+    def _read_watcher(self, watcher: DirectoryWatcher):
+        now = monotonic()
+        for name in watcher.read():
+            if watcher.watching(name):
+                print('New snapshot(s) in', self.backup_paths[name].path)
+            else:
+                print('Stopped watching {}; it was removed or unmounted'.format(self.backup_paths[name].path))
+            self.dirty[name] = now
+
+    def _read_monitor(self, sock: socket.socket):
+        if self.monitor.read(sock):
+            self.next_check = min(self.next_check, monotonic() + PREREQUISITE_SETTLE_TIME)
+
+    def _check_prerequisites(self):
+        try:
+            check_should_backup(self.config)
+            blocked = None
+        except BackupPrerequisiteFailed as e:
+            blocked = e.args[0]
+        if blocked != self.blocked:
+            if blocked is None:
+                print('Backups allowed again')
+            else:
+                print('Not backing up, for reason:', blocked)
+                # Probably no way to reach the servers now anyway
+                for sessions in self.destinations:
+                    sessions.close_all()
+        self.blocked = blocked
+        self.next_check = float('inf')
+        if not self.monitor.complete:
+            self.next_check = monotonic() + self.settings.poll_interval
+
+    def _watch_paths(self):
+        """
+        Mount (if necessary) and watch every path that isn't watched yet
+        """
+        for name, bp in self.backup_paths.items():
+            if self.watcher is not None and self.watcher.watching(name):
+                continue
+            try:
+                if bp.automount:
+                    mount_path_if_necessary(bp.mount_path)
+                    if bp not in self.mounted:
+                        self.mounted.append(bp)
+                if self.watcher is not None:
+                    self.watcher.watch(name, bp.path)
+            except Exception as e:
+                print("Can't watch {}: {!r}".format(bp.path, e))
+
+    def _poll(self):
+        now = monotonic()
+        for name, bp in self.backup_paths.items():
+            try:
+                mtime = bp.path.stat().st_mtime_ns
+            except OSError:
+                continue
+            if name in self.mtimes and self.mtimes[name] != mtime:
+                self.dirty[name] = now
+            self.mtimes[name] = mtime
+        self.next_poll = now + self.settings.poll_interval
+
+    def _keepalive(self):
+        for sessions in self.destinations:
+            sessions.ping_all()
+            try:
+                sessions.warm()
+            except (OSError, ProtocolError) as e:
+                print("Can't connect to {}: {!r}".format(sessions.host, e))
+        self.next_keepalive = monotonic() + self.settings.keepalive_interval
+
+    def _backup(self, names: List[str]):
+        for name in names:
+            del self.dirty[name]
+        if self.pruner is not None:
+            self.pruner.retry_failed()
+        results = run_transfers(
+            [self.backup_paths[name] for name in names],
+            self.executor,
+            self.destinations,
+            self.fanout_settings,
+            self.pruner,
+            self.catalog_cache_dir,
+            self.mounted,
+            self.plan_settings,
+        )
+        failures = report_results(results, self.destinations)
+        if failures:
+            self.notifier.notify('Backup finished with {} failure(s)'.format(len(failures)))
+        elif results:
+            self.notifier.notify('Backup complete')
+
+    def run(self):
+        self._watch_paths()
+        while True:
+            now = monotonic()
+            if now >= self.next_check:
+                self._check_prerequisites()
+            if now >= self.next_rescan:
+                self._watch_paths()
+                for name in self.backup_paths:
+                    self.dirty.setdefault(name, now - self.settings.debounce)
+                self.next_rescan = now + self.settings.rescan_interval
+            if self.watcher is None and now >= self.next_poll:
+                self._poll()
+
+            deadlines = [self.next_check, self.next_rescan]
+            if self.watcher is None:
+                deadlines.append(self.next_poll)
+            if self.blocked is None:
+                due = [name for name, changed in self.dirty.items() if now >= changed + self.settings.debounce]
+                if due:
+                    self._backup(due)
+                    # That took a while, and new snapshots may be waiting
+                    continue
+                deadlines.extend(changed + self.settings.debounce for changed in self.dirty.values())
+                if self.settings.keepalive_interval:
+                    if now >= self.next_keepalive:
+                        self._keepalive()
+                    deadlines.append(self.next_keepalive)
+
+            timeout = max(0.0, min(deadlines) - monotonic())
+            for key, _ in self.selector.select(timeout):
+                key.data(key.fileobj)
+
+    def close(self):
+        self.selector.close()
+        if self.watcher is not None:
+            self.watcher.close()
+        self.monitor.close()
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+def run_daemon(profile: Optional[str] = None):
+    """
+    :param profile: From --profile; see tracing.py
+    """
+    config, backup_paths, key_paths = parse_config()
+    settings = DaemonSettings.from_config(config)
+    status_board.configure(config)
+    buffer_pool.configure(config)
+    tracer.configure(config, 'client', profile)
+    notifier = Notifier()
+
+    destinations = make_destinations(config, key_paths)
+    max_concurrent_transfers = config['server'].getint(
+        'max concurrent transfers',
+        DEFAULT_MAX_CONCURRENT_TRANSFERS,
+    )
+    pruner = start_prune_queue(config)
+    signal.signal(signal.SIGTERM, _terminate)
+
+    daemon = None
+    with tracer.profiling():
+        try:
+            with ThreadPoolExecutor(max_workers=max_concurrent_transfers) as executor:
+                daemon = ClientDaemon(
+                    config,
+                    backup_paths,
+                    destinations,
+                    pruner,
+                    executor,
+                    get_catalog_cache_dir(config),
+                    settings,
+                    notifier,
+                )
+                try:
+                    daemon.run()
+                finally:
+                    daemon.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for sessions in destinations:
+                sessions.close_all()
+            if pruner is not None:
+                pruner.close()
+            if daemon is not None:
+                for bp in daemon.mounted:
+                    umount_path(bp.mount_path)
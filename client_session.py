@@ -0,0 +1,585 @@
+from functools import partial
+from pathlib import Path
+import socket
+import ssl
+from threading import Lock, local
+from time import monotonic
+from typing import List, Mapping, Optional
+
+from btrfs_incremental_send import (
+    CONTROL_PORT,
+    Subvolume,
+    bulk_copy,
+    deserialize_json,
+    send_snapshot,
+    serialize_json,
+)
+from compression import CompressionSettings
+from copy_engine import enable_ktls
+from protocol import (
+    PROTOCOL_MULTIPLEXED,
+    PROTOCOL_STRIPE,
+    PROTOCOL_TWO_PORT,
+    SUPPORTED_PROTOCOLS,
+    ProtocolError,
+    recv_line,
+    recv_message,
+    send_end,
+    send_message,
+    send_stream,
+)
+from dedup import DedupSender
+from digest import DIGEST_AUTO, StreamDigest, check_stream_digest, digesting_copy, offered_digests
+from link_tuning import LinkSettings, LinkTuner
+from meter import TransferMeter, status_board
+from resume import STREAM_DIGEST_ALGORITHM, resumable_copy
+from striping import DEFAULT_MAX_STRIPES, STRIPES_AUTO, StripedSender, parse_stripes
+from tls import HandshakeStats, ReloadingContext, timed_handshake
+from tracing import current_transfer_id, format_address, tracer
+
+DEFAULT_RESUME_ATTEMPTS = 3
+DEFAULT_RESUME_DELAY = 30
+
+def make_client_context(key_paths: Mapping[str, Path]) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = False
+    context.load_verify_locations(str(key_paths['ca_cert']))
+    context.load_cert_chain(
+        str(key_paths['client_cert']),
+        keyfile=str(key_paths['client_key']),
+    )
+    enable_ktls(context)
+    return context
+
+def make_client_contexts(key_paths: Mapping[str, Path]) -> ReloadingContext:
+    """
+    :return: Client context that is rebuilt when the key files change
+    """
+    return ReloadingContext(
+        partial(make_client_context, key_paths),
+        [key_paths[k] for k in ['ca_cert', 'client_cert', 'client_key']],
+    )
+
+def print_compression_summary(summary: dict):
+    print(
+        'Compression: {codec}, {raw_bytes} -> {wire_bytes} bytes (ratio {ratio}), '
+        '{compress_mb_per_second} MB/s, final level {final_level} '
+        'after {level_changes} change(s)'.format(
+            **{
+                key: round(value, 3) if isinstance(value, float) else value
+                for key, value in summary.items()
+            }
+        )
+    )
+
+class TransferOptions:
+    __slots__ = [
+        'compression',
+        'resumable',
+        'resume_attempts',
+        'resume_delay',
+        'use_pv',
+        'stripes',
+        'max_stripes',
+        'use_inventory',
+        'dedup',
+        'digests',
+        'require_digest',
+        'link',
+    ]
+
+    def __init__(
+            self,
+            compression: Optional[CompressionSettings] = None,
+            resumable: bool = False,
+            resume_attempts: int = DEFAULT_RESUME_ATTEMPTS,
+            resume_delay: float = DEFAULT_RESUME_DELAY,
+            use_pv: bool = False,
+            stripes: int = 1,
+            max_stripes: int = DEFAULT_MAX_STRIPES,
+            use_inventory: bool = True,
+            dedup: bool = False,
+            digests: Optional[List[str]] = None,
+            require_digest: bool = False,
+            link: Optional[LinkSettings] = None,
+    ):
+        self.compression = compression or CompressionSettings([])
+        # Ask the server to spool the stream so that an interrupted
+        # transfer can pick up where it left off
+        self.resumable = resumable
+        # How many times to connect for one transfer, and seconds to wait
+        # between attempts
+        self.resume_attempts = resume_attempts
+        self.resume_delay = resume_delay
+        # Pipe streams through `pv` as well as metering them ourselves
+        self.use_pv = use_pv
+        # Connections to spread each stream over (1 means just the control
+        # connection), or STRIPES_AUTO to tune it, up to `max_stripes`
+        self.stripes = stripes
+        self.max_stripes = max_stripes
+        # Ask the server what it already has before each transfer, to pick
+        # the parent and skip snapshots it holds
+        self.use_inventory = use_inventory
+        # Send content-defined chunk digests first, and only the chunks the
+        # server doesn't already have
+        self.dedup = dedup
+        # Stream digest algorithms to offer the server, most preferred first;
+        # see digest.py
+        self.digests = offered_digests(DIGEST_AUTO) if digests is None else digests
+        # Only delete old snapshots after a transfer whose digest the server
+        # confirmed; otherwise (two-port protocol, or an older server) the
+        # .keep file still moves, but old snapshots stay
+        self.require_digest = require_digest
+        # Socket options and chunk size; see link_tuning.py
+        self.link = link or LinkSettings()
+
+    @classmethod
+    def from_config(cls, section, network=None) -> 'TransferOptions':
+        """
+        :param section: The client's [server] config section
+        :param network: The client's [network] config section, if any
+        """
+        return cls(
+            CompressionSettings.from_config(section),
+            section.getboolean('resumable', False),
+            section.getint('resume attempts', DEFAULT_RESUME_ATTEMPTS),
+            section.getfloat('resume delay', DEFAULT_RESUME_DELAY),
+            section.getboolean('use pv', False),
+            parse_stripes(section.get('stripes', '1')),
+            section.getint('max stripes', DEFAULT_MAX_STRIPES),
+            section.getboolean('use server inventory', True),
+            section.getboolean('deduplicate', False),
+            offered_digests(section.get('stream digest', DIGEST_AUTO)),
+            section.getboolean('require stream digest', False),
+            LinkSettings.from_config(section, network),
+        )
+
+class ClientSession:
+    """
+    One control connection to the server. With the multiplexed protocol, any
+    number of snapshots can be sent over it one after another; with the
+    two-port fallback, the server closes the session after one transfer.
+    """
+    def __init__(
+            self,
+            host: str,
+            context: ssl.SSLContext,
+            options: Optional[TransferOptions] = None,
+            port: int = CONTROL_PORT,
+            tls_session: Optional[ssl.SSLSession] = None,
+            handshake_stats: Optional[HandshakeStats] = None,
+            bandwidth: Optional[float] = None,
+    ):
+        """
+        :param bandwidth: Throughput of an earlier session to the same
+        server, for link tuning
+        """
+        self.host = host
+        self.port = port
+        self.context = context
+        self.options = options or TransferOptions()
+        # From an earlier connection made with the same context; lets the
+        # server skip the full handshake
+        self.tls_session = tls_session
+        self.handshake_stats = handshake_stats or HandshakeStats()
+        self.conn = None
+        self.protocol = None
+        # The server's answer to our hello line
+        self.welcome = None
+        self.tuner = LinkTuner(self.options.link, sending=True, bandwidth=bandwidth)
+
+    @property
+    def usable(self) -> bool:
+        return self.conn is not None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Sessions can sit idle for a long time in daemon mode
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.conn = self._wrap(sock)
+        try:
+            print('Connecting to server', self.host, 'port', self.port)
+            with tracer.span('connect', destination=self.host) as span:
+                self.conn.connect((self.host, self.port))
+                span['local'] = format_address(self.conn.getsockname())
+            timed_handshake(self.conn, self.handshake_stats)
+            self.tls_session = self.conn.session
+            # Servers that predate the multiplexed protocol never read this
+            hello = {
+                'protocols': SUPPORTED_PROTOCOLS,
+                'compression': self.options.compression.codecs,
+                'compression_level': self.options.compression.level,
+                'digests': self.options.digests,
+                # We understand 'queued' replies to 'send'
+                'queue_position': True,
+            }
+            started = monotonic()
+            self.conn.sendall(serialize_json(hello))
+            self.welcome = deserialize_json(recv_line(self.conn))
+            # Stands in for the RTT if the kernel can't tell us
+            self.tuner.start(self.conn, monotonic() - started)
+        except BaseException:
+            self.close()
+            raise
+        # Old servers don't say which protocol they're using, but they always
+        # send the data port
+        self.protocol = self.welcome.get('protocol', PROTOCOL_TWO_PORT)
+        print('Negotiated protocol:', self.protocol)
+
+    def _wrap(self, sock: socket.socket) -> ssl.SSLSocket:
+        return self.context.wrap_socket(
+            sock,
+            do_handshake_on_connect=False,
+            session=self.tls_session,
+        )
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def inventory(self) -> Optional[dict]:
+        """
+        :return: The server's reply to an 'inventory' message (see
+        inventory.SnapshotInventory), or None if it can't answer one
+        """
+        if self.protocol != PROTOCOL_MULTIPLEXED or not self.welcome['success']:
+            return None
+        send_message(self.conn, {'type': 'inventory'})
+        reply = recv_message(self.conn)
+        # Servers that predate this answer 'unknown_message_type'
+        if reply.get('type') != 'inventory' or not reply['success']:
+            return None
+        return reply
+
+    def ping(self):
+        """
+        Round trip over an idle session, so that neither the server nor
+        anything in between drops it. Servers that predate 'ping' answer
+        'unknown_message_type', which does just as well.
+        """
+        if self.protocol != PROTOCOL_MULTIPLEXED:
+            return
+        send_message(self.conn, {'type': 'ping'})
+        recv_message(self.conn)
+
+    def transfer(self, snapshot: Subvolume, send=send_snapshot, label: Optional[str] = None) -> dict:
+        """
+        Send one snapshot.
+
+        :param send: Runs `btrfs send` and copies the stream; see
+        `send_snapshot`, and fanout.FanoutBranch.send for sharing one stream
+        between destinations
+        :param label: Name of the transfer in status reports; defaults to
+        the snapshot's
+        :return: The server's last message about this transfer, which has a
+        'success' key in all cases
+        """
+        if not self.welcome['success']:
+            # e.g. our certificate's CN isn't configured on the server. Nothing
+            # else will work on this session.
+            response = self.welcome
+            self.close()
+            return response
+        meter = status_board.start(label or snapshot.newest, 'send')
+        try:
+            if self.protocol == PROTOCOL_MULTIPLEXED:
+                return self._transfer_multiplexed(snapshot, meter, send)
+            return self._transfer_two_port(snapshot, meter, send)
+        finally:
+            meter.finish()
+
+    def _open_stripe(self, token: str) -> ssl.SSLSocket:
+        conn = self._wrap(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        try:
+            conn.connect((self.host, self.port))
+            timed_handshake(conn, self.handshake_stats)
+            conn.sendall(serialize_json({'protocols': [PROTOCOL_STRIPE], 'stripe': token}))
+            welcome = deserialize_json(recv_line(conn))
+        except BaseException:
+            conn.close()
+            raise
+        if not welcome['success']:
+            conn.close()
+            raise ProtocolError('Server refused stripe: {}'.format(welcome.get('reason')))
+        return conn
+
+    def _transfer_multiplexed(self, snapshot: Subvolume, meter: TransferMeter, send=send_snapshot) -> dict:
+        message = {
+            'type': 'send',
+            'snapshot': snapshot.newest,
+            'parent': snapshot.parent,
+            'resumable': self.options.resumable,
+        }
+        max_stripes = min(self.options.max_stripes, self.welcome.get('max_stripes', 1))
+        if self.options.stripes != 1 and max_stripes > 1:
+            message['stripes'] = max_stripes if self.options.stripes == STRIPES_AUTO else self.options.stripes
+        if self.options.dedup and self.welcome.get('dedup'):
+            message['dedup'] = True
+        if current_transfer_id() is not None:
+            # Tags the server's spans for this transfer too
+            message['transfer_id'] = current_transfer_id()
+        with tracer.span('admission', destination=self.host) as span:
+            send_message(self.conn, message)
+            reply = recv_message(self.conn)
+            while reply.get('type') == 'queued':
+                span['queued'] = True
+                if 'device' in reply:
+                    print('Server busy; queued at position {} for {}'.format(reply['position'], reply['device']))
+                else:
+                    print('Server busy; queued at position', reply['position'])
+                reply = recv_message(self.conn)
+        if not reply['success']:
+            return reply
+        # Measure the RTT again; the bandwidth is the previous transfer's
+        self.tuner.start(self.conn)
+        print('Link tuning:', self.tuner.format())
+        meter.on_first_rate = partial(self.tuner.early_rate, self.conn)
+        compressor = None
+        codec = self.welcome.get('compression')
+        if codec is not None:
+            compressor = self.options.compression.make_compressor(codec)
+        copy = partial(send_stream, compressor=compressor, meter=meter, frame_size=self.tuner.chunk_size)
+        # What we compare the server's digest of the stream with
+        digest = None
+        striped = None
+        deduplicated = None
+        if reply.get('dedup'):
+            deduplicated = DedupSender(compressor, meter)
+            copy = deduplicated.copy
+        elif reply.get('stripe_token'):
+            striped = StripedSender(
+                partial(self._open_stripe, reply['stripe_token']),
+                self.options.stripes,
+                reply['stripes'],
+                compressor,
+                meter,
+            )
+            copy = striped.copy
+        if reply.get('resumable'):
+            # The digest of the spool covers the whole stream, including the
+            # part that was sent before the transfer was interrupted
+            digest = StreamDigest(STREAM_DIGEST_ALGORITHM)
+            copy = partial(resumable_copy, offset=reply['offset'], hasher=digest, copy=copy)
+        elif self.welcome.get('digest'):
+            digest = StreamDigest(self.welcome['digest'])
+            copy = partial(digesting_copy, digest=digest, copy=copy)
+        print('Sending data')
+        with tracer.span('copy', destination=self.host) as span:
+            started = monotonic()
+            copy_result, return_code = send(
+                self.conn,
+                snapshot,
+                copy=copy,
+                use_pv=self.options.use_pv,
+            )
+            span['bytes'] = copy_result.bytes_copied
+            span['strategy'] = copy_result.strategy
+            span['send_return_code'] = return_code
+            if meter.first_byte is not None:
+                span['send_startup_seconds'] = meter.first_byte - started
+            span['link'] = self.tuner.describe()
+            self.tuner.record_throughput(copy_result.bytes_copied, monotonic() - started)
+        end_summary = {
+            'bytes_sent': copy_result.bytes_copied,
+            'send_return_code': return_code,
+        }
+        if digest is not None:
+            end_summary['stream_digest'] = digest.hexdigest()
+        if striped is not None:
+            end_summary['chunks'] = striped.chunks
+            end_summary['stripes'] = striped.stripes
+        if deduplicated is not None:
+            end_summary['dedup'] = deduplicated.summary()
+            print(
+                'Deduplication: sent {chunks_sent} of {chunks} chunks ({bytes_sent} bytes)'.format(
+                    **end_summary['dedup']
+                )
+            )
+        if compressor is not None:
+            end_summary['compression'] = compressor.summary()
+            print_compression_summary(end_summary['compression'])
+        with tracer.span('result_wait', destination=self.host):
+            send_end(self.conn, end_summary)
+            result = recv_message(self.conn)
+        if result.get('session_closed'):
+            # The stream couldn't be resynchronized, e.g. `btrfs receive`
+            # died partway through
+            self.close()
+        check_stream_digest(result, digest)
+        # For the planner's transfer history
+        result['stream_bytes'] = copy_result.bytes_copied
+        return result
+
+    def _transfer_two_port(self, snapshot: Subvolume, meter: TransferMeter, send=send_snapshot) -> dict:
+        new_port = self.welcome['new_port']
+        print('New port:', new_port)
+        conn_data = self._wrap(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        try:
+            print('Connecting to new port')
+            with tracer.span('connect', destination=self.host, port=new_port):
+                conn_data.connect((self.host, new_port))
+            timed_handshake(conn_data, self.handshake_stats)
+            tuner = LinkTuner(self.options.link, sending=True, bandwidth=self.tuner.measured)
+            tuner.start(conn_data)
+            print('Link tuning:', tuner.format())
+            meter.on_first_rate = partial(tuner.early_rate, conn_data)
+            print('Sending data')
+            with tracer.span('copy', destination=self.host) as span:
+                started = monotonic()
+                copy_result, return_code = send(
+                    conn_data,
+                    snapshot,
+                    copy=partial(bulk_copy, buffer_size=tuner.chunk_size, meter=meter),
+                    use_pv=self.options.use_pv,
+                )
+                span['bytes'] = copy_result.bytes_copied
+                span['send_return_code'] = return_code
+                if meter.first_byte is not None:
+                    span['send_startup_seconds'] = meter.first_byte - started
+                span['link'] = tuner.describe()
+                self.tuner.record_throughput(copy_result.bytes_copied, monotonic() - started)
+        finally:
+            conn_data.close()
+
+        try:
+            with tracer.span('result_wait', destination=self.host):
+                result = deserialize_json(recv_line(self.conn))
+        finally:
+            # The server handles exactly one transfer per session in this mode
+            self.close()
+        if result.get('success') and self.options.digests:
+            # Nothing to check `btrfs receive`'s word against in this mode
+            print('No stream digest with the two-port protocol; can\'t verify the stream')
+            result['digest_unverified'] = True
+        return result
+
+class SessionPool:
+    """
+    Hands each worker thread its own session, reconnecting whenever the
+    previous one can't be reused. New connections resume the TLS session of
+    the most recent one.
+    """
+    def __init__(
+            self,
+            host: str,
+            contexts: ReloadingContext,
+            options: Optional[TransferOptions] = None,
+            port: int = CONTROL_PORT,
+            name: Optional[str] = None,
+    ):
+        self.host = host
+        self.port = port
+        # Destination name, from a [server/NAME] section; None for [server]
+        self.name = name
+        self.contexts = contexts
+        self.options = options or TransferOptions()
+        self.local = local()
+        self.lock = Lock()
+        self.sessions: List[ClientSession] = []
+        # Connected by `warm` or given back to `release`, and not in use
+        self.idle: List[ClientSession] = []
+        self.handshake_stats = HandshakeStats()
+        # The context that `tls_session` belongs to; a session can't be
+        # resumed with any other
+        self.tls_context = None
+        self.tls_session = None
+
+    def _connect(self) -> ClientSession:
+        context = self.contexts.get()
+        with self.lock:
+            tls_session = self.tls_session if context is self.tls_context else None
+            # The most recent measurement of the link to this server
+            bandwidth = next(
+                (s.tuner.measured for s in reversed(self.sessions) if s.tuner.measured),
+                None,
+            )
+        session = ClientSession(
+            self.host,
+            context,
+            self.options,
+            self.port,
+            tls_session=tls_session,
+            handshake_stats=self.handshake_stats,
+            bandwidth=bandwidth,
+        )
+        session.connect()
+        with self.lock:
+            self.tls_context = context
+            self.tls_session = session.tls_session
+            self.sessions = [s for s in self.sessions if s.usable]
+            self.sessions.append(session)
+        return session
+
+    def get(self) -> ClientSession:
+        session: Optional[ClientSession] = getattr(self.local, 'session', None)
+        if session is None or not session.usable:
+            session = self.acquire()
+            self.local.session = session
+        return session
+
+    def acquire(self) -> ClientSession:
+        """
+        Check out a session for a thread that won't be around to reuse it
+        through `get`. Hand it back with `release` if it's still usable.
+        """
+        with self.lock:
+            while self.idle:
+                session = self.idle.pop()
+                if session.usable:
+                    return session
+        return self._connect()
+
+    def release(self, session: ClientSession):
+        if session.usable:
+            with self.lock:
+                self.idle.append(session)
+
+    def warm(self):
+        """
+        Make sure at least one connected session is waiting, so that the next
+        transfer doesn't have to wait for a handshake. It's handed to
+        whichever thread calls `get` first.
+        """
+        with self.lock:
+            if any(session.usable for session in self.sessions):
+                return
+        session = self._connect()
+        if session.protocol != PROTOCOL_MULTIPLEXED or not session.welcome['success']:
+            # Can't be kept open between transfers
+            session.close()
+            return
+        with self.lock:
+            self.idle.append(session)
+
+    def ping_all(self):
+        """
+        Send a 'ping' over every open session, closing the ones that don't
+        answer. Only for when no transfers are running.
+        """
+        with self.lock:
+            sessions = [session for session in self.sessions if session.usable]
+        for session in sessions:
+            try:
+                session.ping()
+            except (OSError, ProtocolError) as e:
+                print('Session to {} is gone: {!r}'.format(self.host, e))
+                session.close()
+
+    def discard(self):
+        """
+        Drop the current thread's session, e.g. after an error that leaves
+        the stream in an unknown state.
+        """
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            session.close()
+            self.local.session = None
+
+    def close_all(self):
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions.clear()
+            self.idle.clear()
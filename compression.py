@@ -0,0 +1,315 @@
+"""
+Block compression for send streams.
+
+Each DATA block of the stream is compressed independently and sent in its own
+frame along with the codec that was used, so the sender can change level or
+stop compressing at any point without telling the receiver. `zstd` and `lz4`
+need the `zstandard` and `lz4` packages; `zlib` is always available but is
+much slower, so it's only offered if configured explicitly.
+
+Codecs are shared by every thread, so they don't keep compression state
+between blocks; zstd's compressor and decompressor objects, which can't be
+used by two threads at once, are kept per thread. Decompression never
+produces more than the caller's `max_size`, so a small malicious frame
+can't expand into an arbitrary amount of memory.
+"""
+from threading import local
+from time import perf_counter
+from typing import Dict, List, Optional
+import zlib
+
+zstandard_available = False
+lz4_available = False
+
+try:
+    import zstandard
+    zstandard_available = True
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    lz4_available = True
+except ImportError:
+    pass
+
+COMPRESSION_NONE = 'none'
+
+# Check the compression/send balance this often, in blocks
+ADAPT_INTERVAL = 16
+# After turning compression off, try it again after this many blocks in case
+# the data or the link changed
+PROBE_INTERVAL = 256
+# Compressed/raw size ratio above which compression isn't worth the CPU
+INCOMPRESSIBLE_RATIO = 0.95
+
+class DecompressionError(Exception):
+    """
+    A block that doesn't decompress, or would decompress to more than allowed
+    """
+
+class Codec:
+    __slots__ = ['name', 'codec_id', 'min_level', 'max_level', 'default_level']
+
+    def __init__(self, name: str, codec_id: int, min_level: int, max_level: int, default_level: int):
+        self.name = name
+        # Sent in every compressed frame
+        self.codec_id = codec_id
+        self.min_level = min_level
+        self.max_level = max_level
+        self.default_level = default_level
+
+    def clamp_level(self, level: int) -> int:
+        return max(self.min_level, min(self.max_level, level))
+
+    def compress(self, data, level: int) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data, max_size: int) -> bytes:
+        """
+        :raise DecompressionError: If `data` is corrupt, or more than
+        `max_size` bytes once decompressed
+        """
+        raise NotImplementedError
+
+class ZstdCodec(Codec):
+    __slots__ = ['local']
+
+    def __init__(self):
+        super().__init__('zstd', 1, 1, 19, 3)
+        # Compressors (by level) and a decompressor for each thread
+        self.local = local()
+
+    def compress(self, data, level: int) -> bytes:
+        compressors = getattr(self.local, 'compressors', None)
+        if compressors is None:
+            compressors = self.local.compressors = {}
+        compressor = compressors.get(level)
+        if compressor is None:
+            compressor = compressors[level] = zstandard.ZstdCompressor(level=level)
+        return compressor.compress(data)
+
+    def decompress(self, data, max_size: int) -> bytes:
+        decompressor = getattr(self.local, 'decompressor', None)
+        if decompressor is None:
+            decompressor = self.local.decompressor = zstandard.ZstdDecompressor()
+        try:
+            # max_output_size only applies to frames that don't say how big
+            # they are; those that do get a buffer that size
+            if zstandard.frame_content_size(data) > max_size:
+                raise DecompressionError('Block larger than {} bytes'.format(max_size))
+            return decompressor.decompress(data, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise DecompressionError(str(e)) from e
+
+class Lz4Codec(Codec):
+    __slots__ = []
+
+    def __init__(self):
+        super().__init__('lz4', 2, 0, 16, 0)
+
+    def compress(self, data, level: int) -> bytes:
+        return lz4.frame.compress(data, compression_level=level)
+
+    def decompress(self, data, max_size: int) -> bytes:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            block = decompressor.decompress(data, max_length=max_size)
+        except RuntimeError as e:
+            raise DecompressionError(str(e)) from e
+        if not decompressor.eof or decompressor.unused_data:
+            raise DecompressionError('Block truncated or larger than {} bytes'.format(max_size))
+        return block
+
+class ZlibCodec(Codec):
+    __slots__ = []
+
+    def __init__(self):
+        super().__init__('zlib', 3, 1, 9, 1)
+
+    def compress(self, data, level: int) -> bytes:
+        return zlib.compress(data, level)
+
+    def decompress(self, data, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            block = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise DecompressionError(str(e)) from e
+        if not decompressor.eof or decompressor.unconsumed_tail or decompressor.unused_data:
+            raise DecompressionError('Block truncated or larger than {} bytes'.format(max_size))
+        return block
+
+def _available_codecs() -> List[Codec]:
+    codecs = []
+    if zstandard_available:
+        codecs.append(ZstdCodec())
+    if lz4_available:
+        codecs.append(Lz4Codec())
+    codecs.append(ZlibCodec())
+    return codecs
+
+# In order of preference when the client asks for 'auto'
+CODECS: List[Codec] = _available_codecs()
+CODECS_BY_NAME: Dict[str, Codec] = {codec.name: codec for codec in CODECS}
+CODECS_BY_ID: Dict[int, Codec] = {codec.codec_id: codec for codec in CODECS}
+
+def offered_codecs(configured: str) -> List[str]:
+    """
+    :param configured: Codec name from the config file, 'auto' or 'none'
+    :return: Codec names to offer the server, most preferred first
+    """
+    if configured == COMPRESSION_NONE:
+        return []
+    if configured == 'auto':
+        # zlib can't keep up with a fast link, so don't pick it unasked
+        return [codec.name for codec in CODECS if codec.name != 'zlib']
+    if configured not in CODECS_BY_NAME:
+        print("Compression codec '{}' not available; sending uncompressed".format(configured))
+        return []
+    return [configured]
+
+def choose_codec(offered: List[str]) -> Optional[str]:
+    for name in offered:
+        if name in CODECS_BY_NAME:
+            return name
+    return None
+
+class AdaptiveCompressor:
+    """
+    Compresses stream blocks while watching whether the CPU or the network
+    is the bottleneck. If compressing a window of blocks took longer than
+    sending them, the level goes down (and eventually compression turns
+    off); if sending took much longer, the level goes back up towards the
+    configured one.
+    """
+    def __init__(self, codec: Codec, level: int, adaptive: bool = True):
+        self.codec = codec
+        self.level = codec.clamp_level(level)
+        self.max_level = self.level
+        self.adaptive = adaptive
+        self.enabled = True
+        self.blocks_until_probe = 0
+
+        # Totals for the whole stream
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compress_seconds = 0.0
+        self.level_changes = 0
+
+        # Current adaptation window
+        self.window_blocks = 0
+        self.window_raw = 0
+        self.window_compressed = 0
+        self.window_compress_seconds = 0.0
+        self.window_send_seconds = 0.0
+
+    def compress(self, block) -> Optional[bytes]:
+        """
+        :return: Compressed block, or None if it should be sent as-is
+        """
+        size = len(block)
+        self.raw_bytes += size
+        if not self.enabled:
+            self.wire_bytes += size
+            self.blocks_until_probe -= 1
+            if self.blocks_until_probe <= 0:
+                self.enabled = True
+            return None
+
+        start = perf_counter()
+        compressed = self.codec.compress(block, self.level)
+        elapsed = perf_counter() - start
+        self.compress_seconds += elapsed
+        self.window_compress_seconds += elapsed
+        self.window_raw += size
+        self.window_compressed += len(compressed)
+
+        if len(compressed) >= size:
+            self.wire_bytes += size
+            return None
+        self.wire_bytes += len(compressed)
+        return compressed
+
+    def record_send(self, seconds: float):
+        """
+        Called after each block has been handed to the socket, with the time
+        that took. Blocking in sendall means the network is the bottleneck.
+        """
+        self.window_send_seconds += seconds
+        self.window_blocks += 1
+        if self.window_blocks >= ADAPT_INTERVAL:
+            if self.adaptive:
+                self._adapt()
+            self.window_blocks = 0
+            self.window_raw = 0
+            self.window_compressed = 0
+            self.window_compress_seconds = 0.0
+            self.window_send_seconds = 0.0
+
+    def _disable(self):
+        self.enabled = False
+        self.blocks_until_probe = PROBE_INTERVAL
+        self.level_changes += 1
+
+    def _adapt(self):
+        if not self.enabled or not self.window_raw:
+            return
+        if self.window_compressed / self.window_raw > INCOMPRESSIBLE_RATIO:
+            self._disable()
+        elif self.window_compress_seconds > self.window_send_seconds:
+            # CPU-bound
+            if self.level > self.codec.min_level:
+                self.level -= 1
+                self.level_changes += 1
+            else:
+                self._disable()
+        elif self.window_send_seconds > 2 * self.window_compress_seconds:
+            # Network-bound; spend more CPU to send less
+            if self.level < self.max_level:
+                self.level += 1
+                self.level_changes += 1
+
+    def summary(self) -> dict:
+        return {
+            'codec': self.codec.name,
+            'final_level': self.level if self.enabled else None,
+            'level_changes': self.level_changes,
+            'raw_bytes': self.raw_bytes,
+            'wire_bytes': self.wire_bytes,
+            'ratio': self.wire_bytes / self.raw_bytes if self.raw_bytes else None,
+            'compress_seconds': self.compress_seconds,
+            'compress_mb_per_second': (
+                self.raw_bytes / self.compress_seconds / 1e6
+                if self.compress_seconds else None
+            ),
+        }
+
+class CompressionSettings:
+    __slots__ = ['codecs', 'level', 'adaptive']
+
+    def __init__(self, codecs: List[str], level: Optional[int] = None, adaptive: bool = True):
+        # Offered to the server, most preferred first
+        self.codecs = codecs
+        # None means the codec's default
+        self.level = level
+        self.adaptive = adaptive
+
+    @classmethod
+    def from_config(cls, section) -> 'CompressionSettings':
+        """
+        :param section: The client's [server] config section
+        """
+        level = None
+        if 'compression level' in section:
+            level = section.getint('compression level')
+        return cls(
+            offered_codecs(section.get('compression', COMPRESSION_NONE)),
+            level,
+            section.getboolean('adaptive compression', True),
+        )
+
+    def make_compressor(self, codec_name: str) -> AdaptiveCompressor:
+        codec = CODECS_BY_NAME[codec_name]
+        level = codec.default_level if self.level is None else self.level
+        return AdaptiveCompressor(codec, level, self.adaptive)
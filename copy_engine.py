@@ -0,0 +1,292 @@
+"""
+Copy engine for moving `btrfs send` streams between pipes, files and sockets.
+
+When both ends of a copy are plain file descriptors and one of them is a pipe,
+the kernel can move the data itself with splice(2); a regular file can be
+pushed into a socket with sendfile(2). For TLS connections this is only
+possible if the kernel is doing the encryption (kTLS). Python only lets us ask
+for that (ssl.OP_ENABLE_KTLS, Python 3.12+ built against OpenSSL 3), and
+OpenSSL quietly carries on in user space if the kernel's `tls` module or the
+negotiated cipher don't allow it, so each socket is asked the kernel directly
+whether it has TLS keys installed for that direction.
+
+Everything else, including TLS without kTLS, falls back to a `readinto` loop
+over a single buffer leased from buffer_pool.py and reused for the whole
+copy; no buffer is allocated per read, only a memoryview slice when a read or
+write is short.
+"""
+from errno import EINVAL, EIO, ENOSYS, EOPNOTSUPP
+import io
+import os
+import select
+import socket
+import ssl
+import stat
+import struct
+from typing import Optional
+
+from buffer_pool import buffer_pool
+
+# 16 MB seems okay
+BUFFER_SIZE = 1 << 24
+# Pipes only hold 64 KiB by default, so there's no point in asking
+# splice(2) for much more than this at a time
+SPLICE_CHUNK_SIZE = 1 << 20
+
+COPY_STRATEGY_SPLICE = 'splice'
+COPY_STRATEGY_SENDFILE = 'sendfile'
+COPY_STRATEGY_READINTO = 'readinto'
+
+# Errors from splice(2)/sendfile(2) that mean "not for this kind of file
+# descriptor" rather than a real I/O failure. kTLS sockets also return EIO
+# when the next record isn't application data (e.g. a TLS alert), which
+# OpenSSL has to handle in user space.
+KERNEL_COPY_FALLBACK_ERRNOS = frozenset({EINVAL, EIO, ENOSYS, EOPNOTSUPP})
+
+# From linux/tls.h. getsockopt(SOL_TLS, TLS_TX/TLS_RX) with room for just
+# the version and cipher fails unless the kernel has keys for that direction.
+SOL_TLS = getattr(socket, 'SOL_TLS', 282)
+TLS_TX = 1
+TLS_RX = 2
+TLS_CRYPTO_INFO = struct.Struct('=HH')
+
+splice_available = hasattr(os, 'splice')
+sendfile_available = hasattr(os, 'sendfile')
+ktls_available = hasattr(ssl, 'OP_ENABLE_KTLS')
+
+class CopyResult:
+    __slots__ = ['strategy', 'bytes_copied']
+
+    def __init__(self, strategy: str, bytes_copied: int):
+        # Which code path moved the data. If a kernel copy had to give up
+        # partway through, this is e.g. 'splice+readinto'
+        self.strategy = strategy
+        self.bytes_copied = bytes_copied
+
+    def __repr__(self):
+        return 'CopyResult(strategy={!r}, bytes_copied={})'.format(
+            self.strategy,
+            self.bytes_copied,
+        )
+
+def enable_ktls(context: ssl.SSLContext):
+    """
+    Ask OpenSSL to hand symmetric encryption over to the kernel after the
+    handshake, if this Python supports it (3.12+). OpenSSL silently stays
+    in user space if the kernel or negotiated cipher can't do kTLS, so this
+    is always safe to call, and `uses_ktls` tells whether it worked.
+    """
+    if ktls_available:
+        context.options |= ssl.OP_ENABLE_KTLS
+
+def uses_ktls(conn: ssl.SSLSocket, for_writing: bool) -> bool:
+    """
+    :return: Whether the kernel encrypts what's sent on `conn` (or decrypts
+    what's received, if not `for_writing`)
+    """
+    if not ktls_available:
+        return False
+    try:
+        conn.getsockopt(SOL_TLS, TLS_TX if for_writing else TLS_RX, TLS_CRYPTO_INFO.size)
+    except OSError:
+        # ENOPROTOOPT without the `tls` ULP, EBUSY without keys
+        return False
+    return True
+
+def _kernel_fd(obj, for_writing: bool) -> Optional[int]:
+    """
+    :return: A file descriptor that the kernel can copy to/from directly
+    on behalf of `obj`, or None if data has to pass through user space
+    """
+    if isinstance(obj, ssl.SSLSocket):
+        if not uses_ktls(obj, for_writing):
+            return None
+        # Anything OpenSSL has already decrypted into its own buffer would
+        # be skipped by a kernel copy
+        if not for_writing and obj.pending():
+            return None
+        return obj.fileno()
+    if isinstance(obj, socket.socket):
+        return obj.fileno()
+    # Only unbuffered file objects: a BufferedReader may be holding data
+    # that a kernel copy would skip
+    if isinstance(obj, io.FileIO):
+        return obj.fileno()
+    return None
+
+def _choose_kernel_strategy(read_fd: int, write_fd: int) -> Optional[str]:
+    read_mode = os.fstat(read_fd).st_mode
+    write_mode = os.fstat(write_fd).st_mode
+    if splice_available and (stat.S_ISFIFO(read_mode) or stat.S_ISFIFO(write_mode)):
+        return COPY_STRATEGY_SPLICE
+    if sendfile_available and stat.S_ISREG(read_mode) and stat.S_ISSOCK(write_mode):
+        return COPY_STRATEGY_SENDFILE
+    return None
+
+def can_kernel_copy(read_from, write_to) -> bool:
+    read_fd = _kernel_fd(read_from, for_writing=False)
+    write_fd = _kernel_fd(write_to, for_writing=True)
+    if read_fd is None or write_fd is None:
+        return False
+    return _choose_kernel_strategy(read_fd, write_fd) is not None
+
+def _remaining(limit: Optional[int], copied: int, chunk_size: int) -> int:
+    if limit is None:
+        return chunk_size
+    return min(chunk_size, limit - copied)
+
+class KernelCopyUnsupported(Exception):
+    """
+    Raised by the kernel copy loops when the kernel refuses to continue.
+    Failed calls don't consume any data, so user space can pick up exactly
+    where the kernel left off.
+    """
+    def __init__(self, bytes_copied: int):
+        super().__init__(bytes_copied)
+        self.bytes_copied = bytes_copied
+
+def _splice_loop(read_fd: int, write_fd: int, limit: Optional[int], meter) -> int:
+    copied = 0
+    while limit is None or copied < limit:
+        try:
+            n = os.splice(
+                read_fd,
+                write_fd,
+                _remaining(limit, copied, SPLICE_CHUNK_SIZE),
+                flags=os.SPLICE_F_MOVE,
+            )
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+                raise
+            raise KernelCopyUnsupported(copied) from e
+        if not n:
+            break
+        copied += n
+        if meter is not None:
+            meter.update(n)
+    return copied
+
+def _sendfile_loop(read_fd: int, write_fd: int, limit: Optional[int], meter) -> int:
+    copied = 0
+    offset = os.lseek(read_fd, 0, os.SEEK_CUR)
+    try:
+        while limit is None or copied < limit:
+            try:
+                n = os.sendfile(
+                    write_fd,
+                    read_fd,
+                    offset,
+                    _remaining(limit, copied, SPLICE_CHUNK_SIZE),
+                )
+            except OSError as e:
+                if e.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+                    raise
+                raise KernelCopyUnsupported(copied) from e
+            if not n:
+                break
+            offset += n
+            copied += n
+            if meter is not None:
+                meter.update(n)
+    finally:
+        # sendfile(2) with an explicit offset doesn't move the file position
+        os.lseek(read_fd, offset, os.SEEK_SET)
+    return copied
+
+def _get_readinto(read_from):
+    if isinstance(read_from, socket.socket):
+        return read_from.recv_into
+    return read_from.readinto
+
+def write_all(write_to, data):
+    """
+    Write all of `data` to a file object. Raw file objects are allowed to
+    write less than requested, and non-blocking ones return None when they
+    can't take anything yet.
+    """
+    view = memoryview(data)
+    while view:
+        written = write_to.write(view)
+        if written is None:
+            select.select([], [write_to], [])
+            continue
+        if written >= len(view):
+            break
+        view = view[written:]
+
+def _get_write_all(write_to):
+    if isinstance(write_to, socket.socket):
+        return write_to.sendall
+    return lambda view: write_all(write_to, view)
+
+def _readinto_loop(
+        read_from,
+        write_to,
+        limit: Optional[int],
+        copied: int,
+        view: memoryview,
+        meter,
+) -> int:
+    buffer_size = len(view)
+    readinto = _get_readinto(read_from)
+    write_all = _get_write_all(write_to)
+    while limit is None or copied < limit:
+        wanted = _remaining(limit, copied, buffer_size)
+        n = readinto(view if wanted == buffer_size else view[:wanted])
+        if not n:
+            break
+        write_all(view if n == buffer_size else view[:n])
+        copied += n
+        if meter is not None:
+            meter.update(n)
+    return copied
+
+def bulk_copy(
+        read_from,
+        write_to,
+        limit: Optional[int] = None,
+        buffer_size: Optional[int] = None,
+        buffer: Optional[memoryview] = None,
+        meter=None,
+) -> CopyResult:
+    """
+    Copy everything from `read_from` to `write_to`, or at most `limit`
+    bytes, using the cheapest mechanism both ends allow.
+
+    Either end can be a socket (plain or TLS) or a file object. File objects
+    should be unbuffered (e.g. `Popen(..., bufsize=0)`) to be eligible for
+    kernel copies.
+
+    Callers that copy many small pieces (like protocol frames) should pass
+    in their own `buffer` rather than leasing one from the pool per call.
+
+    :param buffer_size: Defaults to BUFFER_SIZE
+    :param meter: If given, a `meter.TransferMeter` updated with each chunk
+
+    :return: How many bytes were copied, and how
+    """
+    read_fd = _kernel_fd(read_from, for_writing=False)
+    write_fd = _kernel_fd(write_to, for_writing=True)
+    strategy = None
+    if read_fd is not None and write_fd is not None:
+        strategy = _choose_kernel_strategy(read_fd, write_fd)
+
+    copied = 0
+    if strategy is not None:
+        kernel_loop = _splice_loop if strategy == COPY_STRATEGY_SPLICE else _sendfile_loop
+        try:
+            return CopyResult(strategy, kernel_loop(read_fd, write_fd, limit, meter))
+        except KernelCopyUnsupported as e:
+            copied = e.bytes_copied
+            strategy += '+'
+
+    if buffer is None:
+        buffer_size = buffer_size or BUFFER_SIZE
+        if limit is not None:
+            # No point holding on to more than we'll need
+            buffer_size = max(min(buffer_size, limit - copied), 1)
+        with buffer_pool.lease(buffer_size) as buffer:
+            copied = _readinto_loop(read_from, write_to, limit, copied, buffer, meter)
+    else:
+        copied = _readinto_loop(read_from, write_to, limit, copied, buffer, meter)
+    return CopyResult((strategy or '') + COPY_STRATEGY_READINTO, copied)
@@ -0,0 +1,451 @@
+"""
+Deduplicated transfers: only send the parts of a stream the server hasn't
+seen before.
+
+The client cuts the stream into content-defined chunks, so an insertion or
+deletion only changes the chunks around it, and sends the SHA-256 of each
+batch of chunks in a HASHES frame. The server looks them up in a per-client
+ChunkStore and answers with a 'want' message listing the ones it lacks; the
+client sends just those, one DATA (or COMPRESSED) frame per chunk, in order.
+The server then writes the whole batch, stored and received chunks alike,
+into `btrfs receive`, and adds the new chunks to the store. Up to
+DEDUP_WINDOW batches can be in flight, so the round trip for each batch
+overlaps with sending the one before.
+
+Chunk boundaries come from a cheap content-defined rule that runs at C
+speed: each byte maps to one bit (`bytes.translate` with BOUNDARY_TABLE),
+and a chunk ends after any run of mapped bits that matches BOUNDARY_PATTERN
+(found with `bytes.find`), subject to the minimum and maximum chunk sizes.
+Whether a position is a boundary depends only on the bytes just before it,
+so boundaries line up again shortly after any change.
+
+Stores are kept per client certificate CN, so one client can't find out
+what another one has sent by asking for chunks. Each is limited in size,
+and the least recently used chunks are evicted first.
+"""
+from collections import OrderedDict, deque
+import hashlib
+import os
+from pathlib import Path
+from threading import Lock, get_ident
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional
+
+from buffer_pool import buffer_pool
+from compression import AdaptiveCompressor
+from copy_engine import CopyResult
+from protocol import (
+    COMPRESSED_HEADER,
+    FRAME_COMPRESSED,
+    FRAME_DATA,
+    FRAME_END,
+    FRAME_HASHES,
+    ProtocolError,
+    ReceivedStream,
+    decompress_block,
+    recv_exactly,
+    recv_frame_header,
+    recv_json_payload,
+    recv_message,
+    send_data_frame,
+    send_frame,
+    send_message,
+    write_all,
+)
+
+CHUNK_DIGEST = 'sha256'
+CHUNK_DIGEST_SIZE = hashlib.new(CHUNK_DIGEST).digest_size
+MIN_CHUNK_SIZE = 1 << 14
+MAX_CHUNK_SIZE = 1 << 18
+# One bit per byte, so the average chunk is about
+# MIN_CHUNK_SIZE + 2 ** BOUNDARY_BITS bytes
+BOUNDARY_BITS = 16
+BOUNDARY_TABLE = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+# Not periodic, so runs of the same byte never match it
+BOUNDARY_PATTERN = bytes((0x9a3c5e71 >> i) & 1 for i in range(BOUNDARY_BITS))
+# Read this much of the stream at a time when looking for boundaries
+CHUNKER_READ_SIZE = 1 << 22
+
+# Bytes of chunks per HASHES frame, and most chunks in one
+DEFAULT_DEDUP_BATCH_SIZE = 1 << 23
+MAX_BATCH_CHUNKS = 4096
+# A batch ends with the chunk that takes it past DEFAULT_DEDUP_BATCH_SIZE.
+# The server holds a whole batch in memory before writing it, so it refuses
+# anything bigger.
+MAX_BATCH_BYTES = DEFAULT_DEDUP_BATCH_SIZE + MAX_CHUNK_SIZE
+# HASHES frames that can be waiting for 'want' replies
+DEDUP_WINDOW = 2
+
+DEFAULT_CHUNK_STORE_SIZE = 1 << 30
+
+def content_defined_chunks(read_from) -> Iterator[bytes]:
+    """
+    Cut everything from `read_from` into chunks of MIN_CHUNK_SIZE to
+    MAX_CHUNK_SIZE bytes
+
+    :param read_from: Anything with `readinto`, like the other copy loops
+    take (see copy_engine.py); e.g. a digest.HashingReader
+    """
+    with buffer_pool.lease(CHUNKER_READ_SIZE) as view:
+        yield from _content_defined_chunks(read_from, view)
+
+def _content_defined_chunks(read_from, view: memoryview) -> Iterator[bytes]:
+    buffer = b''
+    eof = False
+    while True:
+        if not eof and len(buffer) < CHUNKER_READ_SIZE:
+            wanted = CHUNKER_READ_SIZE - len(buffer)
+            filled = 0
+            while filled < wanted:
+                n = read_from.readinto(view[filled:wanted])
+                if not n:
+                    eof = True
+                    break
+                filled += n
+            buffer += view[:filled]
+        if not buffer:
+            return
+        mapped = buffer.translate(BOUNDARY_TABLE)
+        start = 0
+        while True:
+            end = start + MAX_CHUNK_SIZE
+            if end > len(buffer) and not eof:
+                # The chunk might end beyond what we've read; read more first
+                break
+            end = min(end, len(buffer))
+            search_from = start + MIN_CHUNK_SIZE - BOUNDARY_BITS
+            found = mapped.find(BOUNDARY_PATTERN, search_from, end) if search_from < end else -1
+            if found >= 0:
+                end = found + BOUNDARY_BITS
+            yield buffer[start:end]
+            start = end
+            if start >= len(buffer):
+                break
+        buffer = buffer[start:]
+
+class ChunkStore:
+    """
+    Chunks received from one client, as files named by digest under `root`
+    """
+    def __init__(self, root: Path, max_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.lock = Lock()
+        # Hex digest -> size, least recently used first
+        self.entries: Dict[str, int] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evicted = 0
+
+    def _path(self, hex_digest: str) -> Path:
+        return self.root / hex_digest[:2] / hex_digest[2:]
+
+    def load(self):
+        """
+        Index the chunks already on disk, oldest (by mtime) first
+        """
+        found = []
+        if self.root.is_dir():
+            for subdir in self.root.iterdir():
+                if not subdir.is_dir():
+                    continue
+                for entry in os.scandir(str(subdir)):
+                    if entry.name.endswith('.tmp'):
+                        os.unlink(entry.path)
+                        continue
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, subdir.name + entry.name, stat.st_size))
+        found.sort()
+        with self.lock:
+            for mtime, hex_digest, size in found:
+                self.entries[hex_digest] = size
+                self.size += size
+            self._evict()
+
+    def _evict(self):
+        """
+        Caller must hold `lock`
+        """
+        while self.size > self.max_size and self.entries:
+            hex_digest, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evicted += 1
+            try:
+                self._path(hex_digest).unlink()
+            except FileNotFoundError:
+                pass
+
+    def get(self, digest: bytes) -> Optional[bytes]:
+        hex_digest = digest.hex()
+        with self.lock:
+            if hex_digest not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(hex_digest)
+        try:
+            data = self._path(hex_digest).read_bytes()
+        except OSError:
+            data = None
+        if data is None or hashlib.new(CHUNK_DIGEST, data).digest() != digest:
+            # Gone, or damaged (e.g. written just before a crash)
+            with self.lock:
+                size = self.entries.pop(hex_digest, None)
+                if size is not None:
+                    self.size -= size
+                self.misses += 1
+            return None
+        try:
+            # Recently used survives a restart too
+            os.utime(str(self._path(hex_digest)))
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += len(data)
+        return data
+
+    def put(self, digest: bytes, data: bytes):
+        if len(data) > self.max_size:
+            return
+        hex_digest = digest.hex()
+        with self.lock:
+            if hex_digest in self.entries:
+                return
+        path = self._path(hex_digest)
+        # Two transfers from the same client may store the same chunk at once
+        temp_path = path.with_name('{}.{}.tmp'.format(path.name, get_ident()))
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_bytes(data)
+            temp_path.rename(path)
+        except OSError as e:
+            # Only costs a resend of this chunk next time
+            print("Can't store chunk:", repr(e))
+            return
+        with self.lock:
+            if hex_digest not in self.entries:
+                self.entries[hex_digest] = len(data)
+                self.size += len(data)
+                self._evict()
+
+    def summary(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'chunks': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'bytes_saved': self.bytes_saved,
+                'evicted': self.evicted,
+            }
+
+class DedupSettings:
+    """
+    Server side: where chunk stores live, and how big each may get
+    """
+    def __init__(self, root: Path, max_size: int = DEFAULT_CHUNK_STORE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.lock = Lock()
+        self.stores: Dict[str, ChunkStore] = {}
+
+    @classmethod
+    def from_config(cls, config) -> Optional['DedupSettings']:
+        """
+        :return: Settings from the server's [dedup] section, or None if
+        there isn't one
+        """
+        if 'dedup' not in config:
+            return None
+        section = config['dedup']
+        return cls(Path(section['path']), section.getint('max size', DEFAULT_CHUNK_STORE_SIZE))
+
+    def store_for(self, cn: str) -> ChunkStore:
+        with self.lock:
+            store = self.stores.get(cn)
+            if store is None:
+                store = self.stores[cn] = ChunkStore(self.root / cn, self.max_size)
+                store.load()
+            return store
+
+class DedupSender:
+    """
+    Client side of a deduplicated transfer
+    """
+    def __init__(
+            self,
+            compressor: Optional[AdaptiveCompressor] = None,
+            meter=None,
+            batch_size: int = DEFAULT_DEDUP_BATCH_SIZE,
+    ):
+        self.compressor = compressor
+        self.meter = meter
+        self.batch_size = batch_size
+        self.chunks = 0
+        self.chunks_sent = 0
+        self.bytes_sent = 0
+
+    def _batches(self, read_from) -> Iterator[List[bytes]]:
+        batch = []
+        size = 0
+        for chunk in content_defined_chunks(read_from):
+            batch.append(chunk)
+            size += len(chunk)
+            if size >= self.batch_size or len(batch) >= MAX_BATCH_CHUNKS:
+                yield batch
+                batch = []
+                size = 0
+        if batch:
+            yield batch
+
+    def copy(self, read_from, conn) -> CopyResult:
+        total = 0
+        pending = deque()
+        batches = self._batches(read_from)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < DEDUP_WINDOW:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                send_frame(
+                    conn,
+                    FRAME_HASHES,
+                    b''.join(hashlib.new(CHUNK_DIGEST, chunk).digest() for chunk in batch),
+                )
+                pending.append(batch)
+            if not pending:
+                break
+            batch = pending.popleft()
+            reply = recv_message(conn)
+            if reply.get('type') != 'want':
+                raise ProtocolError('Expected want message, got {}'.format(reply))
+            for i in reply['missing']:
+                send_data_frame(conn, batch[i], self.compressor)
+                self.chunks_sent += 1
+                self.bytes_sent += len(batch[i])
+            size = sum(len(chunk) for chunk in batch)
+            self.chunks += len(batch)
+            total += size
+            if self.meter is not None:
+                self.meter.update(size)
+        return CopyResult('dedup', total)
+
+    def summary(self) -> dict:
+        return {
+            'chunks': self.chunks,
+            'chunks_sent': self.chunks_sent,
+            'bytes_sent': self.bytes_sent,
+        }
+
+class DedupReceiver:
+    """
+    Server side of a deduplicated transfer
+    """
+    def __init__(self, store: ChunkStore):
+        self.store = store
+        self.chunks = 0
+        self.chunks_received = 0
+        self.bytes_saved = 0
+        self.decompress_seconds = 0.0
+
+    def _read_chunk(self, conn, frame_type: int, length: int) -> bytes:
+        if length > MAX_CHUNK_SIZE + COMPRESSED_HEADER.size:
+            raise ProtocolError('Chunk too large: {}'.format(length))
+        frame = recv_exactly(conn, length)
+        if frame_type == FRAME_DATA:
+            return frame
+        codec_id, = COMPRESSED_HEADER.unpack_from(frame)
+        start = perf_counter()
+        chunk = decompress_block(codec_id, memoryview(frame)[COMPRESSED_HEADER.size:], MAX_CHUNK_SIZE)
+        self.decompress_seconds += perf_counter() - start
+        return chunk
+
+    def receive(self, conn, write_to, meter=None) -> ReceivedStream:
+        """
+        Like protocol.receive_stream, for a deduplicated stream
+        """
+        # Batches not yet written, oldest first: chunk digests, their data
+        # (None until it arrives), the indices still missing, and the bytes
+        # of data so far
+        pending = deque()
+        written = 0
+        wire_bytes = 0
+        while True:
+            frame_type, length = recv_frame_header(conn)
+            if frame_type == FRAME_END:
+                if pending:
+                    raise ProtocolError('Stream ended with chunks missing')
+                summary = recv_json_payload(conn, length)
+                return ReceivedStream(
+                    CopyResult('dedup', written),
+                    summary,
+                    wire_bytes,
+                    self.decompress_seconds,
+                )
+            wire_bytes += length
+            if frame_type == FRAME_HASHES:
+                if length % CHUNK_DIGEST_SIZE or length > MAX_BATCH_CHUNKS * CHUNK_DIGEST_SIZE:
+                    raise ProtocolError('Bad HASHES frame length {}'.format(length))
+                if len(pending) >= DEDUP_WINDOW:
+                    raise ProtocolError('Too many batches in flight')
+                payload = recv_exactly(conn, length)
+                digests = [
+                    payload[i:i + CHUNK_DIGEST_SIZE]
+                    for i in range(0, length, CHUNK_DIGEST_SIZE)
+                ]
+                # Read now, so eviction can't take them away before the
+                # batch is written
+                data = []
+                size = 0
+                for digest in digests:
+                    chunk = self.store.get(digest)
+                    if chunk is not None:
+                        size += len(chunk)
+                        if size > MAX_BATCH_BYTES:
+                            raise ProtocolError('HASHES batch larger than {} bytes'.format(MAX_BATCH_BYTES))
+                    data.append(chunk)
+                missing = deque(i for i, chunk in enumerate(data) if chunk is None)
+                send_message(conn, {'type': 'want', 'missing': list(missing)})
+                self.bytes_saved += size
+                pending.append([digests, data, missing, size])
+            elif frame_type in (FRAME_DATA, FRAME_COMPRESSED):
+                if not pending or not pending[0][2]:
+                    raise ProtocolError('Unexpected chunk')
+                digests, data, missing, size = pending[0]
+                i = missing.popleft()
+                chunk = self._read_chunk(conn, frame_type, length)
+                if hashlib.new(CHUNK_DIGEST, chunk).digest() != digests[i]:
+                    raise ProtocolError('Chunk {} does not match its digest'.format(i))
+                size += len(chunk)
+                if size > MAX_BATCH_BYTES:
+                    raise ProtocolError('Batch larger than {} bytes'.format(MAX_BATCH_BYTES))
+                pending[0][3] = size
+                data[i] = chunk
+                self.store.put(digests[i], chunk)
+                self.chunks_received += 1
+            else:
+                raise ProtocolError('Unexpected frame type {} in stream'.format(frame_type))
+
+            while pending and not pending[0][2]:
+                digests, data, missing, size = pending.popleft()
+                for chunk in data:
+                    write_all(write_to, chunk)
+                    written += len(chunk)
+                    if meter is not None:
+                        meter.update(len(chunk))
+                self.chunks += len(data)
+
+    def summary(self) -> dict:
+        return {
+            'chunks': self.chunks,
+            'chunks_received': self.chunks_received,
+            'bytes_saved': self.bytes_saved,
+            'hit_rate': (self.chunks - self.chunks_received) / self.chunks if self.chunks else None,
+        }
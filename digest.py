@@ -0,0 +1,192 @@
+"""
+End-to-end digests of send streams.
+
+`btrfs receive` exiting with 0 only means that the stream parsed. To catch
+corruption between the two `btrfs` processes (a flaky NIC, bad RAM in a
+router, a bug in one of our copy paths), both ends hash the raw stream as it
+passes through the copy path: the client as it reads from `btrfs send`, the
+server as it writes into `btrfs receive`, after decompression, deduplication
+and reassembly of stripes. The server puts its digest in the result
+message, and the client only counts the transfer as a success (moving the
+'.keep' file and deleting old snapshots) if it matches its own.
+
+Algorithms are negotiated like compression codecs. `xxh3_128` needs the
+`xxhash` package and is by far the fastest; `blake2b` and `sha256` are
+always available, and which of those is faster depends on whether the CPU
+has SHA extensions, so 'auto' times each one and offers the fastest first.
+Hashing time is measured on both ends and reported with
+each transfer, to check that the algorithm keeps up with the link;
+`./benchmark.py --digests` compares them. Hashing keeps the stream in user
+space, so it rules out kernel copies (splice) on both ends.
+"""
+from functools import lru_cache
+import hashlib
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+from copy_engine import CopyResult
+
+xxhash_available = False
+
+try:
+    import xxhash
+    xxhash_available = True
+except ImportError:
+    pass
+
+DIGEST_NONE = 'none'
+DIGEST_AUTO = 'auto'
+# Bytes hashed with each algorithm to find the fastest one
+PROBE_SIZE = 1 << 22
+
+def _available_digests() -> List[str]:
+    digests = []
+    if xxhash_available:
+        digests.append('xxh3_128')
+    digests.extend(['blake2b', 'sha256'])
+    return digests
+
+DIGEST_ALGORITHMS: List[str] = _available_digests()
+
+def new_hasher(algorithm: str):
+    if algorithm == 'xxh3_128':
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+@lru_cache(maxsize=None)
+def fastest_digests() -> Tuple[str, ...]:
+    """
+    :return: The available algorithms, fastest on this machine first
+    """
+    data = bytes(PROBE_SIZE)
+
+    def seconds(algorithm: str) -> float:
+        hasher = new_hasher(algorithm)
+        start = perf_counter()
+        hasher.update(data)
+        return perf_counter() - start
+
+    return tuple(sorted(DIGEST_ALGORITHMS, key=seconds))
+
+def offered_digests(configured: str) -> List[str]:
+    """
+    :param configured: Algorithm from the config file, 'auto' or 'none'
+    :return: Algorithms to offer the server, most preferred first
+    """
+    if configured == DIGEST_NONE:
+        return []
+    if configured == DIGEST_AUTO:
+        return list(fastest_digests())
+    if configured not in DIGEST_ALGORITHMS:
+        print("Stream digest '{}' not available; not verifying streams".format(configured))
+        return []
+    return [configured]
+
+def choose_digest(offered: List[str]) -> Optional[str]:
+    for name in offered:
+        if name in DIGEST_ALGORITHMS:
+            return name
+    return None
+
+class StreamDigest:
+    """
+    A hasher that keeps track of how much it hashed, and how long that took
+    """
+    __slots__ = ['algorithm', 'hasher', 'size', 'seconds']
+
+    def __init__(self, algorithm: str):
+        self.algorithm = algorithm
+        self.hasher = new_hasher(algorithm)
+        self.size = 0
+        self.seconds = 0.0
+
+    def update(self, data):
+        start = perf_counter()
+        self.hasher.update(data)
+        self.seconds += perf_counter() - start
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+    def summary(self) -> dict:
+        return {
+            'algorithm': self.algorithm,
+            'digest': self.hexdigest(),
+            'bytes': self.size,
+            'seconds': self.seconds,
+        }
+
+def describe_digest(summary: dict) -> str:
+    """
+    :param summary: From StreamDigest.summary
+    """
+    rate = summary['bytes'] / summary['seconds'] / 1e6 if summary['seconds'] else float('inf')
+    return '{} of {} bytes: {:.2f}s hashing, {:.0f} MB/s'.format(
+        summary['algorithm'],
+        summary['bytes'],
+        summary['seconds'],
+        rate,
+    )
+
+class HashingReader:
+    """
+    Wraps a raw file object, hashing everything that is read through it
+    """
+    def __init__(self, raw, hasher):
+        self.raw = raw
+        self.hasher = hasher
+
+    def readinto(self, b) -> int:
+        n = self.raw.readinto(b)
+        if n:
+            self.hasher.update(b[:n])
+        return n
+
+class DigestingWriter:
+    """
+    Wraps a raw file object (the stdin of `btrfs receive`), hashing
+    everything that is written through it
+    """
+    def __init__(self, raw, digest: StreamDigest):
+        self.raw = raw
+        self.digest = digest
+
+    def write(self, b) -> Optional[int]:
+        n = self.raw.write(b)
+        if n:
+            self.digest.update(memoryview(b)[:n])
+        return n
+
+def digesting_copy(read_from, conn, digest: StreamDigest, copy) -> CopyResult:
+    """
+    For use as the `copy` argument of `send_snapshot`: hash the stream while
+    `copy(read_from, conn)` sends it
+    """
+    return copy(HashingReader(read_from, digest), conn)
+
+def check_stream_digest(result: dict, digest: Optional[StreamDigest]):
+    """
+    Compare the server's digest of the stream, from its result message,
+    with ours, marking the transfer as failed if they disagree.
+    """
+    if digest is None:
+        return
+    ours = digest.summary()
+    result['sent_digest'] = ours
+    print('Stream digest:', describe_digest(ours))
+    theirs = result.get('stream_digest')
+    if theirs is None:
+        if result.get('success'):
+            print("Server didn't report a stream digest; can't verify the stream")
+            result['digest_unverified'] = True
+        return
+    if theirs.get('algorithm') != ours['algorithm'] or theirs.get('digest') != ours['digest']:
+        result['success'] = False
+        result['digest_mismatch'] = True
+        result['reason'] = 'stream digest mismatch: sent {} {}, server received {} {}'.format(
+            ours['algorithm'],
+            ours['digest'],
+            theirs.get('algorithm'),
+            theirs.get('digest'),
+        )
@@ -0,0 +1,320 @@
+"""
+Fan-out: one `btrfs send` stream to several servers at once.
+
+Besides [server], the client config can name more destinations in
+[server/NAME] sections. Each destination has its own base snapshot: its
+'.keep' files are named `<snapshot>.<NAME>.keep` (just `<snapshot>.keep` for
+[server]), so a destination that missed a transfer still gets an
+incremental send from the snapshot it has.
+
+Destinations that would be sent the same stream (same snapshot, same parent)
+share a single `btrfs send`. A FanoutStream reads it once, and hands every
+block to one FanoutBranch per destination, which that destination's transfer
+thread reads like it would read the pipe. Blocks are buffers leased from
+buffer_pool.py, which go back once every branch has read them. Each branch
+buffers at most 'fanout buffer' bytes. A destination whose buffer has stayed
+full for 'fanout stall timeout' seconds, while another destination has run
+out of data, is dropped from the shared stream so that it stops holding the
+others back; the caller then sends to it on its own.
+"""
+from collections import deque
+from contextvars import copy_context
+from threading import Condition, Event, Thread
+from time import monotonic
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
+from btrfs_incremental_send import Subvolume, send_snapshot
+from buffer_pool import buffer_pool
+from client_session import SessionPool
+from copy_engine import CopyResult
+from protocol import MAX_FRAME_SIZE
+
+DEFAULT_FANOUT_BUFFER = 1 << 26
+DEFAULT_FANOUT_STALL_TIMEOUT = 60.0
+
+class FanoutSettings:
+    __slots__ = ['buffer_limit', 'stall_timeout']
+
+    def __init__(
+            self,
+            buffer_limit: int = DEFAULT_FANOUT_BUFFER,
+            stall_timeout: float = DEFAULT_FANOUT_STALL_TIMEOUT,
+    ):
+        # Bytes buffered per destination
+        self.buffer_limit = buffer_limit
+        self.stall_timeout = stall_timeout
+
+    @classmethod
+    def from_config(cls, config) -> 'FanoutSettings':
+        """
+        :param config: Client config; reads [server]
+        """
+        section = config['server']
+        return cls(
+            section.getint('fanout buffer', DEFAULT_FANOUT_BUFFER),
+            section.getfloat('fanout stall timeout', DEFAULT_FANOUT_STALL_TIMEOUT),
+        )
+
+class DestinationDropped(Exception):
+    """
+    The destination was too slow to keep up with the shared stream
+    """
+    pass
+
+class FanoutBlock:
+    """
+    A block of the stream, in a buffer leased from buffer_pool that goes back
+    once every branch it was handed to is done with it
+    """
+    __slots__ = ['buffer', 'size', 'users']
+
+    def __init__(self, buffer: bytearray, size: int):
+        self.buffer = buffer
+        self.size = size
+        self.users = 0
+
+    def unref(self):
+        """
+        Caller must hold the stream's `cond`
+        """
+        self.users -= 1
+        if not self.users:
+            buffer_pool.release(self.buffer)
+
+class FanoutBranch:
+    """
+    One destination's view of a FanoutStream; reads like an unbuffered file
+    """
+    def __init__(self, stream: 'FanoutStream', name: str):
+        self.stream = stream
+        self.name = name
+        self.blocks: Deque[FanoutBlock] = deque()
+        # Position in blocks[0]
+        self.offset = 0
+        self.buffered = 0
+        # The whole stream has been handed over
+        self.complete = False
+        # Reading this branch will only raise this from now on
+        self.error: Optional[BaseException] = None
+        # Nobody reads from this branch any more
+        self.closed = False
+
+    @property
+    def live(self) -> bool:
+        return not self.closed and self.error is None
+
+    def _clear(self):
+        """
+        Caller must hold the stream's `cond`
+        """
+        for block in self.blocks:
+            block.unref()
+        self.blocks.clear()
+        self.offset = 0
+        self.buffered = 0
+
+    def readinto(self, b) -> int:
+        """
+        :return: Up to `len(b)` bytes; 0 at the end of the stream
+        """
+        cond = self.stream.cond
+        with cond:
+            while not self.blocks:
+                if self.error is not None:
+                    raise self.error
+                if self.complete:
+                    return 0
+                cond.wait()
+            block = self.blocks[0]
+            # Copied while the block can't go back to the pool
+            n = min(len(b), block.size - self.offset)
+            b[:n] = memoryview(block.buffer)[self.offset:self.offset + n]
+            self.offset += n
+            if self.offset >= block.size:
+                self.blocks.popleft()
+                block.unref()
+                self.offset = 0
+            self.buffered -= n
+            cond.notify_all()
+            return n
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray(size if size >= 0 else MAX_FRAME_SIZE)
+        del data[self.readinto(data):]
+        return bytes(data)
+
+    def close(self):
+        with self.stream.cond:
+            self.closed = True
+            self._clear()
+            self.stream.cond.notify_all()
+
+    def send(self, conn, snapshot: Subvolume, copy, use_pv: bool = False) -> Tuple[CopyResult, int]:
+        """
+        Stands in for `btrfs_incremental_send.send_snapshot` in
+        ClientSession.transfer; `use_pv` isn't supported
+        """
+        try:
+            copy_result = copy(self, conn)
+        finally:
+            self.close()
+        return copy_result, self.stream.wait()
+
+class FanoutStream:
+    def __init__(self, settings: FanoutSettings):
+        self.settings = settings
+        self.cond = Condition()
+        self.branches: List[FanoutBranch] = []
+        self.finished = Event()
+        self.return_code: Optional[int] = None
+        self.error: Optional[BaseException] = None
+
+    def branch(self, name: str) -> FanoutBranch:
+        branch = FanoutBranch(self, name)
+        self.branches.append(branch)
+        return branch
+
+    def _others_starved(self, branch: FanoutBranch) -> bool:
+        """
+        Caller must hold `cond`
+        """
+        return any(
+            other.live and other.buffered == 0
+            for other in self.branches
+            if other is not branch
+        )
+
+    def _put(self, block: FanoutBlock):
+        limit = self.settings.buffer_limit
+        stall_timeout = self.settings.stall_timeout
+        with self.cond:
+            for branch in self.branches:
+                full_since = None
+                while branch.live and branch.buffered and branch.buffered + block.size > limit:
+                    now = monotonic()
+                    if full_since is None:
+                        full_since = now
+                    if now - full_since >= stall_timeout and self._others_starved(branch):
+                        print('Destination {} is falling behind; dropping it from the shared stream'.format(
+                            branch.name,
+                        ))
+                        branch.error = DestinationDropped(
+                            "Couldn't keep up with the other destinations",
+                        )
+                        branch._clear()
+                        break
+                    self.cond.wait(max(0.0, full_since + stall_timeout - now) or stall_timeout)
+                if branch.live:
+                    branch.blocks.append(block)
+                    branch.buffered += block.size
+                    block.users += 1
+            if not block.users:
+                buffer_pool.release(block.buffer)
+            self.cond.notify_all()
+            if not any(branch.live for branch in self.branches):
+                raise DestinationDropped('No destination is reading the stream any more')
+
+    def copy(self, read_from, conn=None) -> CopyResult:
+        """
+        For `send_snapshot`; `conn` isn't used
+        """
+        copied = 0
+        while True:
+            # Not waiting for room in the pool: 'fanout buffer' already
+            # bounds what the branches hold, and a branch that holds too much
+            # is only dropped once the next block is on its way
+            buffer = buffer_pool.acquire(MAX_FRAME_SIZE, over_limit=True)
+            view = memoryview(buffer)
+            n = 0
+            try:
+                # Pipes hand over at most 64 KiB at a time; fewer, larger
+                # blocks mean less locking
+                while n < MAX_FRAME_SIZE:
+                    got = read_from.readinto(view[n:MAX_FRAME_SIZE])
+                    if not got:
+                        break
+                    n += got
+            except BaseException:
+                buffer_pool.release(buffer)
+                raise
+            finally:
+                view.release()
+            if not n:
+                buffer_pool.release(buffer)
+                break
+            self._put(FanoutBlock(buffer, n))
+            copied += n
+        with self.cond:
+            for branch in self.branches:
+                branch.complete = True
+            self.cond.notify_all()
+        return CopyResult('fanout', copied)
+
+    def run(self, snapshot: Subvolume):
+        """
+        Run `btrfs send` and feed every branch
+        """
+        try:
+            copy_result, self.return_code = send_snapshot(None, snapshot, copy=self.copy)
+        except BaseException as e:
+            self.error = e
+            with self.cond:
+                for branch in self.branches:
+                    if branch.error is None:
+                        branch.error = e
+                self.cond.notify_all()
+        finally:
+            self.finished.set()
+
+    def wait(self) -> int:
+        """
+        :return: The return code of `btrfs send`
+        """
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.return_code
+
+def fanout_transfer(
+        views: Dict[SessionPool, Subvolume],
+        settings: FanoutSettings,
+) -> Dict[SessionPool, Union[dict, BaseException]]:
+    """
+    Send one stream to several destinations, with one `btrfs send`. Every
+    view must have the same newest snapshot and parent.
+
+    :param views: Destination -> the snapshot as seen by that destination
+    :return: Destination -> the server's last message about the transfer, or
+    the exception that ended it (DestinationDropped if it was too slow)
+    """
+    stream = FanoutStream(settings)
+    results: Dict[SessionPool, Union[dict, BaseException]] = {}
+
+    def send_to(sessions: SessionPool, view: Subvolume, branch: FanoutBranch):
+        session = None
+        try:
+            session = sessions.acquire()
+            label = '{} to {}'.format(view.newest, sessions.host)
+            results[sessions] = session.transfer(view, send=branch.send, label=label)
+        except BaseException as e:
+            results[sessions] = e
+            if session is not None:
+                session.close()
+        else:
+            sessions.release(session)
+        finally:
+            # If the server turned the transfer down, `branch.send` never ran,
+            # and the other destinations mustn't wait for this one
+            branch.close()
+
+    threads = []
+    for sessions, view in views.items():
+        branch = stream.branch(sessions.name or sessions.host)
+        # In this thread's context, so that its spans have the transfer ID
+        threads.append(Thread(target=copy_context().run, args=(send_to, sessions, view, branch)))
+    for thread in threads:
+        thread.start()
+    stream.run(next(iter(views.values())))
+    for thread in threads:
+        thread.join()
+    return results
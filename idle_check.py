@@ -0,0 +1,228 @@
+"""
+Deciding cheaply whether a client run has anything to do.
+
+Most runs from the timer find that the server already has the newest
+snapshot of every subvolume, but finding that out means mounting automount
+paths, checking the network and power requirements, reading every snapshot
+directory and setting up TLS. So after a run in which a path had nothing to
+send, its snapshot directory's inode and mtime are kept in a state file
+(along with a digest of the config file). The next run compares them with a
+`stat()` of each directory and exits straight away if nothing changed: no
+mount, no prerequisite checks, no connection, and no notifications.
+
+Any new snapshot or `.keep` file changes the directory's mtime. A run that
+sends something moves '.keep' files, so it's always followed by one full
+run that finds nothing to send before runs are skipped again. Automount
+paths aren't mounted between runs, so they can only be checked without
+mounting if they're mounted anyway, or if their [path/NAME] section has a
+'change marker': a file or directory elsewhere whose mtime changes whenever
+a snapshot is taken. Pending snapshot deletions, a changed config, or a
+full check more than 'full check interval' seconds ago also mean a full run.
+
+How long each run took, from process start to exit, is printed and kept
+in the state file, so slow no-op runs show up.
+"""
+import hashlib
+import json
+import os
+from os.path import ismount
+from pathlib import Path
+from time import monotonic, time
+from typing import Dict, Iterable, List, Optional, Set
+
+IDLE_STATE_PATH = Path('/var/lib/btrfs-syncd/idle-state.json')
+IDLE_STATE_VERSION = 1
+# Seconds; 0 to never force a full run
+DEFAULT_FULL_CHECK_INTERVAL = 86400
+# Directory mtimes this close to when they were recorded (in seconds) can't
+# be trusted to change again on the next modification; as in
+# snapshot_catalog
+MTIME_GRANULARITY = 2
+
+# For when /proc/self/stat can't be read
+_imported = monotonic()
+
+class IdleCheckSettings:
+    __slots__ = ['enabled', 'state_path', 'full_check_interval']
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            state_path: Path = IDLE_STATE_PATH,
+            full_check_interval: float = DEFAULT_FULL_CHECK_INTERVAL,
+    ):
+        self.enabled = enabled
+        self.state_path = state_path
+        self.full_check_interval = full_check_interval
+
+    @classmethod
+    def from_config(cls, config) -> 'IdleCheckSettings':
+        """
+        :param config: Client config; reads the optional [idle check] section
+        """
+        if 'idle check' not in config:
+            return cls()
+        section = config['idle check']
+        return cls(
+            section.getboolean('enabled', True),
+            Path(section.get('state', str(IDLE_STATE_PATH))),
+            section.getfloat('full check interval', DEFAULT_FULL_CHECK_INTERVAL),
+        )
+
+def process_seconds() -> float:
+    """
+    :return: Seconds since this process started, including interpreter
+    startup and imports if /proc says when that was
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name (field 2) is in parentheses and may contain
+            # spaces; field 22 is the start time in clock ticks after boot
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return monotonic() - _imported
+
+def config_digest(config_path: Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(config_path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+def watched_path(bp) -> Optional[Path]:
+    """
+    :param bp: client.BackupPath
+    :return: What to `stat()` to tell whether `bp` has changed, or None if
+    that can't be done without mounting it
+    """
+    if bp.change_marker is not None:
+        return bp.change_marker
+    if bp.automount and not ismount(bp.mount_path):
+        return None
+    return bp.path
+
+def path_signature(bp) -> Optional[List[int]]:
+    """
+    :return: Inode and mtime (ns) of `watched_path(bp)`; None if unknown
+    """
+    path = watched_path(bp)
+    if path is None:
+        return None
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return [stat.st_ino, stat.st_mtime_ns]
+
+class IdleState:
+    """
+    What the last runs found, kept in a JSON file
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.config_digest: Optional[str] = None
+        # When the last full run finished
+        self.full_check: Optional[float] = None
+        # Path name -> {'signature': path_signature(), 'recorded': time()},
+        # for paths that had nothing to send
+        self.paths: Dict[str, dict] = {}
+        # Seconds from process start to exit
+        self.last_full_run_seconds: Optional[float] = None
+        self.last_idle_run_seconds: Optional[float] = None
+
+    def load(self):
+        try:
+            with self.path.open() as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print("Can't read idle state:", repr(e))
+            return
+        if state.get('version') != IDLE_STATE_VERSION:
+            return
+        self.config_digest = state['config_digest']
+        self.full_check = state['full_check']
+        self.paths = state['paths']
+        self.last_full_run_seconds = state.get('last_full_run_seconds')
+        self.last_idle_run_seconds = state.get('last_idle_run_seconds')
+
+    def save(self):
+        state = {
+            'version': IDLE_STATE_VERSION,
+            'config_digest': self.config_digest,
+            'full_check': self.full_check,
+            'paths': self.paths,
+            'last_full_run_seconds': self.last_full_run_seconds,
+            'last_idle_run_seconds': self.last_idle_run_seconds,
+        }
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with temp_path.open('w') as f:
+                json.dump(state, f)
+            temp_path.rename(self.path)
+        except OSError as e:
+            # Only costs us a full run next time
+            print("Can't save idle state:", repr(e))
+
+    def reason_to_run(
+            self,
+            settings: IdleCheckSettings,
+            config_path: Path,
+            backup_paths: Iterable,
+            deletions_pending: bool,
+    ) -> Optional[str]:
+        """
+        :param backup_paths: client.BackupPath objects
+        :return: Why a full run is needed, or None if nothing can have
+        changed since the last one
+        """
+        if self.full_check is None:
+            return 'no record of an earlier run'
+        if self.config_digest != config_digest(config_path):
+            return 'config changed'
+        if settings.full_check_interval and time() - self.full_check > settings.full_check_interval:
+            return 'last full check was {:.0f}s ago'.format(time() - self.full_check)
+        if deletions_pending:
+            return 'snapshot deletions pending'
+        for bp in backup_paths:
+            recorded = self.paths.get(bp.name)
+            if recorded is None:
+                return 'path {} had something to send last time'.format(bp.name)
+            signature = path_signature(bp)
+            if signature is None:
+                return "can't check path {} without mounting it".format(bp.name)
+            if signature != recorded['signature']:
+                return 'path {} changed'.format(bp.name)
+            if recorded['recorded'] - signature[1] / 1e9 <= MTIME_GRANULARITY:
+                return 'path {} changed just before the last check'.format(bp.name)
+        return None
+
+    def record_full_run(
+            self,
+            config_path: Path,
+            signatures: Dict[str, Optional[List[int]]],
+            recorded: float,
+            busy: Set[str],
+    ):
+        """
+        :param signatures: Path name -> path_signature() from before the run
+        :param recorded: When `signatures` were taken
+        :param busy: Names of paths that had anything to send, or failed
+        """
+        self.config_digest = config_digest(config_path)
+        self.full_check = time()
+        self.paths = {
+            name: {'signature': signature, 'recorded': recorded}
+            for name, signature in signatures.items()
+            if signature is not None and name not in busy
+        }
+        self.last_full_run_seconds = process_seconds()
+        self.save()
+
+    def record_idle_run(self):
+        self.last_idle_run_seconds = process_seconds()
+        self.save()
@@ -0,0 +1,172 @@
+"""
+What the server already holds, so the client can pick the `btrfs send`
+parent (and skip sends entirely) before any data moves.
+
+The server answers an 'inventory' control message with the snapshots it has
+received into the client's path, and their received UUIDs when
+`btrfs subvolume list` can tell us. Names come from a SnapshotCatalog kept
+per path, which only rescans when the directory's mtime changes; UUIDs are
+listed again only after the catalog changed or a receive into that path
+finished (which sets a received UUID without touching the directory).
+
+A snapshot only counts as held once `btrfs receive` has set its received
+UUID, so half-received snapshots are never offered as parents. Snapshots
+that this server process is receiving right now are left out too, which
+also covers the case where UUIDs aren't available.
+"""
+from pathlib import Path
+import re
+from subprocess import DEVNULL, CalledProcessError, check_output
+from threading import Lock
+from typing import Dict, Mapping, Optional
+
+from btrfs_incremental_send import Subvolume
+from snapshot_catalog import SnapshotCatalog
+
+BTRFS_LIST_COMMAND = [
+    'btrfs',
+    'subvolume',
+    'list',
+    '-o',
+]
+# Column to ask `btrfs subvolume list` for -> its flag
+BTRFS_LIST_UUID_FLAGS = {
+    'uuid': '-u',
+    'received_uuid': '-R',
+}
+NO_UUID = '-'
+
+def list_subvolume_uuids(path: Path, column: str) -> Optional[Dict[str, str]]:
+    """
+    :param column: 'uuid' or 'received_uuid'
+    :return: Name -> UUID (or None if that column is empty) for each
+    subvolume directly under `path`, or None if they can't be listed (not
+    btrfs, not root, no `btrfs` command)
+    """
+    command = BTRFS_LIST_COMMAND + [BTRFS_LIST_UUID_FLAGS[column], str(path)]
+    try:
+        output = check_output(command, stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        return None
+    pattern = re.compile(r'\b{} (\S+) .*\bpath (.+)$'.format(column))
+    uuids = {}
+    for line in output.decode('utf-8', errors='replace').splitlines():
+        m = pattern.search(line)
+        if m:
+            uuid = m.group(1)
+            uuids[Path(m.group(2)).name] = None if uuid == NO_UUID else uuid
+    return uuids
+
+class SnapshotInventory:
+    """
+    Server side: snapshots received into each destination path
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.catalogs: Dict[Path, SnapshotCatalog] = {}
+        # Path -> received UUIDs, and the catalog state they were listed at
+        self.uuids: Dict[Path, Optional[Dict[str, str]]] = {}
+        self.uuid_signatures: Dict[Path, tuple] = {}
+        # Path -> names of snapshots being received into it
+        self.receiving: Dict[Path, Dict[str, int]] = {}
+
+    def start_receive(self, path: Path, snapshot: Optional[str]):
+        with self.lock:
+            if snapshot is not None:
+                receiving = self.receiving.setdefault(path, {})
+                receiving[snapshot] = receiving.get(snapshot, 0) + 1
+
+    def finish_receive(self, path: Path, snapshot: Optional[str]):
+        with self.lock:
+            receiving = self.receiving.get(path, {})
+            if snapshot in receiving:
+                receiving[snapshot] -= 1
+                if not receiving[snapshot]:
+                    del receiving[snapshot]
+            # Whether or not it worked, a received UUID may have appeared
+            self.uuid_signatures.pop(path, None)
+
+    def reply(self, path: Path) -> dict:
+        """
+        :return: The reply to an 'inventory' message
+        """
+        try:
+            return self.snapshots(path)
+        except (OSError, ValueError) as e:
+            print("Can't take inventory of {}: {!r}".format(path, e))
+            return {'type': 'inventory', 'success': False, 'reason': repr(e)}
+
+    def snapshots(self, path: Path) -> dict:
+        with self.lock:
+            catalog = self.catalogs.get(path)
+            if catalog is None:
+                catalog = self.catalogs[path] = SnapshotCatalog(path)
+            catalog.refresh()
+            signature = (catalog.dir_inode, catalog.dir_mtime_ns, catalog.written)
+            if self.uuid_signatures.get(path) != signature:
+                self.uuids[path] = list_subvolume_uuids(path, 'received_uuid')
+                self.uuid_signatures[path] = signature
+            uuids = self.uuids[path]
+            receiving = set(self.receiving.get(path, {}))
+
+            held = []
+            # Already oldest first
+            for name in catalog.snapshots:
+                if name in receiving:
+                    continue
+                received_uuid = None
+                if uuids is not None:
+                    received_uuid = uuids.get(name)
+                    if received_uuid is None:
+                        # Not (completely) received
+                        continue
+                held.append({'name': name, 'received_uuid': received_uuid})
+        return {
+            'type': 'inventory',
+            'success': True,
+            'snapshots': held,
+            'received_uuids': uuids is not None,
+        }
+
+def reconcile(
+        snapshot: Subvolume,
+        inventory: dict,
+        local_uuids: Optional[Mapping[str, Optional[str]]] = None,
+) -> bool:
+    """
+    Set `snapshot.parent` to the newest older snapshot that the server holds
+    (or None for a full send).
+
+    :param inventory: The server's reply to an 'inventory' message
+    :param local_uuids: Snapshot name -> UUID on this machine. If given, and
+    the server knows received UUIDs, a snapshot only counts as held if the
+    UUIDs match, e.g. not if the server has one of the same name that was
+    sent from elsewhere.
+    :return: Whether the server already holds the newest snapshot
+    """
+    held = {entry['name']: entry['received_uuid'] for entry in inventory['snapshots']}
+
+    def server_has(name: str) -> bool:
+        if name not in held:
+            return False
+        if local_uuids is None or held[name] is None or local_uuids.get(name) is None:
+            return True
+        return local_uuids[name] == held[name]
+
+    if server_has(snapshot.newest):
+        return True
+    parent = None
+    for name in reversed(snapshot.all[:-1]):
+        if server_has(name):
+            parent = name
+            break
+    if parent != snapshot.base:
+        print(
+            'Server inventory: sending {} with parent {} instead of {}'.format(
+                snapshot.newest,
+                parent,
+                snapshot.base,
+            )
+        )
+    snapshot.parent = parent
+    return False
@@ -0,0 +1,446 @@
+"""
+Fitting socket options and copy sizes to the link a connection runs over.
+
+When a session starts, each end estimates the round-trip time (from the
+kernel's TCP_INFO, or else from how long the hello/welcome exchange took)
+and the bandwidth (the throughput of the previous transfer with the same
+peer, the 'link bandwidth' setting, or the kernel's delivery rate estimate,
+in that order). Once the first RATE_WINDOW seconds of a transfer have gone
+through, the throughput measured so far replaces the bandwidth estimate and
+everything is chosen again. From the bandwidth-delay product (BDP):
+
+ * Socket buffer (SO_SNDBUF when sending, SO_RCVBUF when receiving): twice
+   the BDP. Linux grows buffers on its own up to the maximum in
+   net.ipv4.tcp_wmem/tcp_rmem, and setting one turns that off for the
+   socket, so a buffer is only set when the BDP needs more than that. As
+   root, SO_SNDBUFFORCE/SO_RCVBUFFORCE get past net.core.wmem_max/rmem_max.
+   A receive buffer beyond net.ipv4.tcp_rmem's maximum may not be usable by
+   a connection that was already open (the window scale is fixed when it
+   opens), so raise that sysctl for links that need more.
+ * Congestion control (sending only): 'bbr', if the kernel has it, for
+   round trips of at least WAN_RTT seconds, where loss-based algorithms
+   back off too far; otherwise the system default.
+ * TCP_NOTSENT_LOWAT (sending only): keeps the unsent part of a large send
+   buffer small, so it doesn't hold memory or delay control messages.
+ * Chunk size: the BDP rounded up to a power of two, between MIN_CHUNK_SIZE
+   and copy_engine.BUFFER_SIZE. Used for frames of the multiplexed protocol
+   (up to protocol.MAX_FRAME_SIZE) and raw copies of the two-port protocol,
+   so a LAN transfer doesn't need a 16 MB buffer.
+
+Any of these can be set in the [server] section, or for all destinations in
+[network]; [server] wins. 'socket tuning = false' leaves everything as it
+was. What was chosen is logged with each transfer.
+"""
+from configparser import ConfigParser
+from functools import lru_cache
+import os
+import socket
+import struct
+from typing import List, Optional, Tuple
+
+from copy_engine import BUFFER_SIZE
+
+# Linux values, which Python doesn't export
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+
+tcp_info_available = hasattr(socket, 'TCP_INFO')
+congestion_control_available = hasattr(socket, 'TCP_CONGESTION')
+
+# struct tcp_info, up to tcpi_delivery_rate (Linux 4.9+; older kernels
+# return less, and the missing fields read as 0)
+TCP_INFO_STRUCT = struct.Struct('=8B24I4Q6IQ')
+# Offsets into the unpacked fields
+TCP_INFO_RTT = 8 + 15
+TCP_INFO_MIN_RTT = 8 + 24 + 4 + 3
+TCP_INFO_DELIVERY_RATE = 8 + 24 + 4 + 6
+
+# Seconds; longer round trips than this get BBR if available
+WAN_RTT = 0.01
+CONGESTION_CONTROL_WAN = 'bbr'
+MIN_SOCKET_BUFFER = 1 << 16
+MAX_SOCKET_BUFFER = 1 << 26
+DEFAULT_NOTSENT_LOWAT = 1 << 17
+MIN_CHUNK_SIZE = 1 << 18
+# When the BDP isn't known
+DEFAULT_CHUNK_SIZE = 1 << 20
+# For 'congestion control': choose from the RTT, or leave the system default
+CONGESTION_CONTROL_AUTO = 'auto'
+CONGESTION_CONTROL_DEFAULT = 'default'
+
+SYSCTL_DIR = '/proc/sys/net'
+
+def read_sysctl(name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(SYSCTL_DIR, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+@lru_cache()
+def autotuning_limit(sending: bool) -> int:
+    """
+    :return: Largest buffer the kernel grows a socket's send or receive
+    buffer to by itself
+    """
+    value = read_sysctl('ipv4/tcp_wmem' if sending else 'ipv4/tcp_rmem')
+    try:
+        return int(value.split()[2])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+@lru_cache()
+def available_congestion_control() -> List[str]:
+    return (read_sysctl('ipv4/tcp_available_congestion_control') or '').split()
+
+def read_tcp_info(sock) -> Optional[Tuple[float, float, float]]:
+    """
+    :return: Smoothed RTT and minimum RTT (seconds) and delivery rate
+    (bytes per second) of `sock`'s connection, or None if the kernel can't
+    say
+    """
+    if not tcp_info_available:
+        return None
+    try:
+        raw = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_STRUCT.size)
+    except OSError:
+        return None
+    fields = TCP_INFO_STRUCT.unpack(raw.ljust(TCP_INFO_STRUCT.size, b'\0'))
+    return (
+        fields[TCP_INFO_RTT] / 1e6,
+        fields[TCP_INFO_MIN_RTT] / 1e6,
+        float(fields[TCP_INFO_DELIVERY_RATE]),
+    )
+
+def _next_power_of_two(n: float) -> int:
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+class LinkSettings:
+    __slots__ = [
+        'enabled',
+        'link_bandwidth',
+        'socket_buffer',
+        'congestion_control',
+        'notsent_lowat',
+        'chunk_size',
+    ]
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            link_bandwidth: Optional[float] = None,
+            socket_buffer: Optional[int] = None,
+            congestion_control: str = CONGESTION_CONTROL_AUTO,
+            notsent_lowat: int = DEFAULT_NOTSENT_LOWAT,
+            chunk_size: Optional[int] = None,
+    ):
+        self.enabled = enabled
+        # Bytes per second to assume until a transfer has been measured
+        self.link_bandwidth = link_bandwidth
+        # Overrides the chosen socket buffer; 0 leaves it to the kernel
+        self.socket_buffer = socket_buffer
+        # A name from net.ipv4.tcp_available_congestion_control, 'auto' or
+        # 'default'
+        self.congestion_control = congestion_control
+        # 0 to leave unset
+        self.notsent_lowat = notsent_lowat
+        # Overrides the chosen chunk size
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_config(cls, section=None, network=None) -> 'LinkSettings':
+        """
+        :param section: [server] section (of the client's config, merged
+        with [server/NAME] for other destinations, or the server's own)
+        :param network: [network] section; defaults for `section`
+        """
+        def get(key: str) -> Optional[str]:
+            for s in [section, network]:
+                if s is not None and key in s:
+                    return s[key]
+            return None
+
+        def get_int(key: str) -> Optional[int]:
+            value = get(key)
+            return None if value is None else int(value)
+
+        enabled = get('socket tuning')
+        link_bandwidth = get('link bandwidth')
+        notsent_lowat = get_int('notsent lowat')
+        return cls(
+            True if enabled is None else ConfigParser.BOOLEAN_STATES[enabled.strip().lower()],
+            None if link_bandwidth is None else float(link_bandwidth),
+            get_int('socket buffer'),
+            get('congestion control') or CONGESTION_CONTROL_AUTO,
+            DEFAULT_NOTSENT_LOWAT if notsent_lowat is None else notsent_lowat,
+            get_int('chunk size'),
+        )
+
+class LinkParameters:
+    __slots__ = ['socket_buffer', 'congestion_control', 'notsent_lowat', 'chunk_size']
+
+    def __init__(
+            self,
+            socket_buffer: Optional[int],
+            congestion_control: Optional[str],
+            notsent_lowat: Optional[int],
+            chunk_size: int,
+    ):
+        # None leaves the setting alone
+        self.socket_buffer = socket_buffer
+        self.congestion_control = congestion_control
+        self.notsent_lowat = notsent_lowat
+        self.chunk_size = chunk_size
+
+    def __eq__(self, other):
+        return isinstance(other, LinkParameters) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+def choose_parameters(
+        settings: LinkSettings,
+        rtt: Optional[float],
+        bandwidth: Optional[float],
+        sending: bool,
+) -> LinkParameters:
+    """
+    :param rtt: Seconds
+    :param bandwidth: Bytes per second
+    :param sending: Whether the stream goes out through this end
+    """
+    bdp = None if rtt is None or not bandwidth else rtt * bandwidth
+
+    if settings.socket_buffer is not None:
+        socket_buffer = settings.socket_buffer or None
+    elif bdp is None:
+        socket_buffer = None
+    else:
+        socket_buffer = int(min(max(2 * bdp, MIN_SOCKET_BUFFER), MAX_SOCKET_BUFFER))
+        if socket_buffer <= autotuning_limit(sending):
+            socket_buffer = None
+
+    congestion_control = None
+    if settings.congestion_control == CONGESTION_CONTROL_AUTO:
+        if (
+                sending
+                and rtt is not None
+                and rtt >= WAN_RTT
+                and CONGESTION_CONTROL_WAN in available_congestion_control()
+        ):
+            congestion_control = CONGESTION_CONTROL_WAN
+    elif settings.congestion_control != CONGESTION_CONTROL_DEFAULT:
+        congestion_control = settings.congestion_control
+
+    if settings.chunk_size is not None:
+        chunk_size = settings.chunk_size
+    elif bdp is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    else:
+        chunk_size = min(max(_next_power_of_two(bdp), MIN_CHUNK_SIZE), BUFFER_SIZE)
+
+    return LinkParameters(
+        socket_buffer,
+        congestion_control,
+        (settings.notsent_lowat or None) if sending else None,
+        chunk_size,
+    )
+
+class LinkTuner:
+    """
+    Chooses and applies the parameters for one connection, and remembers
+    what it found
+    """
+    def __init__(self, settings: LinkSettings, sending: bool, bandwidth: Optional[float] = None):
+        """
+        :param bandwidth: Bytes per second measured by an earlier transfer
+        with the same peer, if any
+        """
+        self.settings = settings
+        self.sending = sending
+        self.rtt: Optional[float] = None
+        self.rtt_source: Optional[str] = None
+        self.bandwidth = bandwidth
+        self.bandwidth_source = None if bandwidth is None else 'previous transfer'
+        # Throughput of the last transfer over this connection
+        self.measured: Optional[float] = None
+        self.parameters: Optional[LinkParameters] = None
+        # What the kernel reports after applying `parameters`
+        self.socket_buffer_kernel: Optional[int] = None
+        self.congestion_control: Optional[str] = None
+        self.errors: List[str] = []
+
+    @property
+    def chunk_size(self) -> Optional[int]:
+        """
+        :return: For copies over this connection; None for the default
+        """
+        return None if self.parameters is None else self.parameters.chunk_size
+
+    def measure(self, sock, exchange_seconds: Optional[float] = None):
+        """
+        :param exchange_seconds: How long a request/reply round trip took,
+        used for the RTT if TCP_INFO isn't available
+        """
+        info = read_tcp_info(sock)
+        delivery_rate = None
+        if info is not None and info[0]:
+            rtt, min_rtt, delivery_rate = info
+            # The minimum leaves out queueing delay, which a bigger buffer
+            # would only add to
+            self.rtt = min_rtt or rtt
+            self.rtt_source = 'tcp_info'
+        elif exchange_seconds is not None:
+            self.rtt = exchange_seconds
+            self.rtt_source = 'exchange'
+        if self.bandwidth_source in {None, 'kernel estimate'}:
+            if self.settings.link_bandwidth is not None:
+                self.bandwidth = self.settings.link_bandwidth
+                self.bandwidth_source = 'configured'
+            elif delivery_rate:
+                # Only from the handshake so far, so probably low
+                self.bandwidth = delivery_rate
+                self.bandwidth_source = 'kernel estimate'
+
+    def start(self, sock, exchange_seconds: Optional[float] = None):
+        """
+        Measure and tune `sock`, at the start of a session or transfer
+        """
+        if not self.settings.enabled:
+            return
+        self.measure(sock, exchange_seconds)
+        self.apply(sock)
+
+    def early_rate(self, sock, rate: float):
+        """
+        Tune again with the throughput of the start of a transfer; for
+        `TransferMeter.on_first_rate`
+        """
+        if not self.settings.enabled or not rate:
+            return
+        previous = self.parameters
+        self.bandwidth = rate
+        self.bandwidth_source = 'early throughput'
+        self.apply(sock)
+        if self.parameters != previous:
+            print('Retuned link:', self.format())
+
+    def record_throughput(self, transferred: int, seconds: float):
+        """
+        The next transfer over this connection starts from this
+        """
+        if transferred and seconds > 0:
+            self.measured = transferred / seconds
+            self.bandwidth = self.measured
+            self.bandwidth_source = 'previous transfer'
+
+    def apply(self, sock):
+        parameters = choose_parameters(self.settings, self.rtt, self.bandwidth, self.sending)
+        self.errors = []
+        previous = self.parameters
+        if parameters.socket_buffer is not None and (
+                previous is None or parameters.socket_buffer != previous.socket_buffer
+        ):
+            self._set_buffer(sock, parameters.socket_buffer)
+        if parameters.congestion_control is not None and (
+                previous is None or parameters.congestion_control != previous.congestion_control
+        ):
+            self._setsockopt(
+                sock,
+                socket.IPPROTO_TCP,
+                getattr(socket, 'TCP_CONGESTION', None),
+                parameters.congestion_control.encode(),
+                'congestion control',
+            )
+        if parameters.notsent_lowat is not None and previous is None:
+            self._setsockopt(sock, socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, parameters.notsent_lowat, 'notsent lowat')
+        self.parameters = parameters
+        try:
+            self.socket_buffer_kernel = sock.getsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_SNDBUF if self.sending else socket.SO_RCVBUF,
+            )
+            if congestion_control_available:
+                self.congestion_control = sock.getsockopt(
+                    socket.IPPROTO_TCP,
+                    socket.TCP_CONGESTION,
+                    16,
+                ).split(b'\0', 1)[0].decode()
+        except OSError:
+            pass
+
+    def _setsockopt(self, sock, level: int, option: Optional[int], value, name: str) -> bool:
+        if option is None:
+            self.errors.append('{}: not supported'.format(name))
+            return False
+        try:
+            sock.setsockopt(level, option, value)
+            return True
+        except OSError as e:
+            self.errors.append('{}: {}'.format(name, e.strerror))
+            return False
+
+    def _set_buffer(self, sock, size: int):
+        if self.sending:
+            force, option = SO_SNDBUFFORCE, socket.SO_SNDBUF
+        else:
+            force, option = SO_RCVBUFFORCE, socket.SO_RCVBUF
+        try:
+            # Only allowed as root, but not capped by net.core.*mem_max
+            sock.setsockopt(socket.SOL_SOCKET, force, size)
+        except OSError:
+            self._setsockopt(sock, socket.SOL_SOCKET, option, size, 'socket buffer')
+
+    def describe(self) -> dict:
+        """
+        :return: For logs and trace spans
+        """
+        description = {
+            'rtt': self.rtt,
+            'rtt_source': self.rtt_source,
+            'bandwidth': self.bandwidth,
+            'bandwidth_source': self.bandwidth_source,
+        }
+        if self.parameters is not None:
+            description.update(
+                {
+                    'socket_buffer': self.parameters.socket_buffer,
+                    'socket_buffer_kernel': self.socket_buffer_kernel,
+                    'congestion_control': self.congestion_control,
+                    'notsent_lowat': self.parameters.notsent_lowat,
+                    'chunk_size': self.parameters.chunk_size,
+                }
+            )
+        if self.errors:
+            description['errors'] = self.errors
+        return description
+
+    def format(self) -> str:
+        if not self.settings.enabled:
+            return 'socket tuning disabled'
+        pieces = [
+            'RTT {}'.format(
+                'unknown' if self.rtt is None
+                else '{:.2f} ms ({})'.format(self.rtt * 1e3, self.rtt_source)
+            ),
+            'bandwidth {}'.format(
+                'unknown' if self.bandwidth is None
+                else '{:.1f} MB/s ({})'.format(self.bandwidth / 1e6, self.bandwidth_source)
+            ),
+        ]
+        if self.parameters is not None:
+            pieces.append(
+                '{} buffer {} ({} bytes)'.format(
+                    'send' if self.sending else 'receive',
+                    'kernel-tuned' if self.parameters.socket_buffer is None else self.parameters.socket_buffer,
+                    self.socket_buffer_kernel,
+                )
+            )
+            pieces.append('congestion control {}'.format(self.congestion_control))
+            if self.parameters.notsent_lowat is not None:
+                pieces.append('notsent lowat {}'.format(self.parameters.notsent_lowat))
+            pieces.append('chunk size {}'.format(self.parameters.chunk_size))
+        if self.errors:
+            pieces.append('errors: {}'.format('; '.join(self.errors)))
+        return ', '.join(pieces)
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+"""
+Load test for the receive server: many clients at once, on one machine.
+
+A real server engine runs in a process of its own, on a loopback port,
+with a destination for each of N clients. Every client is a separate
+process with its own throwaway certificate (CN client-1, client-2, ...),
+and sends a series of streams with the real `client.backup_snapshot`. As
+in benchmark.py, `btrfs send` and `btrfs receive` are replaced by its
+`fake-send` and `fake-receive` subcommands, so the receive sink can be made
+as slow as a busy disk with --receive-rate.
+
+Clients can all start at once, or ramp up with --ramp:
+
+    none            all clients start together (the default)
+    linear:SECONDS  start times spread evenly over SECONDS
+    step:COUNT:SECONDS  COUNT more clients every SECONDS
+
+Each client sends --transfers streams, one after another, with sizes drawn
+from --sizes: comma-separated SIZE or SIZE:WEIGHT, e.g. `16M:3,1G` for
+three small streams to every large one.
+
+While the clients run, the server's RSS, thread count, open file
+descriptors and `btrfs receive` children are sampled from /proc. Each case
+reports the aggregate throughput, transfer latency percentiles (per client
+and overall; a client's first transfer includes its TLS handshake), time
+spent queued for admission, the peaks of those samples, and how full the
+server's buffer pool got (see buffer_pool.py; its limit is set with
+--buffer-memory). Example:
+
+    ./loadtest.py --clients 1,8,32 --engines threading,asyncio \\
+        --sizes 64M:4,512M --receive-rate 100M --ramp linear:10 \\
+        --output loadtest-results.json
+"""
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from datetime import datetime
+import itertools
+import json
+import math
+import os
+from pathlib import Path
+import random
+import socket
+from subprocess import DEVNULL, Popen
+import sys
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import monotonic, perf_counter, sleep, time
+from typing import List, Optional, Tuple
+
+from benchmark import free_port, make_certificates, parse_list, parse_size, version_info
+
+SCRIPT_PATH = Path(__file__).resolve()
+BENCHMARK_PATH = SCRIPT_PATH.with_name('benchmark.py')
+
+DEFAULT_SIZES = '64M'
+DEFAULT_SAMPLE_INTERVAL = 0.5
+# Seconds to wait for the server to start listening
+SERVER_START_TIMEOUT = 30
+PERCENTILES = [50, 90, 99]
+
+RAMP_NONE = 'none'
+RAMP_LINEAR = 'linear'
+RAMP_STEP = 'step'
+
+def client_name(i: int) -> str:
+    """
+    :param i: From 1
+    """
+    return 'client-{}'.format(i)
+
+def parse_sizes(s: str) -> List[Tuple[int, float]]:
+    """
+    :param s: e.g. '16M:3,1G'
+    :return: (size, weight) pairs
+    """
+    sizes = []
+    for piece in parse_list(s):
+        size, _, weight = piece.partition(':')
+        sizes.append((parse_size(size), float(weight) if weight else 1.0))
+    return sizes
+
+def ramp_offsets(ramp: str, count: int) -> List[float]:
+    """
+    :return: Seconds after the first client that each client starts
+    """
+    kind, *params = ramp.split(':')
+    if kind == RAMP_NONE:
+        return [0.0] * count
+    if kind == RAMP_LINEAR:
+        seconds = float(params[0])
+        return [seconds * i / max(count - 1, 1) for i in range(count)]
+    if kind == RAMP_STEP:
+        step_count, seconds = int(params[0]), float(params[1])
+        return [seconds * (i // step_count) for i in range(count)]
+    raise ValueError('Unknown ramp pattern: {}'.format(ramp))
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """
+    Nearest-rank percentile
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+def percentiles(values: List[float]) -> dict:
+    return {'p{}'.format(p): percentile(values, p) for p in PERCENTILES}
+
+def serve(args):
+    """
+    Run a server engine for `args.clients` clients until killed, and write
+    its port to `args.port_file`
+    """
+    import btrfs_incremental_send
+    from buffer_pool import buffer_pool
+    from meter import status_board
+    from receive_scheduler import ReceiveScheduler
+
+    btrfs_incremental_send.BTRFS_RECEIVE_COMMAND[:] = [
+        sys.executable, str(BENCHMARK_PATH), 'fake-receive',
+        '--rate', str(args.receive_rate),
+        '{path}',
+    ]
+    status_board.report_interval = float('inf')
+    status_board.status_path = Path(args.status_file)
+    if args.buffer_memory is not None:
+        buffer_pool.memory_limit = args.buffer_memory
+
+    root = Path(args.root)
+    config = ConfigParser()
+    config['server'] = {'engine': args.engine}
+    if args.max_receives is not None:
+        config['server']['max concurrent receives'] = str(args.max_receives)
+    paths = {}
+    for i in range(1, args.clients + 1):
+        name = client_name(i)
+        paths[name] = root / name
+        paths[name].mkdir()
+        config['path/' + name] = {'path': str(paths[name])}
+
+    key_dir = Path(args.key_dir)
+    files = [str(key_dir / name) for name in ['server.crt.pem', 'server.key.pem', 'ca.crt.pem']]
+    port_file = Path(args.port_file)
+    if args.engine == 'asyncio':
+        import asyncio
+        from functools import partial
+        import aio_server
+        from ssl_socketserver import make_server_context
+        from tls import ReloadingContext
+        server = aio_server.BtrfsReceiveServer(
+            paths,
+            ReloadingContext(partial(make_server_context, *files), files),
+            aio_server.AdmissionController.from_config(config, paths),
+        )
+        port = free_port()
+        port_file.write_text(str(port))
+        asyncio.run(server.serve_forever('127.0.0.1', port))
+        return
+
+    import server as threaded_server
+    from receive_scheduler import AdmissionQueue
+    from ssl_socketserver import SSL_ThreadingTCPServer
+    server = SSL_ThreadingTCPServer(
+        ('127.0.0.1', 0),
+        threaded_server.get_handler_class(
+            paths,
+            admission=AdmissionQueue(ReceiveScheduler.from_config(config, paths)),
+        ),
+        *files
+    )
+    port_file.write_text(str(server.server_address[1]))
+    server.serve_forever()
+
+def run_client(args):
+    """
+    Send one stream of each size in `args.sizes`, one after another, and
+    write how long each took to `args.result`
+    """
+    import btrfs_incremental_send
+    import client
+    import client_session
+    from btrfs_incremental_send import Subvolume
+    from compression import CompressionSettings, offered_codecs
+    from digest import offered_digests
+    from meter import status_board
+
+    status_board.report_interval = float('inf')
+    key_dir = Path(args.key_dir)
+    sessions = client_session.SessionPool(
+        '127.0.0.1',
+        client_session.make_client_contexts(
+            {
+                'ca_cert': key_dir / 'ca.crt.pem',
+                'client_cert': key_dir / (args.name + '.crt.pem'),
+                'client_key': key_dir / (args.name + '.key.pem'),
+            }
+        ),
+        client_session.TransferOptions(
+            CompressionSettings(offered_codecs(args.compression)),
+            use_inventory=False,
+            digests=offered_digests(args.digest),
+        ),
+        args.port,
+    )
+
+    transfers = []
+    with TemporaryDirectory() as temp:
+        for i, size in enumerate(json.loads(args.sizes)):
+            btrfs_incremental_send.BTRFS_SEND_COMMAND[:] = [
+                sys.executable, str(BENCHMARK_PATH), 'fake-send',
+                '--size', str(size),
+            ]
+            snapshot = Subvolume()
+            snapshot.newest = '{}@{}'.format(args.name, i)
+            snapshot.cwd = Path(temp)
+            transfer = {'size': size, 'start': time()}
+            start = perf_counter()
+            try:
+                response = client.backup_snapshot(snapshot, sessions)
+            except Exception as e:
+                response = {'success': False, 'reason': repr(e)}
+            transfer['seconds'] = perf_counter() - start
+            transfer['success'] = response['success']
+            if not response['success']:
+                transfer['reason'] = response.get('reason')
+            transfer['queue_seconds'] = response.get('scheduling', {}).get('wait_seconds')
+            transfers.append(transfer)
+    sessions.close_all()
+
+    with open(args.result, 'w') as f:
+        json.dump({'client': args.name, 'transfers': transfers, 'error': None}, f)
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # utime and stime are fields 14 and 15; the command name (field
+            # 2) may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+class ServerMonitor:
+    """
+    Samples the resource usage of the server process from a thread
+    """
+    def __init__(self, pid: int, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        # [seconds since start, RSS bytes, threads, open FDs, children]
+        self.samples: List[List[float]] = []
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.started = monotonic()
+
+    def sample(self) -> Optional[List[float]]:
+        proc = Path('/proc/{}'.format(self.pid))
+        try:
+            rss = threads = None
+            with (proc / 'status').open() as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) * 1024
+                    elif line.startswith('Threads:'):
+                        threads = int(line.split()[1])
+            fds = len(os.listdir(str(proc / 'fd')))
+            children = 0
+            for task in (proc / 'task').iterdir():
+                children += len((task / 'children').read_text().split())
+        except (OSError, ValueError):
+            # Exited
+            return None
+        return [monotonic() - self.started, rss, threads, fds, children]
+
+    def _run(self):
+        while True:
+            sample = self.sample()
+            if sample is not None:
+                self.samples.append(sample)
+            if self.stopped.wait(self.interval):
+                break
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def summary(self) -> dict:
+        columns = ['rss_bytes', 'threads', 'open_fds', 'receive_processes']
+        summary = {}
+        for i, column in enumerate(columns, 1):
+            values = [sample[i] for sample in self.samples]
+            summary[column] = {
+                'peak': max(values, default=None),
+                'mean': sum(values) / len(values) if values else None,
+            }
+        summary['samples'] = self.samples
+        return summary
+
+def wait_for_server(proc: Popen, port_file: Path) -> int:
+    """
+    :return: The server's port, once it's listening
+    """
+    deadline = monotonic() + SERVER_START_TIMEOUT
+    while monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('Server exited with return code {}'.format(proc.returncode))
+        try:
+            port = int(port_file.read_text())
+            socket.create_connection(('127.0.0.1', port)).close()
+            return port
+        except (OSError, ValueError):
+            sleep(0.05)
+    raise RuntimeError('Server not listening after {} seconds'.format(SERVER_START_TIMEOUT))
+
+def run_scenario(args, key_dir: Path, engine: str, count: int) -> dict:
+    """
+    Start a server, run `count` clients against it, and summarize
+    """
+    output = None if args.verbose else DEVNULL
+    rng = random.Random(args.seed)
+    sizes, weights = zip(*args.sizes)
+    with TemporaryDirectory() as temp:
+        temp = Path(temp)
+        root = temp / 'destinations'
+        root.mkdir()
+        results_dir = temp / 'results'
+        results_dir.mkdir()
+        port_file = temp / 'port'
+        status_file = temp / 'status.json'
+        command = [
+            sys.executable, str(SCRIPT_PATH), 'serve',
+            '--key-dir', str(key_dir),
+            '--root', str(root),
+            '--clients', str(count),
+            '--engine', engine,
+            '--receive-rate', str(args.receive_rate),
+            '--port-file', str(port_file),
+            '--status-file', str(status_file),
+        ]
+        if args.max_receives is not None:
+            command.extend(['--max-receives', str(args.max_receives)])
+        if args.buffer_memory is not None:
+            command.extend(['--buffer-memory', str(args.buffer_memory)])
+        server = Popen(command, stdout=output)
+        try:
+            port = wait_for_server(server, port_file)
+            monitor = ServerMonitor(server.pid, args.sample_interval)
+            monitor.start()
+            cpu_start = process_cpu_seconds(server.pid)
+
+            clients = []
+            start = monotonic()
+            for i, offset in enumerate(ramp_offsets(args.ramp, count), 1):
+                delay = start + offset - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                name = client_name(i)
+                clients.append(
+                    Popen(
+                        [
+                            sys.executable, str(SCRIPT_PATH), 'run-client',
+                            '--key-dir', str(key_dir),
+                            '--port', str(port),
+                            '--name', name,
+                            '--compression', args.compression,
+                            '--digest', args.digest,
+                            '--result', str(results_dir / (name + '.json')),
+                            json.dumps(rng.choices(sizes, weights, k=args.transfers)),
+                        ],
+                        stdout=output,
+                    )
+                )
+            return_codes = [proc.wait() for proc in clients]
+            cpu_end = process_cpu_seconds(server.pid)
+            monitor.stop()
+        finally:
+            server.terminate()
+            server.wait()
+        try:
+            # Rewritten whenever a transfer starts or finishes
+            with status_file.open() as f:
+                buffers = json.load(f)['buffers']
+        except (OSError, ValueError, KeyError):
+            buffers = None
+
+        client_results = []
+        for i, return_code in enumerate(return_codes, 1):
+            try:
+                with (results_dir / (client_name(i) + '.json')).open() as f:
+                    client_results.append(json.load(f))
+            except (OSError, ValueError):
+                client_results.append({'client': client_name(i), 'error': return_code, 'transfers': []})
+
+    transfers = [t for c in client_results for t in c['transfers']]
+    succeeded = [t for t in transfers if t['success']]
+    if succeeded:
+        first_start = min(t['start'] for t in succeeded)
+        last_end = max(t['start'] + t['seconds'] for t in succeeded)
+        throughput = sum(t['size'] for t in succeeded) / (last_end - first_start) / 1e6
+    else:
+        throughput = None
+    queue_seconds = [t['queue_seconds'] for t in succeeded if t['queue_seconds'] is not None]
+    return {
+        'engine': engine,
+        'clients': count,
+        'transfers': len(transfers),
+        'failed': len(transfers) - len(succeeded),
+        # Clients that exited without a result
+        'failed_clients': sum(1 for c in client_results if c.get('error') is not None),
+        'aggregate_mb_per_second': throughput,
+        'latency_seconds': percentiles([t['seconds'] for t in succeeded]),
+        'queue_seconds': percentiles(queue_seconds),
+        'per_client': [
+            {
+                'client': c['client'],
+                'latency_seconds': percentiles([t['seconds'] for t in c['transfers'] if t['success']]),
+                'transfers': c['transfers'],
+                'error': c.get('error'),
+            }
+            for c in client_results
+        ],
+        'server_cpu_seconds': (
+            cpu_end - cpu_start
+            if cpu_start is not None and cpu_end is not None
+            else None
+        ),
+        'server': monitor.summary(),
+        'buffers': buffers,
+    }
+
+def format_seconds(seconds: Optional[float]) -> str:
+    return '-' if seconds is None else '{:.2f}s'.format(seconds)
+
+def load_test(args):
+    cases = list(itertools.product(args.engines, args.clients))
+    results = []
+    with TemporaryDirectory() as temp:
+        key_dir = Path(temp)
+        print('Making certificates for {} clients'.format(max(args.clients)), flush=True)
+        make_certificates(
+            key_dir,
+            {client_name(i): '/CN=' + client_name(i) for i in range(1, max(args.clients) + 1)},
+        )
+        for i, (engine, count) in enumerate(cases, 1):
+            print('[{}/{}] {} engine, {} clients'.format(i, len(cases), engine, count), flush=True)
+            try:
+                result = run_scenario(args, key_dir, engine, count)
+            except RuntimeError as e:
+                print('  failed:', e)
+                results.append({'engine': engine, 'clients': count, 'error': str(e)})
+                continue
+            latency = result['latency_seconds']
+            print(
+                '  {} MB/s aggregate, latency p50 {} p90 {} p99 {}, {} of {} failed'.format(
+                    '-' if result['aggregate_mb_per_second'] is None
+                    else '{:.1f}'.format(result['aggregate_mb_per_second']),
+                    format_seconds(latency['p50']),
+                    format_seconds(latency['p90']),
+                    format_seconds(latency['p99']),
+                    result['failed'],
+                    result['transfers'],
+                ),
+            )
+            server = result['server']
+            if server['samples']:
+                print(
+                    '  server peak: RSS {:.1f} MB, {} threads, {} FDs, {} receive processes'.format(
+                        server['rss_bytes']['peak'] / 1e6,
+                        server['threads']['peak'],
+                        server['open_fds']['peak'],
+                        server['receive_processes']['peak'],
+                    ),
+                    flush=True,
+                )
+            buffers = result['buffers']
+            if buffers is not None:
+                print(
+                    '  buffer pool: peak {:.1f} MB in use, {:.1f} MB allocated, {} waits ({:.1f}s)'.format(
+                        buffers['peak_in_use_bytes'] / 1e6,
+                        buffers['allocated_bytes'] / 1e6,
+                        buffers['waits'],
+                        buffers['wait_seconds'],
+                    ),
+                    flush=True,
+                )
+            results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(
+            {
+                'started': datetime.now().isoformat(),
+                'version': version_info(),
+                'settings': {
+                    'sizes': args.sizes,
+                    'transfers': args.transfers,
+                    'receive_rate': args.receive_rate,
+                    'ramp': args.ramp,
+                    'max_receives': args.max_receives,
+                    'buffer_memory': args.buffer_memory,
+                    'compression': args.compression,
+                    'digest': args.digest,
+                    'seed': args.seed,
+                },
+                'results': results,
+            },
+            f,
+            indent=2,
+        )
+    print('Results written to', args.output)
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('serve')
+    p.add_argument('--key-dir', required=True)
+    p.add_argument('--root', required=True)
+    p.add_argument('--clients', type=int, required=True)
+    p.add_argument('--engine', default='threading')
+    p.add_argument('--receive-rate', type=parse_size, default=0)
+    p.add_argument('--max-receives', type=int)
+    p.add_argument('--buffer-memory', type=int)
+    p.add_argument('--port-file', required=True)
+    p.add_argument('--status-file', required=True)
+    p.set_defaults(func=serve)
+
+    p = subparsers.add_parser('run-client')
+    p.add_argument('--key-dir', required=True)
+    p.add_argument('--port', type=int, required=True)
+    p.add_argument('--name', required=True)
+    p.add_argument('--compression', default='none')
+    p.add_argument('--digest', default='auto')
+    p.add_argument('--result', required=True)
+    p.add_argument('sizes', help='JSON list of stream sizes')
+    p.set_defaults(func=run_client)
+
+    # Load testing is the default when no subcommand is given
+    parser.add_argument(
+        '--clients',
+        type=lambda s: parse_list(s, int),
+        default=[4],
+        help='Comma-separated numbers of concurrent clients to try',
+    )
+    parser.add_argument('--engines', type=parse_list, default=['threading'])
+    parser.add_argument(
+        '--sizes',
+        type=parse_sizes,
+        default=parse_sizes(DEFAULT_SIZES),
+        help="Stream sizes, with optional weights, e.g. '16M:3,1G'",
+    )
+    parser.add_argument('--transfers', type=int, default=3, help='Streams sent by each client')
+    parser.add_argument(
+        '--receive-rate',
+        type=parse_size,
+        default=0,
+        help='Bytes per second each fake `btrfs receive` consumes; 0 for unlimited',
+    )
+    parser.add_argument('--ramp', default=RAMP_NONE, help="none, linear:SECONDS or step:COUNT:SECONDS")
+    parser.add_argument(
+        '--max-receives',
+        type=int,
+        help="The server's 'max concurrent receives'; defaults to the engine's default",
+    )
+    parser.add_argument(
+        '--buffer-memory',
+        type=parse_size,
+        help="The server's [buffers] 'memory limit'; defaults to buffer_pool.DEFAULT_MEMORY_LIMIT",
+    )
+    parser.add_argument('--compression', default='none')
+    parser.add_argument('--digest', default='auto')
+    parser.add_argument('--seed', type=int, default=0, help='For choosing stream sizes')
+    parser.add_argument('--sample-interval', type=float, default=DEFAULT_SAMPLE_INTERVAL)
+    parser.add_argument('--output', default='loadtest-results.json')
+    parser.add_argument('--verbose', action='store_true', help='Show client and server output')
+
+    args = parser.parse_args()
+    if args.command is None:
+        # A bad --ramp should fail before making certificates
+        ramp_offsets(args.ramp, 1)
+        load_test(args)
+    else:
+        args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+In-process progress and throughput metering, replacing `pv`.
+
+The copy loops call `TransferMeter.update` with each chunk they move. Every
+REPORT_INTERVAL seconds (and when a transfer finishes) the meter is reported:
+to the journal as structured fields if the `systemd` Python package is
+installed, otherwise as a printed line, and to the status file if one is
+configured. The status file is JSON describing every transfer in progress
+and the occupancy of the buffer pool (see buffer_pool.py), rewritten
+atomically so other programs can poll it.
+"""
+import json
+import os
+from pathlib import Path
+from threading import Lock
+from time import monotonic, time
+from typing import Callable, Dict, Optional
+
+from buffer_pool import buffer_pool
+
+journal_available = False
+
+try:
+    from systemd import journal
+    journal_available = True
+except ImportError:
+    pass
+
+# Seconds between progress reports for each transfer
+REPORT_INTERVAL = 10
+# A gap this long (in seconds) between two chunks counts as stalled time
+STALL_THRESHOLD = 1.0
+# The current rate is measured over windows of at least this many seconds
+RATE_WINDOW = 2.0
+
+class TransferMeter:
+    __slots__ = [
+        'board',
+        'name',
+        'direction',
+        'started',
+        'bytes',
+        'last_update',
+        'stall_seconds',
+        'window_start',
+        'window_bytes',
+        'rate',
+        'next_report',
+        'first_byte',
+        'on_first_rate',
+    ]
+
+    def __init__(self, board: 'StatusBoard', name: str, direction: str):
+        self.board = board
+        self.name = name
+        # 'send' or 'receive'
+        self.direction = direction
+        now = monotonic()
+        self.started = now
+        self.bytes = 0
+        self.last_update = now
+        self.stall_seconds = 0.0
+        self.window_start = now
+        self.window_bytes = 0
+        # Bytes per second over the last complete window; None until the
+        # first one is complete
+        self.rate = None
+        self.next_report = now + board.report_interval
+        # When the first bytes went through, for measuring startup latency
+        self.first_byte: Optional[float] = None
+        # Called with the rate once the first window is complete, e.g.
+        # link_tuning.LinkTuner.early_rate
+        self.on_first_rate: Optional[Callable[[float], None]] = None
+
+    def update(self, n: int):
+        now = monotonic()
+        if self.first_byte is None and n:
+            self.first_byte = now
+        gap = now - self.last_update
+        if gap > STALL_THRESHOLD:
+            self.stall_seconds += gap
+        self.last_update = now
+        self.bytes += n
+        self.window_bytes += n
+        if now - self.window_start >= RATE_WINDOW:
+            self.rate = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+            if self.on_first_rate is not None:
+                callback, self.on_first_rate = self.on_first_rate, None
+                callback(self.rate)
+        if now >= self.next_report:
+            self.next_report = now + self.board.report_interval
+            self.board.report(self, 'progress')
+
+    def summary(self) -> dict:
+        elapsed = monotonic() - self.started
+        average_rate = self.bytes / elapsed if elapsed else 0.0
+        return {
+            'name': self.name,
+            'direction': self.direction,
+            'bytes': self.bytes,
+            'elapsed_seconds': elapsed,
+            'rate': average_rate if self.rate is None else self.rate,
+            'average_rate': average_rate,
+            'stall_seconds': self.stall_seconds,
+        }
+
+    def finish(self):
+        self.board.finish(self)
+
+class StatusBoard:
+    """
+    The transfers in progress in this process
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.meters: Dict[int, TransferMeter] = {}
+        self.status_path: Optional[Path] = None
+        self.report_interval = REPORT_INTERVAL
+
+    def configure(self, config):
+        """
+        :param config: Client or server config; reads the optional [status]
+        section
+        """
+        if 'status' not in config:
+            return
+        section = config['status']
+        if 'file' in section:
+            self.status_path = Path(section['file'])
+        self.report_interval = section.getfloat('report interval', REPORT_INTERVAL)
+
+    def start(self, name: str, direction: str) -> TransferMeter:
+        meter = TransferMeter(self, name, direction)
+        with self.lock:
+            self.meters[id(meter)] = meter
+        self.write_status()
+        return meter
+
+    def finish(self, meter: TransferMeter):
+        with self.lock:
+            self.meters.pop(id(meter), None)
+        self.report(meter, 'done')
+
+    def report(self, meter: TransferMeter, state: str):
+        summary = meter.summary()
+        message = (
+            '{name}: {state}, {direction} {bytes} bytes in {elapsed:.1f}s, '
+            '{rate:.1f} MB/s now, {average:.1f} MB/s average, {stall:.1f}s stalled'
+        ).format(
+            name=summary['name'],
+            state=state,
+            direction=summary['direction'],
+            bytes=summary['bytes'],
+            elapsed=summary['elapsed_seconds'],
+            rate=summary['rate'] / 1e6,
+            average=summary['average_rate'] / 1e6,
+            stall=summary['stall_seconds'],
+        )
+        if journal_available:
+            journal.send(
+                message,
+                TRANSFER_NAME=summary['name'],
+                TRANSFER_STATE=state,
+                TRANSFER_DIRECTION=summary['direction'],
+                TRANSFER_BYTES=str(summary['bytes']),
+                TRANSFER_ELAPSED_SECONDS='{:.3f}'.format(summary['elapsed_seconds']),
+                TRANSFER_RATE='{:.0f}'.format(summary['rate']),
+                TRANSFER_AVERAGE_RATE='{:.0f}'.format(summary['average_rate']),
+                TRANSFER_STALL_SECONDS='{:.3f}'.format(summary['stall_seconds']),
+            )
+        else:
+            print(message)
+        self.write_status()
+
+    def write_status(self):
+        if self.status_path is None:
+            return
+        with self.lock:
+            status = {
+                'pid': os.getpid(),
+                'updated': time(),
+                'transfers': [meter.summary() for meter in self.meters.values()],
+                'buffers': buffer_pool.summary(),
+            }
+            temp_path = self.status_path.with_name(self.status_path.name + '.tmp')
+            try:
+                self.status_path.parent.mkdir(parents=True, exist_ok=True)
+                with temp_path.open('w') as f:
+                    json.dump(status, f, indent=2)
+                temp_path.rename(self.status_path)
+            except OSError as e:
+                # Not worth failing a transfer over
+                print("Can't write status file:", repr(e))
+
+# Shared by everything in this process
+status_board = StatusBoard()
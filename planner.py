@@ -0,0 +1,432 @@
+"""
+Planning a run: which of the pending transfers to send, and in what order.
+
+Before any transfer starts, the size of each pending `btrfs send` stream is
+estimated without running it:
+ * incremental sends: the length of the extents written since the parent
+   snapshot's generation, from `btrfs subvolume find-new` (metadata only)
+ * full sends: the size of the snapshot, from `btrfs filesystem du`
+ * if those fail (not root, not btrfs): the size of the last stream sent for
+   the same subvolume, from the transfer history
+
+The transfers are then put in order: smallest first by default, so that one
+huge subvolume doesn't hold up all the small ones behind it (and a laptop
+that leaves the network partway through a run has sent as many subvolumes as
+possible); by configured priority, then size; or in the order they were
+found. An optional byte and/or time budget cuts the run short, deferring
+the transfers that wouldn't fit to the next run. A transfer that has been
+deferred 'max deferrals' runs in a row goes first, budget or not, so that a
+big one isn't put off forever. The time budget is converted to bytes with
+the throughput of the previous run, and is also enforced while running: no
+transfer starts once it has run out.
+
+The plan is printed, and written as JSON to the 'export' path if there is
+one, before the first transfer starts.
+"""
+import json
+from pathlib import Path
+import re
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, check_output
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from btrfs_incremental_send import Subvolume
+
+ORDER_SMALLEST_FIRST = 'smallest-first'
+ORDER_PRIORITY = 'priority'
+ORDER_CATALOG = 'catalog'
+PLAN_ORDERS = [ORDER_SMALLEST_FIRST, ORDER_PRIORITY, ORDER_CATALOG]
+
+TRANSFER_HISTORY_PATH = Path('/var/lib/btrfs-syncd/transfer-history.json')
+TRANSFER_HISTORY_VERSION = 1
+PLAN_EXPORT_VERSION = 1
+DEFAULT_MAX_DEFERRALS = 3
+
+BTRFS_SHOW_COMMAND = [
+    'btrfs',
+    'subvolume',
+    'show',
+]
+BTRFS_FIND_NEW_COMMAND = [
+    'btrfs',
+    'subvolume',
+    'find-new',
+]
+BTRFS_DU_COMMAND = [
+    'btrfs',
+    'filesystem',
+    'du',
+    '-s',
+    '--raw',
+]
+GENERATION_PATTERN = re.compile(r'^\s*Generation:\s*(\d+)\s*$', re.MULTILINE)
+FIND_NEW_LENGTH_PATTERN = re.compile(rb'\blen (\d+)\b')
+
+ESTIMATE_FIND_NEW = 'find-new'
+ESTIMATE_DU = 'du'
+ESTIMATE_HISTORY = 'history'
+
+class PlanSettings:
+    __slots__ = [
+        'order',
+        'byte_budget',
+        'time_budget',
+        'max_deferrals',
+        'estimate',
+        'history_path',
+        'export_path',
+    ]
+
+    def __init__(
+            self,
+            order: str = ORDER_SMALLEST_FIRST,
+            byte_budget: int = 0,
+            time_budget: float = 0.0,
+            max_deferrals: int = DEFAULT_MAX_DEFERRALS,
+            estimate: bool = True,
+            history_path: Optional[Path] = TRANSFER_HISTORY_PATH,
+            export_path: Optional[Path] = None,
+    ):
+        self.order = order
+        # Bytes and seconds per run; 0 for no limit
+        self.byte_budget = byte_budget
+        self.time_budget = time_budget
+        self.max_deferrals = max_deferrals
+        # Ask btrfs for estimates; otherwise only the history is used
+        self.estimate = estimate
+        self.history_path = history_path
+        self.export_path = export_path
+
+    @classmethod
+    def from_config(cls, config) -> 'PlanSettings':
+        """
+        :param config: Client config; reads the optional [plan] section
+        """
+        if 'plan' not in config:
+            return cls()
+        section = config['plan']
+        order = section.get('order', ORDER_SMALLEST_FIRST)
+        if order not in PLAN_ORDERS:
+            raise ValueError("Unknown 'order' setting in [plan]: {}".format(order))
+        history = section.get('history', str(TRANSFER_HISTORY_PATH))
+        export = section.get('export')
+        return cls(
+            order,
+            section.getint('byte budget', 0),
+            section.getfloat('time budget', 0.0),
+            section.getint('max deferrals', DEFAULT_MAX_DEFERRALS),
+            section.getboolean('estimate', True),
+            Path(history) if history else None,
+            Path(export) if export else None,
+        )
+
+class PlannedTransfer:
+    __slots__ = [
+        'path_name',
+        'subvolume_name',
+        'snapshot',
+        'destinations',
+        'priority',
+        'estimate',
+        'estimate_source',
+        'deferrals',
+        'deferred',
+    ]
+
+    def __init__(
+            self,
+            path_name: str,
+            subvolume_name: str,
+            snapshot: Subvolume,
+            destinations: Iterable[Optional[str]] = (None,),
+            priority: int = 0,
+    ):
+        self.path_name = path_name
+        self.subvolume_name = subvolume_name
+        self.snapshot = snapshot
+        # Names of the destinations it's sent to; None for [server]
+        self.destinations = list(destinations)
+        # Higher goes first with ORDER_PRIORITY
+        self.priority = priority
+        # Estimated stream size in bytes, or None if unknown
+        self.estimate: Optional[int] = None
+        self.estimate_source: Optional[str] = None
+        # Runs in a row that this subvolume was deferred in
+        self.deferrals = 0
+        # Left for the next run
+        self.deferred = False
+
+    @property
+    def key(self) -> str:
+        return '{}/{}'.format(self.path_name, self.subvolume_name)
+
+    def parents(self) -> List[Optional[str]]:
+        """
+        :return: Parent snapshot of each distinct stream that has to be sent;
+        None for a full send
+        """
+        parents = []
+        for destination in self.destinations:
+            base = self.snapshot.bases.get(destination)
+            if base != self.snapshot.newest and base not in parents:
+                parents.append(base)
+        return parents
+
+    def describe(self) -> dict:
+        return {
+            'path': self.path_name,
+            'subvolume': self.subvolume_name,
+            'snapshot': self.snapshot.newest,
+            'parents': self.parents(),
+            'priority': self.priority,
+            'estimated_bytes': self.estimate,
+            'estimate_source': self.estimate_source,
+            'deferrals': self.deferrals,
+            'deferred': self.deferred,
+        }
+
+class TransferHistory:
+    """
+    Sizes of the streams sent for each subvolume, how often each was
+    deferred, and the throughput of the last run; kept in a JSON file
+    """
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        # PlannedTransfer.key -> {'bytes': ..., 'deferrals': ...}
+        self.subvolumes: Dict[str, dict] = {}
+        # Bytes sent and seconds taken by the last run that sent anything
+        self.throughput: Optional[Tuple[int, float]] = None
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with self.path.open() as f:
+                history = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print("Can't read transfer history:", repr(e))
+            return
+        if history.get('version') != TRANSFER_HISTORY_VERSION:
+            return
+        self.subvolumes = history['subvolumes']
+        if history.get('throughput'):
+            self.throughput = tuple(history['throughput'])
+
+    def save(self):
+        if self.path is None:
+            return
+        history = {
+            'version': TRANSFER_HISTORY_VERSION,
+            'subvolumes': self.subvolumes,
+            'throughput': self.throughput,
+        }
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with temp_path.open('w') as f:
+                json.dump(history, f)
+            temp_path.rename(self.path)
+        except OSError as e:
+            print("Can't save transfer history:", repr(e))
+
+    def last_size(self, key: str) -> Optional[int]:
+        return self.subvolumes.get(key, {}).get('bytes')
+
+    def deferrals(self, key: str) -> int:
+        return self.subvolumes.get(key, {}).get('deferrals', 0)
+
+    def record_sent(self, key: str, size: Optional[int]):
+        entry = self.subvolumes.setdefault(key, {})
+        entry['deferrals'] = 0
+        if size is not None:
+            entry['bytes'] = size
+
+    def record_deferred(self, key: str):
+        entry = self.subvolumes.setdefault(key, {})
+        entry['deferrals'] = entry.get('deferrals', 0) + 1
+
+    def record_run(self, size: int, seconds: float):
+        if size and seconds > 0:
+            self.throughput = (size, seconds)
+
+    def bytes_per_second(self) -> Optional[float]:
+        if self.throughput is None:
+            return None
+        size, seconds = self.throughput
+        return size / seconds
+
+def subvolume_generation(path: Path) -> Optional[int]:
+    try:
+        output = check_output(BTRFS_SHOW_COMMAND + [str(path)], stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        return None
+    m = GENERATION_PATTERN.search(output.decode('utf-8', errors='replace'))
+    return int(m.group(1)) if m else None
+
+def changed_bytes(path: Path, generation: int) -> Optional[int]:
+    """
+    :return: Total length of the file extents in `path` written after
+    `generation`
+    """
+    command = BTRFS_FIND_NEW_COMMAND + [str(path), str(generation)]
+    try:
+        proc = Popen(command, stdout=PIPE, stderr=DEVNULL)
+    except OSError:
+        return None
+    total = 0
+    # One line per extent, so this can be long; don't hold it all
+    with proc.stdout:
+        for line in proc.stdout:
+            m = FIND_NEW_LENGTH_PATTERN.search(line)
+            if m:
+                total += int(m.group(1))
+    if proc.wait():
+        return None
+    return total
+
+def subvolume_size(path: Path) -> Optional[int]:
+    try:
+        output = check_output(BTRFS_DU_COMMAND + [str(path)], stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        return None
+    # Header, then "<total> <exclusive> <set shared> <path>"
+    lines = output.decode('utf-8', errors='replace').splitlines()
+    try:
+        return int(lines[1].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+def estimate_send_size(snapshot: Subvolume, parent: Optional[str]) -> Tuple[Optional[int], Optional[str]]:
+    """
+    :return: Estimated size of the stream that sending the newest snapshot
+    incrementally from `parent` (None for a full send) would produce, and
+    how it was estimated; (None, None) if btrfs can't tell us
+    """
+    newest = snapshot.cwd / snapshot.newest
+    if parent is None:
+        size = subvolume_size(newest)
+        return size, None if size is None else ESTIMATE_DU
+    generation = subvolume_generation(snapshot.cwd / parent)
+    if generation is None:
+        return None, None
+    size = changed_bytes(newest, generation)
+    return size, None if size is None else ESTIMATE_FIND_NEW
+
+def estimate_planned(planned: PlannedTransfer) -> Tuple[Optional[int], Optional[str]]:
+    """
+    :return: The largest estimate of the streams `planned` needs; with
+    fan-out, that's the one the others wait for
+    """
+    best = None, None
+    for parent in planned.parents():
+        size, source = estimate_send_size(planned.snapshot, parent)
+        if size is None:
+            return None, None
+        if best[0] is None or size > best[0]:
+            best = size, source
+    return best
+
+def make_plan(
+        pending: Iterable[PlannedTransfer],
+        settings: PlanSettings,
+        history: TransferHistory,
+) -> List[PlannedTransfer]:
+    """
+    Estimate, order and budget the pending transfers
+
+    :return: All of them, in the order they should be sent; those that
+    don't fit the budget have `deferred` set
+    """
+    plan = list(pending)
+    for planned in plan:
+        planned.deferrals = history.deferrals(planned.key)
+        if settings.estimate:
+            planned.estimate, planned.estimate_source = estimate_planned(planned)
+        if planned.estimate is None:
+            planned.estimate = history.last_size(planned.key)
+            planned.estimate_source = None if planned.estimate is None else ESTIMATE_HISTORY
+
+    def overdue(planned: PlannedTransfer) -> bool:
+        return bool(settings.max_deferrals) and planned.deferrals >= settings.max_deferrals
+
+    def size_key(planned: PlannedTransfer):
+        # Unknown sizes last
+        return planned.estimate is None, planned.estimate or 0
+
+    if settings.order == ORDER_SMALLEST_FIRST:
+        plan.sort(key=lambda planned: (not overdue(planned), size_key(planned)))
+    elif settings.order == ORDER_PRIORITY:
+        plan.sort(key=lambda planned: (not overdue(planned), -planned.priority, size_key(planned)))
+    else:
+        plan.sort(key=lambda planned: not overdue(planned))
+
+    budget = settings.byte_budget
+    if settings.time_budget:
+        rate = history.bytes_per_second()
+        if rate is None:
+            print('No throughput from previous runs; the time budget only applies while running')
+        else:
+            time_bytes = int(settings.time_budget * rate)
+            budget = min(budget, time_bytes) if budget else time_bytes
+    if budget:
+        planned_bytes = 0
+        for planned in plan:
+            size = planned.estimate or 0
+            if planned_bytes + size > budget and not overdue(planned):
+                planned.deferred = True
+            else:
+                planned_bytes += size
+    return plan
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return 'unknown'
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TiB'.format(size)
+
+def print_plan(plan: List[PlannedTransfer], settings: PlanSettings):
+    if not plan:
+        return
+    print('Transfer plan ({}):'.format(settings.order))
+    for i, planned in enumerate(plan, 1):
+        print(
+            '  {}. {}: {} (from {}), {}{}{}'.format(
+                i,
+                planned.key,
+                planned.snapshot.newest,
+                ', '.join(parent or 'scratch' for parent in planned.parents()),
+                format_size(planned.estimate),
+                '' if planned.estimate_source is None else ' by ' + planned.estimate_source,
+                ', DEFERRED to the next run' if planned.deferred else '',
+            )
+        )
+    total = sum(planned.estimate or 0 for planned in plan if not planned.deferred)
+    print('  About {} to send'.format(format_size(total)))
+
+def export_plan(plan: List[PlannedTransfer], settings: PlanSettings):
+    """
+    Write the plan as JSON to the configured path, if any
+    """
+    if settings.export_path is None:
+        return
+    export = {
+        'version': PLAN_EXPORT_VERSION,
+        'created': time(),
+        'order': settings.order,
+        'byte_budget': settings.byte_budget,
+        'time_budget': settings.time_budget,
+        'transfers': [planned.describe() for planned in plan],
+    }
+    temp_path = settings.export_path.with_name(settings.export_path.name + '.tmp')
+    try:
+        settings.export_path.parent.mkdir(parents=True, exist_ok=True)
+        with temp_path.open('w') as f:
+            json.dump(export, f, indent=2)
+        temp_path.rename(settings.export_path)
+    except OSError as e:
+        print("Can't export transfer plan:", repr(e))
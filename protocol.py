@@ -0,0 +1,373 @@
+"""
+Framed protocol that carries control messages and `btrfs send` streams over
+the single control connection.
+
+Session outline:
+ 1. The client sends a hello line, `{"protocols": [...]}`, listing the
+    protocols it supports in order of preference.
+ 2. The server answers with a JSON line. If it picked the multiplexed
+    protocol, the answer contains `"protocol": "multiplexed"` and everything
+    after it is framed. Otherwise it contains `new_port`, and the transfer
+    happens over a second connection like it always has. Servers that predate
+    this module never read the hello line and always answer with `new_port`;
+    clients that predate it never send a hello line, which the server
+    notices after HELLO_TIMEOUT seconds.
+ 3. For each snapshot, the client sends a 'send' control message, waits for a
+    'ready' reply, streams DATA frames and an END frame, and then reads the
+    'result' message. Any number of snapshots can follow on the same session.
+    Between transfers, the client may also send 'inventory' (see
+    inventory.py) or 'ping' messages; the latter are answered with 'pong'
+    and keep an idle session open.
+
+Every frame is a FRAME_HEADER (type, payload length) followed by the payload.
+Control and END payloads are JSON. If the hello and welcome messages agreed on
+a compression codec, stream blocks may instead be sent as COMPRESSED frames,
+whose payload is a one-byte codec ID followed by the compressed block.
+
+Striped transfers (see striping.py) spread one stream over several extra
+connections. The 'send' message asks for up to `stripes` of them; if the
+'ready' reply includes a `stripe_token`, the client opens each stripe as a
+new connection whose hello line is `{"protocols": ["stripe"], "stripe":
+token}`, and sends the stream as CHUNK frames spread across the stripes,
+each ending with an END frame. The payload of a CHUNK frame is a
+CHUNK_HEADER (sequence number, codec ID or 0 if uncompressed) followed by the
+data. The END frame on the control connection then says how many chunks
+there were.
+
+Deduplicated transfers (see dedup.py) send HASHES frames, whose payload is
+the digests of a batch of chunks. The server answers each with a 'want'
+control message listing the indices of the chunks it doesn't have, which the
+client then sends as DATA or COMPRESSED frames.
+"""
+import fcntl
+import select
+import socket
+import struct
+import termios
+from time import perf_counter
+from typing import Optional, Tuple
+
+from btrfs_incremental_send import deserialize_json, serialize_json
+from buffer_pool import buffer_pool
+from compression import CODECS_BY_ID, AdaptiveCompressor, DecompressionError
+from copy_engine import CopyResult, bulk_copy, can_kernel_copy, write_all
+
+PROTOCOL_MULTIPLEXED = 'multiplexed'
+PROTOCOL_TWO_PORT = 'two-port'
+# Only used in the hello line of a stripe connection
+PROTOCOL_STRIPE = 'stripe'
+# In order of preference
+SUPPORTED_PROTOCOLS = [PROTOCOL_MULTIPLEXED, PROTOCOL_TWO_PORT]
+
+# Seconds to wait for a client's hello line before assuming it's a client
+# that predates the multiplexed protocol
+HELLO_TIMEOUT = 5
+MAX_LINE_LENGTH = 1 << 16
+
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_CONTROL = 1
+FRAME_DATA = 2
+FRAME_END = 3
+FRAME_COMPRESSED = 4
+FRAME_CHUNK = 5
+FRAME_HASHES = 6
+COMPRESSED_HEADER = struct.Struct('!B')
+CHUNK_HEADER = struct.Struct('!QB')
+
+MAX_FRAME_SIZE = 1 << 20
+# Control and END payloads are read into memory whole. Longer than
+# MAX_LINE_LENGTH, since an inventory reply lists every snapshot the server
+# holds; the same as the asyncio server's limit on any frame.
+MAX_MESSAGE_LENGTH = 1 << 20
+
+class ProtocolError(Exception):
+    pass
+
+class ConnectionClosed(ProtocolError):
+    pass
+
+class ReceivedStream:
+    __slots__ = ['copy_result', 'end_summary', 'wire_bytes', 'decompress_seconds']
+
+    def __init__(self, copy_result: CopyResult, end_summary: dict, wire_bytes: int, decompress_seconds: float):
+        # Counts bytes after decompression, i.e. what `btrfs receive` saw
+        self.copy_result = copy_result
+        # From the sender's END frame
+        self.end_summary = end_summary
+        # Frame payload bytes, i.e. what actually crossed the network
+        self.wire_bytes = wire_bytes
+        self.decompress_seconds = decompress_seconds
+
+def decompress_block(codec_id: int, data, max_size: Optional[int] = None) -> bytes:
+    """
+    :param max_size: Largest block the sender could have compressed (by
+    default MAX_FRAME_SIZE); anything that decompresses to more is rejected
+    """
+    if max_size is None:
+        max_size = MAX_FRAME_SIZE
+    codec = CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ProtocolError('Unknown compression codec {}'.format(codec_id))
+    try:
+        return codec.decompress(data, max_size)
+    except DecompressionError as e:
+        raise ProtocolError('Bad compressed block: {}'.format(e)) from e
+
+def recv_line(conn: socket.socket) -> bytes:
+    """
+    Read a newline-terminated line one byte at a time, so that nothing after
+    the line is consumed. Only used for the short hello/welcome lines.
+    """
+    line = bytearray()
+    while not line.endswith(b'\n'):
+        if len(line) > MAX_LINE_LENGTH:
+            raise ProtocolError('Line too long')
+        byte = conn.recv(1)
+        if not byte:
+            raise ConnectionClosed('Connection closed while reading line')
+        line += byte
+    return bytes(line)
+
+def read_hello(conn: socket.socket) -> Optional[dict]:
+    """
+    :return: The client's hello message, or None if the client didn't
+    send one within HELLO_TIMEOUT seconds
+    """
+    previous_timeout = conn.gettimeout()
+    conn.settimeout(HELLO_TIMEOUT)
+    try:
+        return deserialize_json(recv_line(conn))
+    except socket.timeout:
+        return None
+    finally:
+        conn.settimeout(previous_timeout)
+
+def choose_protocol(hello: Optional[dict]) -> str:
+    offered = [] if hello is None else hello.get('protocols', [])
+    for protocol in SUPPORTED_PROTOCOLS:
+        if protocol in offered:
+            return protocol
+    return PROTOCOL_TWO_PORT
+
+def recv_into_exactly(conn: socket.socket, view: memoryview):
+    """
+    Fill all of `view` from `conn`
+    """
+    size = len(view)
+    received = 0
+    while received < size:
+        n = conn.recv_into(view[received:] if received else view)
+        if not n:
+            raise ConnectionClosed(
+                'Connection closed after {} of {} bytes'.format(received, size)
+            )
+        received += n
+
+def recv_exactly(conn: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    recv_into_exactly(conn, memoryview(data))
+    return bytes(data)
+
+def send_frame(conn: socket.socket, frame_type: int, payload: bytes = b''):
+    conn.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+def recv_frame_header(conn: socket.socket) -> Tuple[int, int]:
+    return FRAME_HEADER.unpack(recv_exactly(conn, FRAME_HEADER.size))
+
+def recv_json_payload(conn: socket.socket, length: int) -> dict:
+    """
+    Read the JSON payload of a control or END frame, once its header says
+    it's `length` bytes
+    """
+    if length > MAX_MESSAGE_LENGTH:
+        raise ProtocolError('Message too long: {}'.format(length))
+    return deserialize_json(recv_exactly(conn, length))
+
+def send_message(conn: socket.socket, message: dict):
+    send_frame(conn, FRAME_CONTROL, serialize_json(message))
+
+def recv_message(conn: socket.socket) -> dict:
+    frame_type, length = recv_frame_header(conn)
+    if frame_type != FRAME_CONTROL:
+        raise ProtocolError('Expected control frame, got type {}'.format(frame_type))
+    return recv_json_payload(conn, length)
+
+def send_data_frame(conn: socket.socket, data, compressor: Optional[AdaptiveCompressor] = None):
+    """
+    Send `data` as one DATA frame, or a COMPRESSED frame if `compressor`
+    thinks that's worth it
+    """
+    compressed = None
+    if compressor is not None:
+        compressed = compressor.compress(data)
+    start = perf_counter()
+    if compressed is None:
+        conn.sendall(FRAME_HEADER.pack(FRAME_DATA, len(data)))
+        conn.sendall(data)
+    else:
+        conn.sendall(
+            FRAME_HEADER.pack(FRAME_COMPRESSED, COMPRESSED_HEADER.size + len(compressed))
+            + COMPRESSED_HEADER.pack(compressor.codec.codec_id)
+        )
+        conn.sendall(compressed)
+    if compressor is not None:
+        compressor.record_send(perf_counter() - start)
+
+def send_end(conn: socket.socket, summary: dict):
+    send_frame(conn, FRAME_END, serialize_json(summary))
+
+def _merge_strategy(current: Optional[str], new: str) -> str:
+    if current is None or current == new:
+        return new
+    strategies = set(current.split('/'))
+    strategies.add(new)
+    return '/'.join(sorted(strategies))
+
+def _pipe_bytes_available(fd: int) -> int:
+    """
+    Block until the pipe has data or is closed on the write end.
+    :return: Number of bytes that can be read without blocking; 0 means EOF
+    """
+    select.select([fd], [], [])
+    buf = fcntl.ioctl(fd, termios.FIONREAD, b'\0\0\0\0')
+    return struct.unpack('i', buf)[0]
+
+def _send_stream_kernel(read_from, conn: socket.socket, meter, frame_size: int) -> CopyResult:
+    # Frame headers go out ahead of each payload, so we need to know how
+    # much the pipe can give us before telling the kernel to move it
+    fd = read_from.fileno()
+    sent = 0
+    strategy = None
+    while True:
+        available = _pipe_bytes_available(fd)
+        if not available:
+            break
+        size = min(available, frame_size)
+        conn.sendall(FRAME_HEADER.pack(FRAME_DATA, size))
+        result = bulk_copy(read_from, conn, limit=size, meter=meter)
+        strategy = _merge_strategy(strategy, result.strategy)
+        sent += result.bytes_copied
+    return CopyResult(strategy or 'splice', sent)
+
+def send_stream(
+        read_from,
+        conn: socket.socket,
+        compressor: Optional[AdaptiveCompressor] = None,
+        meter=None,
+        frame_size: Optional[int] = None,
+) -> CopyResult:
+    """
+    Send everything from `read_from` as DATA (or COMPRESSED) frames. The END
+    frame is left to the caller, which usually has more to say about how the
+    stream ended.
+
+    :param meter: If given, a `meter.TransferMeter` updated with the
+    uncompressed size of each frame
+    :param frame_size: Largest payload per frame (before compression), e.g.
+    from link_tuning; at most (and by default) MAX_FRAME_SIZE, which is all
+    the receiver accepts
+    """
+    frame_size = min(frame_size or MAX_FRAME_SIZE, MAX_FRAME_SIZE)
+    if compressor is None and can_kernel_copy(read_from, conn):
+        return _send_stream_kernel(read_from, conn, meter, frame_size)
+
+    with buffer_pool.lease(FRAME_HEADER.size + frame_size) as view:
+        return _send_stream_frames(read_from, conn, compressor, meter, frame_size, view)
+
+def _send_stream_frames(
+        read_from,
+        conn: socket.socket,
+        compressor: Optional[AdaptiveCompressor],
+        meter,
+        frame_size: int,
+        view: memoryview,
+) -> CopyResult:
+    # Each frame header goes in front of its payload in `view`, so an
+    # uncompressed frame is a single send
+    payload = view[FRAME_HEADER.size:]
+    sent = 0
+    while True:
+        n = read_from.readinto(payload)
+        if not n:
+            break
+        if compressor is not None:
+            # Pipes hand over at most 64 KiB at a time, which is too small a
+            # block to compress well
+            while n < frame_size:
+                more = read_from.readinto(payload[n:])
+                if not more:
+                    break
+                n += more
+        sent += n
+        compressed = None
+        if compressor is not None:
+            compressed = compressor.compress(payload[:n])
+        start = perf_counter()
+        if compressed is None:
+            FRAME_HEADER.pack_into(view, 0, FRAME_DATA, n)
+            conn.sendall(view[:FRAME_HEADER.size + n])
+        else:
+            conn.sendall(
+                FRAME_HEADER.pack(FRAME_COMPRESSED, COMPRESSED_HEADER.size + len(compressed))
+                + COMPRESSED_HEADER.pack(compressor.codec.codec_id)
+            )
+            conn.sendall(compressed)
+        if compressor is not None:
+            compressor.record_send(perf_counter() - start)
+        if meter is not None:
+            meter.update(n)
+    return CopyResult('readinto', sent)
+
+def receive_stream(conn: socket.socket, write_to, meter=None) -> ReceivedStream:
+    """
+    Copy DATA and COMPRESSED frames from `conn` into `write_to` until an
+    END frame arrives.
+
+    :param meter: If given, a `meter.TransferMeter` updated with the
+    uncompressed size of each frame
+    """
+    with buffer_pool.lease(MAX_FRAME_SIZE + COMPRESSED_HEADER.size) as buffer:
+        return _receive_stream_frames(conn, write_to, meter, buffer)
+
+def _receive_stream_frames(conn: socket.socket, write_to, meter, buffer: memoryview) -> ReceivedStream:
+    # Frame headers are read into the start of `buffer` too, so that no
+    # buffer is allocated per frame
+    header = buffer[:FRAME_HEADER.size]
+    received = 0
+    wire_bytes = 0
+    decompress_seconds = 0.0
+    strategy = None
+    while True:
+        recv_into_exactly(conn, header)
+        frame_type, length = FRAME_HEADER.unpack_from(header)
+        if frame_type == FRAME_END:
+            summary = recv_json_payload(conn, length)
+            return ReceivedStream(
+                CopyResult(strategy or 'readinto', received),
+                summary,
+                wire_bytes,
+                decompress_seconds,
+            )
+        if frame_type == FRAME_DATA:
+            result = bulk_copy(conn, write_to, limit=length, buffer=buffer, meter=meter)
+            if result.bytes_copied != length:
+                raise ConnectionClosed('Connection closed in the middle of a frame')
+            strategy = _merge_strategy(strategy, result.strategy)
+            received += length
+        elif frame_type == FRAME_COMPRESSED:
+            if length > len(buffer):
+                raise ProtocolError('Compressed frame too large: {}'.format(length))
+            frame = buffer[:length]
+            recv_into_exactly(conn, frame)
+            codec_id, = COMPRESSED_HEADER.unpack_from(frame)
+            start = perf_counter()
+            data = decompress_block(codec_id, frame[COMPRESSED_HEADER.size:])
+            decompress_seconds += perf_counter() - start
+            write_all(write_to, data)
+            strategy = _merge_strategy(strategy, 'decompress')
+            received += len(data)
+            if meter is not None:
+                meter.update(len(data))
+        else:
+            raise ProtocolError('Unexpected frame type {} in stream'.format(frame_type))
+        wire_bytes += length
@@ -0,0 +1,282 @@
+"""
+Background deletion of old snapshots.
+
+After a snapshot is sent, the `.keep` file is moved to it straight away (in
+the transfer's thread, since the next run depends on it), but the extra
+snapshots are only queued for deletion. A worker thread deletes them in
+batches, one `btrfs subvolume delete` per snapshot directory per batch,
+optionally waiting between batches so that the btrfs cleaner isn't
+competing with `btrfs send` for the disk the whole time.
+
+The queue is kept in a journal file, rewritten atomically whenever it
+changes, so deletions that were queued but not done when the process
+stopped are picked up by the next run. Those in a snapshot directory that
+isn't there (an automount path that isn't mounted yet) wait until
+`recheck_directories` is called, after the next mount.
+"""
+import json
+import os
+from pathlib import Path
+from threading import Condition, Thread
+from time import sleep
+from typing import Dict, List, Optional, Set, Tuple
+
+from btrfs_incremental_send import (
+    BTRFS_DELETE_COMMIT_FLAGS,
+    Subvolume,
+    delete_snapshots,
+    prunable_snapshots,
+    snapshots_with_keep_files,
+    update_keep_file,
+)
+from tracing import tracer
+
+PRUNE_JOURNAL_PATH = Path('/var/lib/btrfs-syncd/pending-deletions.json')
+PRUNE_JOURNAL_VERSION = 1
+# Snapshots per `btrfs subvolume delete`
+DEFAULT_PRUNE_BATCH_SIZE = 32
+
+# (snapshot directory, snapshot name)
+PendingDeletion = Tuple[str, str]
+
+class PruneSettings:
+    __slots__ = ['journal_path', 'batch_size', 'commit', 'delay', 'background']
+
+    def __init__(
+            self,
+            journal_path: Optional[Path] = PRUNE_JOURNAL_PATH,
+            batch_size: int = DEFAULT_PRUNE_BATCH_SIZE,
+            commit: Optional[str] = None,
+            delay: float = 0.0,
+            background: bool = True,
+    ):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        # None, 'after' or 'each'; see btrfs_incremental_send.delete_snapshots
+        self.commit = commit
+        # Seconds to wait after each batch
+        self.delay = delay
+        self.background = background
+
+    @classmethod
+    def from_config(cls, config) -> 'PruneSettings':
+        """
+        :param config: Client config; reads the optional [prune] section
+        """
+        if 'prune' not in config:
+            return cls()
+        section = config['prune']
+        commit = section.get('commit', 'none')
+        if commit == 'none':
+            commit = None
+        elif commit not in BTRFS_DELETE_COMMIT_FLAGS:
+            raise ValueError("Unknown 'commit' setting in [prune]: {}".format(commit))
+        return cls(
+            Path(section.get('journal', str(PRUNE_JOURNAL_PATH))),
+            section.getint('batch size', DEFAULT_PRUNE_BATCH_SIZE),
+            commit,
+            section.getfloat('delay', 0.0),
+            section.getboolean('background', True),
+        )
+
+def has_pending_deletions(journal_path: Optional[Path]) -> bool:
+    """
+    :return: Whether a previous run left deletions in the journal, without
+    loading it into a PruneQueue
+    """
+    if journal_path is None:
+        return False
+    try:
+        with journal_path.open() as f:
+            journal = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError):
+        # PruneQueue.load will complain about it
+        return True
+    return bool(journal.get('pending'))
+
+class PruneQueue:
+    """
+    Snapshots waiting to be deleted, and the thread that deletes them
+    """
+    def __init__(self, settings: PruneSettings):
+        self.settings = settings
+        self.cond = Condition()
+        # Oldest first; dict for ordering and deduplication
+        self.pending: Dict[PendingDeletion, None] = {}
+        # Failed in this run; left in the journal for the next one
+        self.failed: Set[PendingDeletion] = set()
+        # Snapshot directories that weren't there, e.g. not mounted yet;
+        # their deletions wait for `recheck_directories`
+        self.unavailable: Set[str] = set()
+        self.closing = False
+        self.deleted = 0
+        self.worker: Optional[Thread] = None
+
+    def load(self):
+        """
+        Pick up deletions left over from a previous run
+        """
+        if self.settings.journal_path is None:
+            return
+        try:
+            with self.settings.journal_path.open() as f:
+                journal = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print("Can't read pending deletions:", repr(e))
+            return
+        if journal.get('version') != PRUNE_JOURNAL_VERSION:
+            return
+        with self.cond:
+            for cwd, name in journal['pending']:
+                self.pending[(cwd, name)] = None
+        if self.pending:
+            print('Resuming {} pending snapshot deletion(s)'.format(len(self.pending)))
+
+    def _save(self):
+        """
+        Caller must hold `cond`
+        """
+        journal_path = self.settings.journal_path
+        if journal_path is None:
+            return
+        journal = {
+            'version': PRUNE_JOURNAL_VERSION,
+            'pending': [list(item) for item in self.pending],
+        }
+        temp_path = journal_path.with_name(journal_path.name + '.tmp')
+        try:
+            journal_path.parent.mkdir(parents=True, exist_ok=True)
+            with temp_path.open('w') as f:
+                json.dump(journal, f)
+                f.flush()
+                os.fsync(f.fileno())
+            temp_path.rename(journal_path)
+        except OSError as e:
+            # The extra snapshots are found again after the next transfer
+            # of the same subvolume, so this only delays their deletion
+            print("Can't save pending deletions:", repr(e))
+
+    def start(self):
+        self.worker = Thread(target=self._run, name='prune-queue')
+        self.worker.start()
+
+    def schedule(self, snapshot: Subvolume):
+        """
+        Move the `.keep` file to the newest snapshot, then queue the extra
+        snapshots for deletion
+        """
+        update_keep_file(snapshot)
+        extra = prunable_snapshots(snapshot)
+        if not extra:
+            print('Nothing to delete for subvolume', snapshot.newest)
+            return
+        with self.cond:
+            for name in extra:
+                self.pending[(str(snapshot.cwd), name)] = None
+            self._save()
+            self.cond.notify_all()
+        print('Queued {} snapshot(s) for deletion'.format(len(extra)))
+
+    def _next_batch(self) -> Optional[List[PendingDeletion]]:
+        """
+        :return: Up to `batch_size` pending deletions from one directory, or
+        None once closing and nothing is left
+        """
+        with self.cond:
+            while True:
+                available = [
+                    item for item in self.pending
+                    if item not in self.failed and item[0] not in self.unavailable
+                ]
+                if available:
+                    cwd = available[0][0]
+                    batch = [item for item in available if item[0] == cwd]
+                    return batch[:self.settings.batch_size]
+                if self.closing:
+                    return None
+                self.cond.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            cwd = Path(batch[0][0])
+            names = []
+            done = []
+            if not cwd.is_dir():
+                # Probably not mounted (yet); keep these for later
+                print('Snapshot directory {} not available; not deleting from it yet'.format(cwd))
+                with self.cond:
+                    self.unavailable.add(batch[0][0])
+                continue
+            bases = snapshots_with_keep_files(cwd)
+            for item in batch:
+                name = item[1]
+                if not (cwd / name).exists():
+                    # Deleted before the journal caught up
+                    done.append(item)
+                elif name in bases:
+                    # A base snapshot again (or still); never delete those
+                    print('Not deleting base snapshot', cwd / name)
+                    done.append(item)
+                else:
+                    names.append(name)
+            if names:
+                try:
+                    with tracer.span('prune_batch', directory=cwd, snapshots=len(names)):
+                        delete_snapshots(cwd, names, self.settings.commit)
+                    done.extend(item for item in batch if item[1] in names)
+                    self.deleted += len(names)
+                except Exception as e:
+                    print("Couldn't delete snapshots in {}: {!r}".format(cwd, e))
+                    with self.cond:
+                        self.failed.update(item for item in batch if item[1] in names)
+            with self.cond:
+                for item in done:
+                    self.pending.pop(item, None)
+                self._save()
+            if names and self.settings.delay:
+                sleep(self.settings.delay)
+
+    def recheck_directories(self):
+        """
+        Look again for snapshot directories that weren't available, e.g.
+        after mounting a path
+        """
+        with self.cond:
+            if self.unavailable:
+                self.unavailable.clear()
+                self.cond.notify_all()
+
+    def retry_failed(self):
+        """
+        Give deletions that failed earlier another try, for a process that
+        runs longer than one backup (daemon mode)
+        """
+        with self.cond:
+            if self.failed or self.unavailable:
+                self.failed.clear()
+                self.unavailable.clear()
+                self.cond.notify_all()
+
+    def close(self):
+        """
+        Finish the queued deletions and stop the worker
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+        if self.deleted or self.failed or self.unavailable:
+            print(
+                'Deleted {} snapshot(s); {} deletion(s) left for the next run'.format(
+                    self.deleted,
+                    len(self.pending),
+                )
+            )
@@ -0,0 +1,373 @@
+"""
+Which queued receives run next, shared by both server engines.
+
+Destination paths are grouped by the device they're stored on: the source
+of the mount they're under (e.g. /dev/md0), or whatever a [path/NAME]
+section's 'device' setting says, for paths on different filesystems that
+share disks. Concurrent `btrfs receive` processes on one device seek against
+each other, so besides the global and per-client limits there's a limit per
+device.
+
+A receive that can't start right away is queued. Whenever one finishes, the
+queue is ordered by the client's configured priority (highest first), then
+by how long ago each client was last admitted (so one client with many
+snapshots to send can't starve the others), then by arrival; every queued
+receive that fits within the limits is admitted, in that order. A receive
+blocked only by its own device or client never holds up the others.
+
+How long each receive waited, and how busy its device has been (the
+fraction of time since the server started that at least one receive was
+running on it), is logged and included in the result sent to the client.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import re
+from threading import Condition
+from time import monotonic
+from typing import Callable, Dict, List, Mapping, Optional
+
+from btrfs_incremental_send import PATH_CONFIG_KEY_PATTERN
+
+# 0 means no limit
+DEFAULT_MAX_CONCURRENT_RECEIVES_PER_DEVICE = 0
+DEFAULT_PRIORITY = 0
+# For clients with no known device
+UNKNOWN_DEVICE = 'unknown'
+MOUNTINFO_PATH = Path('/proc/self/mountinfo')
+MOUNTINFO_ESCAPE_PATTERN = re.compile(r'\\([0-7]{3})')
+
+def backing_device(path: Path) -> str:
+    """
+    :return: The source of the mount that `path` is on if it's a device
+    (e.g. '/dev/sda2'; every subvolume mounted from one btrfs filesystem
+    has the same one), otherwise the mount's device number
+    """
+    path_str = os.path.realpath(str(path))
+    best = None
+    try:
+        with MOUNTINFO_PATH.open() as f:
+            for line in f:
+                fields = line.split()
+                mount_point = MOUNTINFO_ESCAPE_PATTERN.sub(lambda m: chr(int(m.group(1), 8)), fields[4])
+                prefix = mount_point.rstrip('/') + '/'
+                if path_str != mount_point and not path_str.startswith(prefix):
+                    continue
+                if best is None or len(mount_point) > len(best[0]):
+                    source = fields[fields.index('-') + 2]
+                    best = (mount_point, source if source.startswith('/') else fields[2])
+    except (OSError, IndexError, ValueError):
+        pass
+    if best is not None:
+        return best[1]
+    try:
+        st_dev = os.stat(path_str).st_dev
+    except OSError:
+        return UNKNOWN_DEVICE
+    return '{}:{}'.format(os.major(st_dev), os.minor(st_dev))
+
+def _under(limit: int, count: int) -> bool:
+    return not limit or count < limit
+
+class Ticket:
+    """
+    One receive, from when it's queued until it's released
+    """
+    __slots__ = ['client', 'device', 'priority', 'arrival', 'queued_at', 'admitted_at']
+
+    def __init__(self, client: str, device: str, priority: int, arrival: int):
+        self.client = client
+        self.device = device
+        self.priority = priority
+        self.arrival = arrival
+        self.queued_at = monotonic()
+        self.admitted_at: Optional[float] = None
+
+    @property
+    def admitted(self) -> bool:
+        return self.admitted_at is not None
+
+    @property
+    def wait_seconds(self) -> float:
+        end = monotonic() if self.admitted_at is None else self.admitted_at
+        return end - self.queued_at
+
+class DeviceStats:
+    __slots__ = ['active', 'busy_since', 'busy_seconds', 'receives', 'wait_seconds']
+
+    def __init__(self):
+        self.active = 0
+        # When `active` last went from 0 to 1
+        self.busy_since: Optional[float] = None
+        self.busy_seconds = 0.0
+        self.receives = 0
+        self.wait_seconds = 0.0
+
+class ReceiveScheduler:
+    """
+    The queue and the limits. Not thread-safe by itself: `AdmissionQueue`
+    (threading engine) and aio_server.AdmissionController (asyncio engine)
+    serialize access to it, and do the waiting.
+    """
+    def __init__(
+            self,
+            max_active: int = 0,
+            max_active_per_client: int = 0,
+            max_active_per_device: int = DEFAULT_MAX_CONCURRENT_RECEIVES_PER_DEVICE,
+            devices: Optional[Mapping[str, str]] = None,
+            priorities: Optional[Mapping[str, int]] = None,
+    ):
+        """
+        Limits of 0 mean no limit.
+
+        :param devices: Client CN -> device its path is on
+        :param priorities: Client CN -> priority; higher goes first
+        """
+        self.max_active = max_active
+        self.max_active_per_client = max_active_per_client
+        self.max_active_per_device = max_active_per_device
+        self.devices = devices or {}
+        self.priorities = priorities or {}
+        self.active = 0
+        self.active_per_client = Counter()
+        self.device_stats: Dict[str, DeviceStats] = {}
+        self.waiting: List[Ticket] = []
+        self.arrivals = 0
+        self.admissions = 0
+        # Client CN -> value of `admissions` when it was last admitted
+        self.last_admitted: Dict[str, int] = {}
+        self.started = monotonic()
+
+    @classmethod
+    def from_config(
+            cls,
+            config,
+            paths: Mapping[str, Path],
+            default_max_active: int = 0,
+            default_max_active_per_client: int = 0,
+    ) -> 'ReceiveScheduler':
+        """
+        :param config: Server config; reads the limits from [server], and
+        'device' and 'priority' from each [path/NAME] section
+        :param paths: Client CN -> destination path
+        """
+        section = config['server'] if 'server' in config else config[config.default_section]
+        devices = {}
+        priorities = {}
+        for key in config:
+            m = PATH_CONFIG_KEY_PATTERN.match(key)
+            if m and m.group(1) in paths:
+                cn = m.group(1)
+                device = config[key].get('device')
+                devices[cn] = device if device is not None else backing_device(paths[cn])
+                priorities[cn] = config[key].getint('priority', DEFAULT_PRIORITY)
+        return cls(
+            section.getint('max concurrent receives', default_max_active),
+            section.getint('max concurrent receives per client', default_max_active_per_client),
+            section.getint(
+                'max concurrent receives per device',
+                DEFAULT_MAX_CONCURRENT_RECEIVES_PER_DEVICE,
+            ),
+            devices,
+            priorities,
+        )
+
+    def print_summary(self):
+        def limit(value: int) -> str:
+            return str(value) if value else 'no limit'
+
+        print(
+            'Concurrent receives: {} overall, {} per client, {} per device'.format(
+                limit(self.max_active),
+                limit(self.max_active_per_client),
+                limit(self.max_active_per_device),
+            )
+        )
+        clients_by_device = {}
+        for client, device in self.devices.items():
+            clients_by_device.setdefault(device, []).append(client)
+        for device, clients in sorted(clients_by_device.items()):
+            print('Device {}: {}'.format(
+                device,
+                ', '.join(
+                    '{} (priority {})'.format(client, self.priorities.get(client, DEFAULT_PRIORITY))
+                    for client in sorted(clients)
+                ),
+            ))
+
+    def _stats(self, device: str) -> DeviceStats:
+        stats = self.device_stats.get(device)
+        if stats is None:
+            stats = self.device_stats[device] = DeviceStats()
+        return stats
+
+    def _can_admit(self, ticket: Ticket) -> bool:
+        return (
+            _under(self.max_active, self.active)
+            and _under(self.max_active_per_client, self.active_per_client[ticket.client])
+            and _under(self.max_active_per_device, self._stats(ticket.device).active)
+        )
+
+    def _order_key(self, ticket: Ticket):
+        return -ticket.priority, self.last_admitted.get(ticket.client, -1), ticket.arrival
+
+    def enqueue(self, client: str) -> Ticket:
+        ticket = Ticket(
+            client,
+            self.devices.get(client, UNKNOWN_DEVICE),
+            self.priorities.get(client, DEFAULT_PRIORITY),
+            self.arrivals,
+        )
+        self.arrivals += 1
+        self.waiting.append(ticket)
+        return ticket
+
+    def admit_waiting(self) -> List[Ticket]:
+        """
+        :return: Queued tickets that are now admitted, in order
+        """
+        admitted = []
+        for ticket in sorted(self.waiting, key=self._order_key):
+            if not self._can_admit(ticket):
+                continue
+            self.waiting.remove(ticket)
+            ticket.admitted_at = monotonic()
+            self.active += 1
+            self.active_per_client[ticket.client] += 1
+            self.admissions += 1
+            self.last_admitted[ticket.client] = self.admissions
+            stats = self._stats(ticket.device)
+            if not stats.active:
+                stats.busy_since = ticket.admitted_at
+            stats.active += 1
+            stats.receives += 1
+            stats.wait_seconds += ticket.wait_seconds
+            admitted.append(ticket)
+            if ticket.wait_seconds >= 0.1:
+                print(
+                    '{} admitted on {} after waiting {:.1f}s ({} active there, busy {:.0%} of the time)'.format(
+                        ticket.client,
+                        ticket.device,
+                        ticket.wait_seconds,
+                        stats.active,
+                        self.utilization(ticket.device),
+                    )
+                )
+        return admitted
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        :return: 1-based place in the queue
+        """
+        key = self._order_key(ticket)
+        return 1 + sum(1 for other in self.waiting if self._order_key(other) < key)
+
+    def cancel(self, ticket: Ticket):
+        """
+        Take a ticket that was never admitted out of the queue
+        """
+        self.waiting.remove(ticket)
+
+    def release(self, ticket: Ticket):
+        self.active -= 1
+        self.active_per_client[ticket.client] -= 1
+        if not self.active_per_client[ticket.client]:
+            del self.active_per_client[ticket.client]
+        stats = self._stats(ticket.device)
+        stats.active -= 1
+        if not stats.active:
+            stats.busy_seconds += monotonic() - stats.busy_since
+            stats.busy_since = None
+
+    def utilization(self, device: str) -> float:
+        """
+        :return: Fraction of the time since the server started that at least
+        one receive was running on `device`
+        """
+        stats = self._stats(device)
+        now = monotonic()
+        busy = stats.busy_seconds
+        if stats.busy_since is not None:
+            busy += now - stats.busy_since
+        elapsed = now - self.started
+        return busy / elapsed if elapsed > 0 else 0.0
+
+    def describe(self, ticket: Ticket) -> dict:
+        """
+        :return: For the client: how this receive was scheduled
+        """
+        stats = self._stats(ticket.device)
+        return {
+            'device': ticket.device,
+            'wait_seconds': ticket.wait_seconds,
+            'device_active': stats.active,
+            'device_utilization': self.utilization(ticket.device),
+            'device_average_wait_seconds': stats.wait_seconds / max(stats.receives, 1),
+        }
+
+class AdmissionQueue:
+    """
+    Threading engine front end: blocks the handler's thread while queued
+    """
+    def __init__(self, scheduler: ReceiveScheduler):
+        self.scheduler = scheduler
+        self.cond = Condition()
+
+    def _wake(self):
+        """
+        Caller must hold `cond`
+        """
+        if self.scheduler.admit_waiting():
+            # Everyone else's position may have changed too
+            self.cond.notify_all()
+
+    def acquire(self, client: str, report: Optional[Callable[[Ticket, int], None]] = None) -> Ticket:
+        """
+        Wait for a slot for `client`.
+
+        :param report: Called with the ticket and its 1-based queue position
+        whenever the latter changes while waiting
+        """
+        with self.cond:
+            ticket = self.scheduler.enqueue(client)
+            self._wake()
+            try:
+                last_position = None
+                while not ticket.admitted:
+                    position = self.scheduler.position(ticket)
+                    if report is not None and position != last_position:
+                        last_position = position
+                        self.cond.release()
+                        try:
+                            report(ticket, position)
+                        finally:
+                            self.cond.acquire()
+                        # Things may have moved while we were reporting
+                        continue
+                    self.cond.wait()
+            except BaseException:
+                if ticket.admitted:
+                    self.scheduler.release(ticket)
+                else:
+                    self.scheduler.cancel(ticket)
+                self._wake()
+                self.cond.notify_all()
+                raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        with self.cond:
+            self.scheduler.release(ticket)
+            self._wake()
+
+    @contextmanager
+    def slot(self, client: str, report: Optional[Callable[[Ticket, int], None]] = None):
+        """
+        `with admission.slot(client) as ticket:` around a receive
+        """
+        ticket = self.acquire(client, report)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,205 @@
+"""
+Resumable transfers.
+
+With spooling enabled, the server writes the incoming stream to a staging
+file instead of straight into `btrfs receive`, recording a checkpoint (the
+number of bytes known to be on disk) every CHECKPOINT_INTERVAL bytes. If the
+connection drops, the client reconnects, is told the checkpointed offset, runs
+the same `btrfs send` again and skips that many bytes of the (deterministic)
+stream. `btrfs receive` only runs once the whole stream is spooled and its
+length and digest match what the client says it sent.
+"""
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+from time import time
+from typing import Optional
+
+from buffer_pool import buffer_pool
+from copy_engine import CopyResult
+from digest import HashingReader, StreamDigest
+
+STREAM_DIGEST_ALGORITHM = 'sha256'
+
+CHECKPOINT_INTERVAL = 1 << 26
+# Spools that haven't been touched in this long are assumed to be abandoned
+SPOOL_MAX_AGE = 7 * 24 * 60 * 60
+
+SPOOL_EXTENSION = '.spool'
+CHECKPOINT_EXTENSION = '.checkpoint'
+
+READ_BUFFER_SIZE = 1 << 20
+
+def transfer_id(snapshot: str, parent: Optional[str]) -> str:
+    """
+    Identifies a `btrfs send` stream; the same snapshot and parent produce
+    the same stream.
+    """
+    key = '{}\0{}'.format(snapshot, parent or '')
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def skip_stream_prefix(read_from, count: int, hasher) -> int:
+    """
+    Read and discard the first `count` bytes of `read_from`, which the server
+    already has, hashing them so the digest still covers the whole stream.
+
+    :return: Number of bytes skipped, which is less than `count` only if the
+    stream ended early
+    """
+    skipped = 0
+    with buffer_pool.lease(READ_BUFFER_SIZE) as view:
+        while skipped < count:
+            n = read_from.readinto(view[:min(READ_BUFFER_SIZE, count - skipped)])
+            if not n:
+                break
+            hasher.update(view[:n])
+            skipped += n
+    return skipped
+
+def resumable_copy(read_from, conn, offset: int, hasher, copy) -> CopyResult:
+    """
+    For use as the `copy` argument of `send_snapshot`: skip what the server
+    already has, then send the rest with `copy(read_from, conn)`.
+
+    :return: Copy result covering the whole stream, including skipped bytes
+    """
+    skipped = skip_stream_prefix(read_from, offset, hasher)
+    if skipped:
+        print('Skipped {} bytes already spooled on the server'.format(skipped))
+    result = copy(HashingReader(read_from, hasher), conn)
+    return CopyResult(result.strategy, skipped + result.bytes_copied)
+
+class Spool:
+    """
+    One partially received stream on the server. Open with `open()`, feed
+    with `write()`, and then either `verify()` and `reader()` it into
+    `btrfs receive`, or leave it for the client to resume.
+    """
+    def __init__(self, spool_dir: Path, transfer_id: str, checkpoint_interval: int = CHECKPOINT_INTERVAL):
+        self.spool_dir = spool_dir
+        self.data_path = spool_dir / (transfer_id + SPOOL_EXTENSION)
+        self.checkpoint_path = spool_dir / (transfer_id + CHECKPOINT_EXTENSION)
+        self.checkpoint_interval = checkpoint_interval
+        self.file = None
+        self.hasher = StreamDigest(STREAM_DIGEST_ALGORITHM)
+        self.size = 0
+        self.committed = 0
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with self.checkpoint_path.open() as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return 0
+        if checkpoint.get('digest_algorithm') != STREAM_DIGEST_ALGORITHM:
+            return 0
+        return checkpoint['offset']
+
+    def open(self) -> int:
+        """
+        :return: Offset to resume from, i.e. the last checkpoint
+        """
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        offset = self._read_checkpoint()
+        self.file = open(str(self.data_path), 'ab+', buffering=0)
+        if os.fstat(self.file.fileno()).st_size < offset:
+            # Checkpoint is ahead of the data; shouldn't happen since the
+            # data is synced first, but start over if it does
+            offset = 0
+        # Anything past the checkpoint may not have made it to disk intact
+        self.file.truncate(offset)
+        self.file.seek(0)
+        # The digest has to cover the whole stream, so rehash what we already
+        # have. Resumes are rare enough for this not to matter.
+        remaining = offset
+        with buffer_pool.lease(READ_BUFFER_SIZE) as view:
+            while remaining:
+                n = self.file.readinto(view[:min(READ_BUFFER_SIZE, remaining)])
+                if not n:
+                    raise IOError('Spool file {} shorter than expected'.format(self.data_path))
+                self.hasher.update(view[:n])
+                remaining -= n
+        self.size = self.committed = offset
+        return offset
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        total = len(view)
+        while view:
+            written = self.file.write(view)
+            self.hasher.update(view[:written])
+            view = view[written:]
+        self.size += total
+        if self.size - self.committed >= self.checkpoint_interval:
+            self.checkpoint()
+        return total
+
+    def checkpoint(self):
+        """
+        Make everything written so far durable, and record its length
+        """
+        if self.file is None or self.size == self.committed:
+            return
+        os.fsync(self.file.fileno())
+        temp_path = self.checkpoint_path.with_suffix('.tmp')
+        with temp_path.open('w') as f:
+            json.dump(
+                {
+                    'offset': self.size,
+                    'digest_algorithm': STREAM_DIGEST_ALGORITHM,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        temp_path.rename(self.checkpoint_path)
+        self.committed = self.size
+
+    def verify(self, end_summary: dict) -> Optional[str]:
+        """
+        :return: Why the spooled stream doesn't match what the client sent,
+        or None if it does
+        """
+        if end_summary.get('send_return_code'):
+            return '`btrfs send` returned {}'.format(end_summary['send_return_code'])
+        if end_summary.get('bytes_sent') != self.size:
+            return 'client sent {} bytes, spooled {}'.format(end_summary.get('bytes_sent'), self.size)
+        if end_summary.get('stream_digest') != self.hasher.hexdigest():
+            return 'stream digest mismatch'
+        return None
+
+    def reader(self) -> io.FileIO:
+        """
+        :return: Unbuffered reader for the complete stream, positioned at the
+        start, so the copy engine can splice it into `btrfs receive`
+        """
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        for path in [self.data_path, self.checkpoint_path]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+def remove_stale_spools(spool_dir: Path, max_age: float = SPOOL_MAX_AGE):
+    if not spool_dir.is_dir():
+        return
+    cutoff = time() - max_age
+    for entry in spool_dir.iterdir():
+        if entry.suffix in {SPOOL_EXTENSION, CHECKPOINT_EXTENSION}:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    print('Removing stale spool file', entry)
+                    entry.unlink()
+            except FileNotFoundError:
+                pass
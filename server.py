@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
+from argparse import ArgumentParser
 from configparser import ConfigParser
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 import re
+import secrets
+import signal
 from socket import socket, AF_INET, SOCK_STREAM
 from socketserver import StreamRequestHandler
-import ssl
 from subprocess import PIPE, Popen
+from threading import Lock, Thread
+from time import monotonic
+from typing import Dict, Optional
 
 from btrfs_incremental_send import (
     BTRFS_RECEIVE_COMMAND,
@@ -14,8 +21,40 @@ from btrfs_incremental_send import (
     bulk_copy,
     serialize_json,
 )
+from buffer_pool import buffer_pool
+from copy_engine import CopyResult
+from compression import COMPRESSION_NONE, choose_codec
+from dedup import DedupReceiver, DedupSettings
+from digest import DigestingWriter, StreamDigest, choose_digest, describe_digest
+from inventory import SnapshotInventory
+from link_tuning import LinkSettings, LinkTuner
+from meter import TransferMeter, status_board
+from protocol import (
+    PROTOCOL_MULTIPLEXED,
+    PROTOCOL_STRIPE,
+    PROTOCOL_TWO_PORT,
+    ConnectionClosed,
+    ProtocolError,
+    choose_protocol,
+    read_hello,
+    receive_stream,
+    recv_message,
+    send_message,
+)
+from receive_scheduler import AdmissionQueue, ReceiveScheduler
+from resume import CHECKPOINT_INTERVAL, Spool, remove_stale_spools, transfer_id
 from ssl_socketserver import SSL_ThreadingTCPServer
+from staging import StagingSettings
+from striping import Reassembler, StripingSettings, receive_stripe, receive_striped_end
+from tls import timed_handshake
+from tracing import PROFILE_CPROFILE, PROFILE_NONE, PROFILE_SAMPLING, new_transfer_id, tracer
+
+ENGINE_THREADING = 'threading'
+ENGINE_ASYNCIO = 'asyncio'
 
+# Seconds to wait for the client to connect to the data port, when using the
+# two-port protocol
+DATA_CONNECTION_TIMEOUT = 60
 
 def get_common_name(cert):
     for field in cert['subject']:
@@ -44,73 +83,682 @@ def parse_config():
 
     return config, paths, key_paths
 
-def get_handler_class(paths):
+def get_spool_config(config):
+    """
+    :return: Spool directory (or None if resumable transfers are disabled),
+    and checkpoint interval in bytes
+    """
+    if 'spool' not in config:
+        return None, CHECKPOINT_INTERVAL
+    return (
+        Path(config['spool']['path']),
+        config['spool'].getint('checkpoint interval', CHECKPOINT_INTERVAL),
+    )
+
+def receive_snapshot(path: Path, copy, digest: Optional[StreamDigest] = None) -> dict:
+    """
+    Run `btrfs receive` in `path`, feeding it with `copy(proc.stdin)`.
+
+    :param copy: Returns a CopyResult
+    :param digest: If given, everything written into `btrfs receive` is
+    hashed with it, and the result includes the digest
+    :return: The result message for the client. If the copy had to stop
+    early, 'stream_broken' is set and the exception is left in 'reason'.
+    """
+    command = [
+        piece.format(path=path)
+        for piece in BTRFS_RECEIVE_COMMAND
+    ]
+
+    with tracer.span('spawn_receive'):
+        # Unbuffered, so that the copy engine can splice into the pipe
+        proc = Popen(
+            command,
+            stdin=PIPE,
+            cwd=str(path),
+            bufsize=0,
+        )
+    copy_result = None
+    stream_error = None
+    write_to = proc.stdin if digest is None else DigestingWriter(proc.stdin, digest)
+    with tracer.span('copy') as span:
+        try:
+            copy_result = copy(write_to)
+            span['bytes'] = copy_result.bytes_copied
+            span['strategy'] = copy_result.strategy
+        except (OSError, ProtocolError) as e:
+            # Most likely `btrfs receive` exited early (BrokenPipeError), or
+            # the client went away
+            stream_error = e
+            span['error'] = repr(e)
+        finally:
+            proc.stdin.close()
+    with tracer.span('receive_wait') as span:
+        return_code = proc.wait()
+        span['return_code'] = return_code
+    return receive_result(return_code, copy_result, stream_error, digest)
+
+def receive_result(
+        return_code: int,
+        copy_result: Optional[CopyResult],
+        stream_error: Optional[Exception],
+        digest: Optional[StreamDigest] = None,
+) -> dict:
+    """
+    :return: The result message for the client, given how `btrfs receive`
+    exited and how feeding it went
+    """
+    print('command returned {}'.format(return_code))
+
+    data = {
+        'return_code': return_code,
+        'success': not return_code and stream_error is None,
+    }
+    if stream_error is not None:
+        print('stream interrupted:', repr(stream_error))
+        data['stream_broken'] = True
+        data['reason'] = repr(stream_error)
+        return data
+
+    print(
+        'received {} bytes using {}'.format(
+            copy_result.bytes_copied,
+            copy_result.strategy,
+        )
+    )
+    data['bytes_received'] = copy_result.bytes_copied
+    data['copy_strategy'] = copy_result.strategy
+    if digest is not None:
+        data['stream_digest'] = digest.summary()
+        print('stream digest:', describe_digest(data['stream_digest']))
+    return data
+
+def staged_copy(copy, staging: Optional[StagingSettings], summaries: list):
+    """
+    Wrap a `copy` function for `receive_snapshot` so that it fills a staging
+    buffer, which another thread drains into `btrfs receive`.
+
+    :param summaries: The buffer's summary is appended to this
+    """
+    if staging is None:
+        return copy
+
+    def staged(write_to):
+        buffer = staging.make_buffer()
+        try:
+            return buffer.run(write_to, copy)
+        finally:
+            summary = buffer.summary()
+            print(
+                'staging: {memory_high_water} bytes in memory and {disk_high_water} on disk at most, '
+                'network waited {write_stall_seconds:.1f}s, receive waited {drain_wait_seconds:.1f}s'.format(
+                    **summary
+                )
+            )
+            summaries.append(summary)
+
+    return staged
+
+def check_end_summary(data: dict, end_summary: dict):
+    """
+    Compare the client's description of the stream it sent (from the END
+    frame) with what we received, marking the transfer as failed if they
+    disagree. `btrfs receive` may not notice a truncated stream.
+    """
+    if not end_summary:
+        return
+    if end_summary.get('send_return_code'):
+        data['success'] = False
+        data['reason'] = '`btrfs send` returned {}'.format(end_summary['send_return_code'])
+    elif end_summary.get('bytes_sent') != data.get('bytes_received'):
+        data['success'] = False
+        data['reason'] = 'client sent {} bytes, received {}'.format(
+            end_summary.get('bytes_sent'),
+            data.get('bytes_received'),
+        )
+    elif 'stream_digest' in end_summary and 'stream_digest' in data:
+        # The client checks this too, but it should show up in our log
+        if end_summary['stream_digest'] != data['stream_digest']['digest']:
+            print('stream digest mismatch')
+            data['success'] = False
+            data['reason'] = 'stream digest mismatch'
+
+def get_handler_class(
+        paths,
+        spool_root: Optional[Path] = None,
+        checkpoint_interval: int = CHECKPOINT_INTERVAL,
+        staging: Optional[StagingSettings] = None,
+        striping: Optional[StripingSettings] = None,
+        dedup: Optional[DedupSettings] = None,
+        admission: Optional[AdmissionQueue] = None,
+        link: Optional[LinkSettings] = None,
+):
+    """
+    :param paths: Client certificate CN -> destination path
+    :param spool_root: If set, clients can ask for resumable transfers,
+    which are spooled to a subdirectory of this named after the client's CN
+    :param staging: If set, streams that aren't spooled go through a
+    staging buffer, so `btrfs receive` pausing doesn't pause the network
+    :param striping: If set, clients can spread a transfer over several
+    connections
+    :param dedup: If set, clients can send deduplicated streams
+    :param admission: If set, receives wait for a slot from this
+    :param link: Socket tuning for connections; see link_tuning.py
+    """
+    link_settings = link or LinkSettings()
+    # Client CN -> throughput of its last transfer, the starting point for
+    # tuning its next connection
+    link_rates: Dict[str, float] = {}
+    # Transfer IDs currently being spooled, so that a client that reconnects
+    # while its old session is still draining can't write to the same spool
+    active_spools = set()
+    active_spools_lock = Lock()
+    # Stripe token -> (client CN, Reassembler) for striped transfers in
+    # progress
+    striped_transfers = {}
+    striped_transfers_lock = Lock()
+    inventory = SnapshotInventory()
+
     class BtrfsReceiveHandler(StreamRequestHandler):
+        # Negotiated in handle_multiplexed
+        digest_algorithm: Optional[str] = None
+
         def handle(self):
-            cn = get_common_name(self.server.client_cert)
+            self.server.record_accept(self.client_address)
+            # Not self.server.client_cert: with a threading server, that may
+            # already belong to the next connection
+            cn = get_common_name(self.request.getpeercert())
+            print('TLS handshakes:', self.server.handshake_stats)
             if cn not in paths:
                 self.wfile.write(serialize_json({'success': False, 'reason': 'bad_hostname'}))
+                return
             path = paths[cn]
             print('Path:', path)
 
+            hello = read_hello(self.request)
+            if hello is not None and 'stripe' in hello:
+                self.handle_stripe(cn, hello['stripe'])
+                return
+            self.tuner = LinkTuner(link_settings, sending=False, bandwidth=link_rates.get(cn))
+            self.tuner.start(self.request)
+            protocol = choose_protocol(hello)
+            print('Client {} using protocol {}'.format(cn, protocol))
+            if protocol == PROTOCOL_MULTIPLEXED:
+                self.handle_multiplexed(cn, path, hello)
+            else:
+                self.handle_two_port(cn, path)
+
+        def record_link(self, cn: str, meter: TransferMeter):
+            self.tuner.record_throughput(meter.bytes, monotonic() - meter.started)
+            if self.tuner.measured is not None:
+                link_rates[cn] = self.tuner.measured
+
+        def slot(self, cn: str, report=None):
+            if admission is None:
+                return nullcontext()
+            return admission.slot(cn, report)
+
+        def new_digest(self) -> Optional[StreamDigest]:
+            """
+            :return: For hashing a stream with the algorithm that was
+            negotiated for this session, if any
+            """
+            if self.digest_algorithm is None:
+                return None
+            return StreamDigest(self.digest_algorithm)
+
+        def handle_multiplexed(self, cn: str, path: Path, hello: dict):
+            conn = self.request
+            # The client picks the level, and may change it (or stop
+            # compressing) at any time; we only need to be able to decompress
+            codec = choose_codec(hello.get('compression', []))
+            print('Compression:', codec or COMPRESSION_NONE)
+            welcome = {
+                'success': True,
+                'protocol': PROTOCOL_MULTIPLEXED,
+                'compression': codec,
+                'compression_level': hello.get('compression_level'),
+            }
+            if striping is not None:
+                welcome['max_stripes'] = striping.max_stripes
+            if dedup is not None:
+                welcome['dedup'] = True
+            self.digest_algorithm = choose_digest(hello.get('digests', []))
+            welcome['digest'] = self.digest_algorithm
+            self.wfile.write(serialize_json(welcome))
+
+            def report_position(ticket, position):
+                print('{} queued at position {} for {}'.format(cn, position, ticket.device))
+                send_message(
+                    conn,
+                    {
+                        'type': 'queued',
+                        'success': True,
+                        'position': position,
+                        'device': ticket.device,
+                    },
+                )
+
+            # Older clients would take any successful reply for 'ready'
+            report = report_position if hello.get('queue_position') else None
+
+            while True:
+                try:
+                    message = recv_message(conn)
+                except ConnectionClosed:
+                    # Client is done with this session
+                    return
+
+                if message.get('type') == 'inventory':
+                    send_message(conn, inventory.reply(path))
+                    continue
+                if message.get('type') == 'ping':
+                    send_message(conn, {'type': 'pong', 'success': True})
+                    continue
+                if message.get('type') != 'send':
+                    send_message(
+                        conn,
+                        {
+                            'success': False,
+                            'reason': 'unknown_message_type',
+                        },
+                    )
+                    continue
+
+                print('receiving snapshot {} (parent {})'.format(
+                    message.get('snapshot'),
+                    message.get('parent'),
+                ))
+                # Older clients don't send one
+                tid = message.get('transfer_id') or new_transfer_id()
+                with tracer.transfer(tid), tracer.span('transfer', client=cn, snapshot=message.get('snapshot')) as span:
+                    with self.slot(cn, report) as ticket:
+                        if ticket is not None:
+                            tracer.record('admission', ticket.wait_seconds, device=ticket.device)
+                        meter = status_board.start('{}:{}'.format(cn, message.get('snapshot')), 'receive')
+                        self.tuner.start(conn)
+                        print('Link tuning:', self.tuner.format())
+                        meter.on_first_rate = partial(self.tuner.early_rate, conn)
+                        inventory.start_receive(path, message.get('snapshot'))
+                        try:
+                            if message.get('resumable') and spool_root is not None:
+                                data = self.receive_spooled(path, message, meter)
+                            elif message.get('stripes', 1) > 1 and striping is not None:
+                                data = self.receive_striped(cn, path, message, meter)
+                            elif message.get('dedup') and dedup is not None:
+                                data = self.receive_deduplicated(cn, path, meter)
+                            else:
+                                data = self.receive_direct(path, meter)
+                        finally:
+                            inventory.finish_receive(path, message.get('snapshot'))
+                            meter.finish()
+                        data['link'] = span['link'] = self.tuner.describe()
+                        self.record_link(cn, meter)
+                        if ticket is not None:
+                            data['scheduling'] = admission.scheduler.describe(ticket)
+                data['type'] = 'result'
+                if data.get('stream_broken'):
+                    # We don't know where the next frame starts, so this
+                    # session is unusable
+                    data['session_closed'] = True
+                    try:
+                        send_message(conn, data)
+                    except OSError:
+                        pass
+                    return
+                send_message(conn, data)
+
+        def receive_direct(self, path: Path, meter: TransferMeter) -> dict:
+            """
+            Stream frames straight into `btrfs receive`
+            """
+            conn = self.request
+            send_message(conn, {'type': 'ready', 'success': True})
+            received_streams = []
+            staging_summaries = []
+
+            def copy(write_to):
+                received = receive_stream(conn, write_to, meter)
+                received_streams.append(received)
+                return received.copy_result
+
+            data = receive_snapshot(path, staged_copy(copy, staging, staging_summaries), self.new_digest())
+            if staging_summaries:
+                data['staging'] = staging_summaries[0]
+            if received_streams:
+                received = received_streams[0]
+                data['wire_bytes'] = received.wire_bytes
+                data['decompress_seconds'] = received.decompress_seconds
+                check_end_summary(data, received.end_summary)
+            return data
+
+        def receive_deduplicated(self, cn: str, path: Path, meter: TransferMeter) -> dict:
+            """
+            Rebuild the stream from the client's chunk store and the chunks
+            it sends, straight into `btrfs receive`
+            """
+            conn = self.request
+            store = dedup.store_for(cn)
+            receiver = DedupReceiver(store)
+            send_message(conn, {'type': 'ready', 'success': True, 'dedup': True})
+            received_streams = []
+            staging_summaries = []
+
+            def copy(write_to):
+                received = receiver.receive(conn, write_to, meter)
+                received_streams.append(received)
+                return received.copy_result
+
+            data = receive_snapshot(path, staged_copy(copy, staging, staging_summaries), self.new_digest())
+            if staging_summaries:
+                data['staging'] = staging_summaries[0]
+            data['dedup'] = receiver.summary()
+            print('dedup: {}; chunk store: {}'.format(data['dedup'], store.summary()))
+            if received_streams:
+                received = received_streams[0]
+                data['wire_bytes'] = received.wire_bytes
+                data['decompress_seconds'] = received.decompress_seconds
+                check_end_summary(data, received.end_summary)
+            return data
+
+        def receive_striped(self, cn: str, path: Path, message: dict, meter: TransferMeter) -> dict:
+            """
+            Have the client open stripe connections, and feed the chunks
+            from all of them into `btrfs receive` in order
+            """
+            conn = self.request
+            reassembler = Reassembler(striping.reorder_limit)
+            token = secrets.token_hex(16)
+            with striped_transfers_lock:
+                striped_transfers[token] = (cn, reassembler)
+            try:
+                send_message(
+                    conn,
+                    {
+                        'type': 'ready',
+                        'success': True,
+                        'stripes': min(message['stripes'], striping.max_stripes),
+                        'stripe_token': token,
+                    },
+                )
+                end_summaries = []
+                staging_summaries = []
+
+                def copy(write_to):
+                    drained = []
+
+                    def drain():
+                        try:
+                            drained.append(reassembler.drain(write_to, meter))
+                        except BaseException as e:
+                            reassembler.abort(e)
+                            drained.append(e)
+
+                    drainer = Thread(target=drain)
+                    drainer.start()
+                    try:
+                        end_summaries.append(receive_striped_end(conn, reassembler))
+                    finally:
+                        drainer.join()
+                    if isinstance(drained[0], BaseException):
+                        raise drained[0]
+                    return drained[0]
+
+                data = receive_snapshot(path, staged_copy(copy, staging, staging_summaries), self.new_digest())
+            finally:
+                with striped_transfers_lock:
+                    del striped_transfers[token]
+            if staging_summaries:
+                data['staging'] = staging_summaries[0]
+            data['wire_bytes'] = reassembler.wire_bytes
+            data['decompress_seconds'] = reassembler.decompress_seconds
+            data['reorder_high_water'] = reassembler.high_water
+            if end_summaries:
+                print('striped over {} connection(s)'.format(end_summaries[0].get('stripes')))
+                check_end_summary(data, end_summaries[0])
+            return data
+
+        def handle_stripe(self, cn: str, token: str):
+            """
+            One stripe of a striped transfer
+            """
+            with striped_transfers_lock:
+                transfer = striped_transfers.get(token)
+            if transfer is None or transfer[0] != cn or not transfer[1].add_stripe(self.request):
+                self.wfile.write(serialize_json({'success': False, 'reason': 'unknown_stripe'}))
+                return
+            self.wfile.write(serialize_json({'success': True, 'protocol': PROTOCOL_STRIPE}))
+            receive_stripe(self.request, transfer[1])
+
+        def receive_spooled(self, path: Path, message: dict, meter: TransferMeter) -> dict:
+            """
+            Spool frames to disk, resuming from the last checkpoint if this
+            stream was interrupted before, and only run `btrfs receive` once
+            all of it has arrived intact
+            """
+            conn = self.request
+            cn = get_common_name(self.request.getpeercert())
+            spool_dir = spool_root / cn
+            tid = transfer_id(message['snapshot'], message.get('parent'))
+            with active_spools_lock:
+                if tid in active_spools:
+                    data = {
+                        'type': 'ready',
+                        'success': False,
+                        'reason': 'transfer_in_progress',
+                    }
+                    send_message(conn, data)
+                    return data
+                active_spools.add(tid)
+
+            spool = Spool(spool_dir, tid, checkpoint_interval)
+            try:
+                remove_stale_spools(spool_dir)
+                offset = spool.open()
+                if offset:
+                    print('resuming {} at offset {}'.format(message['snapshot'], offset))
+                send_message(
+                    conn,
+                    {
+                        'type': 'ready',
+                        'success': True,
+                        'resumable': True,
+                        'offset': offset,
+                    },
+                )
+                try:
+                    with tracer.span('spool', offset=offset):
+                        received = receive_stream(conn, spool, meter)
+                except (OSError, ProtocolError) as e:
+                    print('stream interrupted at {} bytes: {!r}'.format(spool.size, e))
+                    # Everything written so far is a valid prefix of the stream
+                    spool.checkpoint()
+                    return {
+                        'success': False,
+                        'stream_broken': True,
+                        'resumable': True,
+                        'offset': spool.committed,
+                        'reason': repr(e),
+                    }
+                spool.checkpoint()
+
+                reason = spool.verify(received.end_summary)
+                if reason is not None:
+                    print('spooled stream rejected:', reason)
+                    spool.remove()
+                    return {
+                        'success': False,
+                        'reason': reason,
+                    }
+
+                data = receive_snapshot(path, partial(bulk_copy, spool.reader()))
+                data['wire_bytes'] = received.wire_bytes
+                data['decompress_seconds'] = received.decompress_seconds
+                data['resumed_from'] = offset
+                if data['success']:
+                    # Checked against the client's digest, which also
+                    # covers the part sent before any interruption
+                    data['stream_digest'] = spool.hasher.summary()
+                # Resending the same stream won't make `btrfs receive` any
+                # happier, so the spool is done with either way
+                spool.remove()
+                return data
+            finally:
+                spool.close()
+                with active_spools_lock:
+                    active_spools.discard(tid)
+
+        def handle_two_port(self, cn: str, path: Path):
+            # No way to report a queue position to these clients; they just
+            # wait a little longer for the data port
+            with tracer.transfer(new_transfer_id()), tracer.span('transfer', client=cn):
+                with self.slot(cn) as ticket:
+                    if ticket is not None:
+                        tracer.record('admission', ticket.wait_seconds, device=ticket.device)
+                    self.receive_two_port(cn, path, ticket)
+
+        def receive_two_port(self, cn: str, path: Path, ticket):
             s = socket(AF_INET, SOCK_STREAM)
             s.bind(('', 0))
 
-            s = ssl.wrap_socket(
+            s = self.server.ssl_context.wrap_socket(
                 s,
                 server_side=True,
-                certfile=self.server.cert_file,
-                keyfile=self.server.key_file,
-                ca_certs=self.server.ca_cert_file,
-                ssl_version=self.server.ssl_version,
-                cert_reqs=ssl.CERT_REQUIRED,
+                do_handshake_on_connect=False,
             )
 
             new_addr, new_port = s.getsockname()
             print('bound new socket to {}:{}'.format(new_addr, new_port))
+            # Listen before telling the client where to connect
+            s.listen()
             intermediate_data = {
                 'success': True,
+                'protocol': PROTOCOL_TWO_PORT,
                 'new_port': new_port,
             }
             self.wfile.write(serialize_json(intermediate_data))
-            s.listen()
-            conn, remote_addr = s.accept()
+            # Don't leak the socket (and this thread) if the client
+            # never connects
+            s.settimeout(DATA_CONNECTION_TIMEOUT)
+            try:
+                conn, remote_addr = s.accept()
+            except OSError as e:
+                print('client never connected to data port:', repr(e))
+                return
+            finally:
+                s.close()
+            conn.settimeout(DATA_CONNECTION_TIMEOUT)
+            try:
+                timed_handshake(conn, self.server.handshake_stats)
+            except OSError as e:
+                print('TLS handshake on data port failed:', repr(e))
+                conn.close()
+                return
+            conn.settimeout(None)
             print('accepted connection from {}:{}'.format(*remote_addr))
-            command = [
-                piece.format(path=path)
-                for piece in BTRFS_RECEIVE_COMMAND
-            ]
-
-            proc = Popen(
-                command,
-                stdin=PIPE,
-                cwd=str(path),
-            )
-            bulk_copy(conn, proc.stdin)
-            proc.stdin.close()
-            return_code = proc.wait()
-
-            print('command returned {}'.format(return_code))
-            conn.close()
-
-            data = {
-                'return_code': return_code,
-                'success': not return_code,
-            }
+            # The data connection gets tuned instead of the control one
+            self.tuner = LinkTuner(link_settings, sending=False, bandwidth=link_rates.get(cn))
+            self.tuner.start(conn)
+            print('Link tuning:', self.tuner.format())
+            # Old clients don't tell us which snapshot this is
+            meter = status_board.start('{}:two-port'.format(cn), 'receive')
+            meter.on_first_rate = partial(self.tuner.early_rate, conn)
+            staging_summaries = []
+            try:
+                data = receive_snapshot(
+                    path,
+                    staged_copy(
+                        partial(bulk_copy, conn, buffer_size=self.tuner.chunk_size, meter=meter),
+                        staging,
+                        staging_summaries,
+                    ),
+                )
+            finally:
+                inventory.finish_receive(path, None)
+                meter.finish()
+                conn.close()
+            data['link'] = self.tuner.describe()
+            self.record_link(cn, meter)
+            if staging_summaries:
+                data['staging'] = staging_summaries[0]
+            if ticket is not None:
+                data['scheduling'] = admission.scheduler.describe(ticket)
             self.wfile.write(serialize_json(data))
 
     return BtrfsReceiveHandler
 
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--profile',
+        choices=[PROFILE_CPROFILE, PROFILE_SAMPLING],
+        help='Profile the server until it stops; see tracing.py',
+    )
+    args = parser.parse_args()
+
     config, paths, key_paths = parse_config()
     print('Initializing btrfs sync server. Hostname -> path mapping:')
     for hostname in sorted(paths):
         print('{} -> {}'.format(hostname, paths[hostname]))
 
-    SSL_ThreadingTCPServer(
-        ('0.0.0.0', CONTROL_PORT),
-        get_handler_class(paths),
-        str(key_paths['server_cert']),
-        str(key_paths['server_key']),
-        str(key_paths['ca_cert']),
-    ).serve_forever()
+    status_board.configure(config)
+    buffer_pool.configure(config)
+    tracer.configure(config, 'server', args.profile)
+    link = LinkSettings.from_config(
+        config['server'] if 'server' in config else None,
+        config['network'] if 'network' in config else None,
+    )
+    spool_root, checkpoint_interval = get_spool_config(config)
+    if spool_root is not None:
+        print('Spooling resumable transfers in', spool_root)
+    staging = StagingSettings.from_config(config)
+    if staging is not None:
+        print(
+            'Staging up to {} bytes in memory and {} on disk per transfer'.format(
+                staging.memory_limit,
+                staging.disk_limit,
+            )
+        )
+
+    if tracer.profile != PROFILE_NONE:
+        # So that the profile is written when systemd stops us
+        signal.signal(signal.SIGTERM, _terminate)
+    with tracer.profiling():
+        engine = config.get('server', 'engine', fallback=ENGINE_THREADING)
+        if engine == ENGINE_THREADING:
+            striping = StripingSettings.from_config(config)
+            if striping is not None:
+                print('Accepting striped transfers over up to {} connections'.format(striping.max_stripes))
+            dedup = DedupSettings.from_config(config)
+            if dedup is not None:
+                print('Deduplicating streams against chunk stores in {}, {} bytes each'.format(dedup.root, dedup.max_size))
+            scheduler = ReceiveScheduler.from_config(config, paths)
+            scheduler.print_summary()
+            SSL_ThreadingTCPServer(
+                ('0.0.0.0', CONTROL_PORT),
+                get_handler_class(
+                    paths,
+                    spool_root,
+                    checkpoint_interval,
+                    staging,
+                    striping,
+                    dedup,
+                    AdmissionQueue(scheduler),
+                    link,
+                ),
+                str(key_paths['server_cert']),
+                str(key_paths['server_key']),
+                str(key_paths['ca_cert']),
+            ).serve_forever()
+        elif engine == ENGINE_ASYNCIO:
+            # Imports this module, so can't be imported at the top
+            from aio_server import AdmissionController, serve
+            admission = AdmissionController.from_config(config, paths)
+            print('Using asyncio engine')
+            admission.scheduler.print_summary()
+            serve(paths, key_paths, admission, spool_root, checkpoint_interval, link=link)
+        else:
+            raise ValueError('Unknown server engine: {}'.format(engine))
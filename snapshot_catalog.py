@@ -0,0 +1,182 @@
+"""
+Cached catalog of the snapshots in a snapshot directory.
+
+Listing a directory of thousands of snapshots and parsing every timestamp
+on every run is most of the work of a run that has nothing to send. The
+catalog remembers each entry's parsed timestamp, along with the directory's
+inode and mtime. If those haven't changed, the cached listing is used as-is;
+otherwise the directory is listed again, but only names that weren't there
+last time are parsed. The cache is thrown away (and the directory rescanned
+from scratch) if it can't be read, belongs to another directory, or was
+written so soon after the directory last changed that a later change could
+have left the mtime as it was.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from time import time
+from typing import Dict, List, Mapping, Optional, Set
+
+from subvolume import KEEP_FILE_EXTENSION, Subvolume, parse_datetime, parse_keep_file_name
+
+CATALOG_CACHE_DIR = Path('/var/cache/btrfs-syncd')
+# 2: snapshots are stored oldest first
+CATALOG_VERSION = 2
+# Directory mtimes this close to when the cache was written (in seconds)
+# can't be trusted to change again on the next modification
+MTIME_GRANULARITY = 2
+
+def catalog_cache_path(cache_dir: Path, path: Path) -> Path:
+    digest = hashlib.sha256(str(path).encode('utf-8')).hexdigest()[:16]
+    return cache_dir / 'catalog-{}.json'.format(digest)
+
+class SnapshotCatalog:
+    """
+    Snapshots and `.keep` files in one directory
+    """
+    def __init__(self, path: Path, cache_path: Optional[Path] = None):
+        self.path = path
+        self.cache_path = cache_path
+        # Snapshot name -> timestamp (seconds since the epoch), oldest first
+        # (ties by name); sorted when the directory is scanned, and kept in
+        # that order in the cache
+        self.snapshots: Dict[str, float] = {}
+        # Names of `.keep` files
+        self.keep_files: Set[str] = set()
+        self.dir_inode = None
+        self.dir_mtime_ns = None
+        self.written = None
+
+    def load(self) -> bool:
+        """
+        :return: Whether a usable cache was loaded
+        """
+        if self.cache_path is None:
+            return False
+        try:
+            with self.cache_path.open() as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cache.get('version') != CATALOG_VERSION or cache.get('path') != str(self.path):
+            return False
+        self.snapshots = cache['snapshots']
+        self.keep_files = set(cache['keep_files'])
+        self.dir_inode = cache['dir_inode']
+        self.dir_mtime_ns = cache['dir_mtime_ns']
+        self.written = cache['written']
+        return True
+
+    def save(self):
+        self.written = time()
+        if self.cache_path is None:
+            return
+        cache = {
+            'version': CATALOG_VERSION,
+            'path': str(self.path),
+            'dir_inode': self.dir_inode,
+            'dir_mtime_ns': self.dir_mtime_ns,
+            'written': self.written,
+            'snapshots': self.snapshots,
+            'keep_files': sorted(self.keep_files),
+        }
+        temp_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with temp_path.open('w') as f:
+                json.dump(cache, f)
+            temp_path.rename(self.cache_path)
+        except OSError as e:
+            # Only costs us a rescan next time
+            print("Can't save snapshot catalog:", repr(e))
+
+    def _is_current(self, stat: os.stat_result) -> bool:
+        if self.dir_mtime_ns is None:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns) != (self.dir_inode, self.dir_mtime_ns):
+            return False
+        return self.written - stat.st_mtime_ns / 1e9 > MTIME_GRANULARITY
+
+    def _rescan(self):
+        snapshots = {}
+        keep_files = set()
+        with os.scandir(str(self.path)) as entries:
+            for entry in entries:
+                # DirEntry knows the type without a stat() on most
+                # filesystems
+                if entry.is_file():
+                    if entry.name.endswith(KEEP_FILE_EXTENSION):
+                        keep_files.add(entry.name)
+                    continue
+                timestamp = self.snapshots.get(entry.name)
+                if timestamp is None:
+                    timestamp = parse_datetime(entry.name).timestamp()
+                snapshots[entry.name] = timestamp
+        self.snapshots = {
+            name: snapshots[name]
+            for name in sorted(snapshots, key=lambda s: (snapshots[s], s))
+        }
+        self.keep_files = keep_files
+
+    def refresh(self):
+        """
+        Bring the catalog up to date with the directory, saving the cache
+        if anything changed
+        """
+        stat = self.path.stat()
+        if self._is_current(stat):
+            return
+        self._rescan()
+        self.dir_inode = stat.st_ino
+        self.dir_mtime_ns = stat.st_mtime_ns
+        self.save()
+
+    def subvolumes(self) -> Mapping[str, Subvolume]:
+        """
+        :return: Subvolume name -> Subvolume, sorted by name. Each
+        subvolume's snapshots are sorted oldest first.
+        """
+        by_name: Dict[str, List[str]] = {}
+        for snapshot in self.snapshots:
+            name, timestamp = snapshot.split('@')
+            by_name.setdefault(name, []).append(snapshot)
+
+        # Subvolume name -> destination -> base snapshot
+        bases: Dict[str, Dict[Optional[str], str]] = {}
+        for keep_file in self.keep_files:
+            base, destination = parse_keep_file_name(keep_file)
+            name, timestamp = base.split('@')
+            subvolume_bases = bases.setdefault(name, {})
+            # TODO figure out how important this is
+            if destination in subvolume_bases:
+                raise ValueError('Multiple base snapshots')
+            subvolume_bases[destination] = base
+            if name not in by_name:
+                raise ValueError('Found {} but no snapshots of {}'.format(keep_file, name))
+
+        subvolumes = {}
+        for name in sorted(by_name):
+            subvolume = Subvolume()
+            subvolume.cwd = self.path
+            subvolume.all = by_name[name]
+            subvolume.bases = bases.get(name, {})
+            subvolume.base = subvolume.bases.get(None)
+            subvolume.parent = subvolume.base
+            subvolume.newest = subvolume.all[-1]
+            subvolume.extra = subvolume.all[:-1]
+            subvolumes[name] = subvolume
+        return subvolumes
+
+def catalog_snapshots(path: Path, cache_dir: Optional[Path] = CATALOG_CACHE_DIR) -> Mapping[str, Subvolume]:
+    """
+    Cached equivalent of `search_snapshots`
+
+    :param cache_dir: Where to keep the catalog; None to always scan
+    """
+    cache_path = None if cache_dir is None else catalog_cache_path(cache_dir, path)
+    catalog = SnapshotCatalog(path, cache_path)
+    if not catalog.load() and cache_path is not None:
+        print('No usable snapshot catalog for {}; scanning'.format(path))
+    catalog.refresh()
+    return catalog.subvolumes()
@@ -1,5 +1,19 @@
+from functools import partial
 import ssl
 from socketserver import TCPServer, ThreadingMixIn
+from time import monotonic
+
+from copy_engine import enable_ktls
+from tls import HandshakeStats, ReloadingContext, timed_handshake
+from tracing import format_address, tracer
+
+def make_server_context(cert_file, key_file, ca_cert_file, ssl_version=ssl.PROTOCOL_TLSv1_2) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl_version)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(ca_cert_file)
+    context.load_cert_chain(cert_file, keyfile=key_file)
+    enable_ktls(context)
+    return context
 
 class SSL_TCPServer(TCPServer):
     def __init__(
@@ -18,20 +32,46 @@ class SSL_TCPServer(TCPServer):
         self.ca_cert_file = ca_cert_file
         self.ssl_version = ssl_version
         self.client_cert = None
+        # `ssl.wrap_socket` has no way to request kTLS, so build a context
+        # that both the control and data connections can share. It also
+        # holds the session cache that lets clients resume.
+        self.ssl_contexts = ReloadingContext(
+            partial(make_server_context, cert_file, key_file, ca_cert_file, ssl_version),
+            [cert_file, key_file, ca_cert_file],
+        )
+        self.handshake_stats = HandshakeStats()
+        # Client address -> when its connection was accepted, until its
+        # handler starts
+        self.accepted = {}
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        return self.ssl_contexts.get()
 
     def get_request(self):
         newsocket, fromaddr = self.socket.accept()
-        connstream = ssl.wrap_socket(
+        self.accepted[fromaddr] = monotonic()
+        connstream = self.ssl_context.wrap_socket(
             newsocket,
             server_side=True,
-            certfile=self.cert_file,
-            keyfile=self.key_file,
-            ca_certs=self.ca_cert_file,
-            ssl_version=self.ssl_version,
-            cert_reqs=ssl.CERT_REQUIRED,
+            do_handshake_on_connect=False,
         )
+        try:
+            timed_handshake(connstream, self.handshake_stats)
+        except OSError:
+            self.accepted.pop(fromaddr, None)
+            connstream.close()
+            raise
         self.client_cert = connstream.getpeercert()
         return connstream, fromaddr
 
+    def record_accept(self, client_address):
+        """
+        Called by the handler once it's running
+        """
+        accepted = self.accepted.pop(client_address, None)
+        if accepted is not None:
+            tracer.record('accept', monotonic() - accepted, peer=format_address(client_address))
+
 class SSL_ThreadingTCPServer(ThreadingMixIn, SSL_TCPServer):
     pass
@@ -0,0 +1,295 @@
+"""
+Bounded staging buffer between the network and `btrfs receive`.
+
+Without it, the thread that reads the connection is the one that writes into
+`btrfs receive`, so whenever `btrfs receive` stops reading for a while (say,
+to unlink a large directory) the socket isn't read either, the TCP window
+closes and `btrfs send` on the client stalls too. With staging, the network
+side writes into a buffer that a second thread drains into `btrfs receive`.
+The buffer holds up to a configured amount in memory, then spills to a file
+on local disk; only when both are full does the network side wait.
+
+The memory comes in BLOCK_SIZE blocks from buffer_pool.py, but only while
+the pool has room to spare: staging never makes a transfer wait for memory,
+and when the pool is full it spills to disk (or waits for `btrfs receive`)
+as if its own limit had been reached.
+"""
+from collections import deque
+import os
+from pathlib import Path
+import tempfile
+from threading import Condition, Thread
+from time import monotonic
+from typing import Optional
+
+from buffer_pool import buffer_pool
+from copy_engine import write_all
+
+DEFAULT_MEMORY_LIMIT = 1 << 26
+# Size of each block of memory taken from the pool, and the largest piece
+# read back from the staging file at once
+BLOCK_SIZE = 1 << 20
+
+class StagingBuffer:
+    """
+    Single producer (`write`, then `close`), single consumer (`drain`).
+    Usually driven by `run`.
+    """
+    def __init__(self, memory_limit: int, disk_limit: int = 0, staging_dir: Optional[Path] = None):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.staging_dir = staging_dir
+        self.cond = Condition()
+        # Data in memory, oldest first, as [block, length] pairs. Only the last
+        # one is still being filled. While `spilling`, everything here is
+        # older than anything in the file.
+        self.chunks = deque()
+        self.memory_used = 0
+        self.file = None
+        self.file_read_offset = 0
+        self.file_write_offset = 0
+        self.spilling = False
+        # Set by the producer
+        self.closed = False
+        self.aborted = False
+        # Set by the consumer if writing into `btrfs receive` failed
+        self.drain_error: Optional[BaseException] = None
+
+        self.memory_high_water = 0
+        self.disk_high_water = 0
+        self.spilled_bytes = 0
+        # Time the network side spent waiting for room
+        self.write_stall_seconds = 0.0
+        # Time `btrfs receive` spent waiting for data
+        self.drain_wait_seconds = 0.0
+
+    @property
+    def disk_used(self) -> int:
+        return self.file_write_offset - self.file_read_offset
+
+    def _write_to_file(self, data):
+        if self.file is None:
+            if self.staging_dir is not None:
+                self.staging_dir.mkdir(parents=True, exist_ok=True)
+            # Unlinked straight away; nothing to clean up after a crash
+            self.file = tempfile.TemporaryFile(
+                dir=None if self.staging_dir is None else str(self.staging_dir),
+                buffering=0,
+            )
+        view = memoryview(data)
+        offset = self.file_write_offset
+        while view:
+            written = os.pwrite(self.file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+
+    def _write_to_memory(self, view: memoryview) -> memoryview:
+        """
+        Copy as much of `view` as the pool has room for into the last block,
+        and new ones as needed; called with the lock held
+
+        :return: What didn't fit
+        """
+        # With nothing in memory, nothing here would free up room for us
+        over_limit = not self.memory_used
+        while view:
+            if self.chunks and self.chunks[-1][1] < len(self.chunks[-1][0]):
+                chunk = self.chunks[-1]
+            else:
+                block = buffer_pool.acquire(BLOCK_SIZE, wait=False, over_limit=over_limit)
+                if block is None:
+                    break
+                chunk = [block, 0]
+                self.chunks.append(chunk)
+            block, length = chunk
+            n = min(len(view), len(block) - length)
+            block[length:length + n] = view[:n]
+            chunk[1] += n
+            self.memory_used += n
+            view = view[n:]
+        self.memory_high_water = max(self.memory_high_water, self.memory_used)
+        return view
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        size = len(view)
+        stall_start = None
+        with self.cond:
+            while True:
+                if self.drain_error is not None:
+                    raise BrokenPipeError('`btrfs receive` stopped reading') from self.drain_error
+                # A chunk bigger than the whole memory limit still has to
+                # go somewhere
+                fits_memory = self.memory_used + len(view) <= self.memory_limit or not self.memory_used
+                if not self.spilling and fits_memory:
+                    view = self._write_to_memory(view)
+                    if not view:
+                        break
+                if self.disk_limit and self.disk_used + len(view) <= self.disk_limit:
+                    self.spilling = True
+                    # Under the lock, so the consumer never sees the file
+                    # drained while we're in the middle of appending to it
+                    self._write_to_file(view)
+                    self.file_write_offset += len(view)
+                    self.spilled_bytes += len(view)
+                    self.disk_high_water = max(self.disk_high_water, self.disk_used)
+                    break
+                if stall_start is None:
+                    stall_start = monotonic()
+                self.cond.wait()
+            if stall_start is not None:
+                self.write_stall_seconds += monotonic() - stall_start
+            self.cond.notify_all()
+        return size
+
+    def close(self):
+        """
+        No more data is coming; `drain` finishes once it has written
+        everything
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        """
+        The stream is broken; `drain` stops as soon as possible
+        """
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+
+    def _next(self):
+        """
+        :return: The next block of data from the pool and how much of it is
+        used, or None at the end of the stream. The caller releases the block.
+        """
+        wait_start = None
+        with self.cond:
+            while not self.aborted:
+                if self.chunks:
+                    block, length = self.chunks.popleft()
+                    self.memory_used -= length
+                    break
+                if self.disk_used:
+                    offset = self.file_read_offset
+                    size = min(self.disk_used, BLOCK_SIZE)
+                    block = None
+                    break
+                if self.closed:
+                    return None
+                if wait_start is None:
+                    wait_start = monotonic()
+                self.cond.wait()
+            else:
+                return None
+            if wait_start is not None:
+                self.drain_wait_seconds += monotonic() - wait_start
+            if block is not None:
+                self.cond.notify_all()
+                return block, length
+
+        # Waiting for room in the pool here could hold up the producer that
+        # would make it, so this one block may go over the limit. The
+        # producer only appends past file_write_offset, so this part of the
+        # file can be read without the lock.
+        block = buffer_pool.acquire(BLOCK_SIZE, over_limit=True)
+        try:
+            length = os.preadv(self.file.fileno(), [memoryview(block)[:size]], offset)
+        except BaseException:
+            buffer_pool.release(block)
+            raise
+        with self.cond:
+            self.file_read_offset += length
+            if not self.disk_used:
+                # Drained; start again from the beginning of the file, and
+                # put new data in memory
+                self.file_read_offset = self.file_write_offset = 0
+                self.file.truncate(0)
+                self.spilling = False
+            self.cond.notify_all()
+        return block, length
+
+    def drain(self, write_to):
+        """
+        Write everything into `write_to` until the producer closes or aborts
+        """
+        try:
+            while True:
+                item = self._next()
+                if item is None:
+                    return
+                block, length = item
+                try:
+                    write_all(write_to, memoryview(block)[:length])
+                finally:
+                    buffer_pool.release(block)
+        except BaseException as e:
+            with self.cond:
+                self.drain_error = e
+                self.cond.notify_all()
+
+    def run(self, write_to, fill):
+        """
+        Call `fill(self)` in this thread while another drains into
+        `write_to`, and wait for both.
+
+        :return: What `fill` returned
+        """
+        drainer = Thread(target=self.drain, args=(write_to,))
+        drainer.start()
+        try:
+            try:
+                result = fill(self)
+            except BaseException:
+                self.abort()
+                raise
+            self.close()
+        finally:
+            drainer.join()
+            # Anything left over if the transfer failed
+            while self.chunks:
+                buffer_pool.release(self.chunks.popleft()[0])
+            if self.file is not None:
+                self.file.close()
+        if self.drain_error is not None:
+            raise self.drain_error
+        return result
+
+    def summary(self) -> dict:
+        return {
+            'memory_high_water': self.memory_high_water,
+            'disk_high_water': self.disk_high_water,
+            'spilled_bytes': self.spilled_bytes,
+            'write_stall_seconds': self.write_stall_seconds,
+            'drain_wait_seconds': self.drain_wait_seconds,
+        }
+
+class StagingSettings:
+    __slots__ = ['memory_limit', 'disk_limit', 'staging_dir']
+
+    def __init__(self, memory_limit: int, disk_limit: int = 0, staging_dir: Optional[Path] = None):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.staging_dir = staging_dir
+
+    @classmethod
+    def from_config(cls, config) -> Optional['StagingSettings']:
+        """
+        :return: Settings from the server's [staging] section, or None if
+        there isn't one
+        """
+        if 'staging' not in config:
+            return None
+        section = config['staging']
+        staging_dir = None
+        if 'path' in section:
+            staging_dir = Path(section['path'])
+        return cls(
+            section.getint('memory limit', DEFAULT_MEMORY_LIMIT),
+            section.getint('disk limit', 0),
+            staging_dir,
+        )
+
+    def make_buffer(self) -> StagingBuffer:
+        return StagingBuffer(self.memory_limit, self.disk_limit, self.staging_dir)
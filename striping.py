@@ -0,0 +1,381 @@
+"""
+Striped transfers: one `btrfs send` stream spread over several connections.
+
+On a long, fat link a single TCP connection spends most of its time waiting
+for its window to open, so the client can ask to stripe a transfer. The
+stream is cut into sequenced chunks of up to MAX_FRAME_SIZE, which sender
+threads (one per stripe connection) take from a shared queue, so a slow
+stripe simply sends fewer chunks. The server reads every stripe in its own
+thread and puts the chunks back in order in a `Reassembler`, which holds at
+most a configured number of bytes of out-of-order chunks; a stripe that gets
+too far ahead waits until the others catch up.
+
+The number of stripes is either fixed, or 'auto': start with one and add
+another every STRIPE_PROBE_INTERVAL seconds for as long as each addition
+raised the throughput by at least STRIPE_GAIN_THRESHOLD.
+
+See protocol.py for the framing.
+"""
+from queue import Queue
+import socket
+from threading import Condition, Thread
+from time import monotonic, perf_counter
+from typing import Callable, Dict, List, Optional
+
+from btrfs_incremental_send import serialize_json
+from buffer_pool import buffer_pool
+from compression import AdaptiveCompressor
+from copy_engine import CopyResult
+from protocol import (
+    CHUNK_HEADER,
+    FRAME_CHUNK,
+    FRAME_END,
+    FRAME_HEADER,
+    MAX_FRAME_SIZE,
+    ConnectionClosed,
+    ProtocolError,
+    decompress_block,
+    recv_exactly,
+    recv_frame_header,
+    recv_json_payload,
+    send_frame,
+    write_all,
+)
+
+# 'stripes' setting meaning "work it out"
+STRIPES_AUTO = 0
+DEFAULT_MAX_STRIPES = 8
+# Bytes of out-of-order chunks the server holds per transfer
+DEFAULT_REORDER_LIMIT = 1 << 26
+# Seconds between throughput measurements when tuning the number of stripes
+STRIPE_PROBE_INTERVAL = 2.0
+# Minimum relative throughput gain for another stripe to be worth adding
+STRIPE_GAIN_THRESHOLD = 0.1
+
+class StripingSettings:
+    """
+    Server side limits
+    """
+    __slots__ = ['max_stripes', 'reorder_limit']
+
+    def __init__(self, max_stripes: int = DEFAULT_MAX_STRIPES, reorder_limit: int = DEFAULT_REORDER_LIMIT):
+        self.max_stripes = max_stripes
+        self.reorder_limit = reorder_limit
+
+    @classmethod
+    def from_config(cls, config) -> Optional['StripingSettings']:
+        """
+        :return: Settings from the server's [server] section, or None if
+        'max stripes' is 0 (striping disabled)
+        """
+        section = config['server'] if 'server' in config else config[config.default_section]
+        max_stripes = section.getint('max stripes', DEFAULT_MAX_STRIPES)
+        if max_stripes < 1:
+            return None
+        return cls(max_stripes, section.getint('stripe reorder buffer', DEFAULT_REORDER_LIMIT))
+
+def parse_stripes(value: str) -> int:
+    """
+    :return: Number of stripes from a config value, or STRIPES_AUTO
+    """
+    if value == 'auto':
+        return STRIPES_AUTO
+    stripes = int(value)
+    if stripes < 1:
+        raise ValueError('Number of stripes must be at least 1, or auto')
+    return stripes
+
+class StripedSender:
+    """
+    Client side: reads the stream, cuts it into chunks and hands them to
+    one sender thread per stripe connection.
+    """
+    def __init__(
+            self,
+            open_stripe: Callable[[], socket.socket],
+            stripes: int,
+            max_stripes: int,
+            compressor: Optional[AdaptiveCompressor] = None,
+            meter=None,
+    ):
+        """
+        :param open_stripe: Connects a new stripe, up to and including its
+        hello and welcome lines
+        :param stripes: How many to open, or STRIPES_AUTO
+        """
+        self.open_stripe = open_stripe
+        self.auto = stripes == STRIPES_AUTO
+        self.initial_stripes = 1 if self.auto else min(stripes, max_stripes)
+        self.max_stripes = max_stripes
+        self.compressor = compressor
+        self.meter = meter
+        # Room for a couple of chunks per stripe, so none of them waits for
+        # the reader but memory stays bounded
+        self.queue = Queue(maxsize=2 * max_stripes)
+        self.conns: List[socket.socket] = []
+        self.threads: List[Thread] = []
+        self.error: Optional[BaseException] = None
+        self.chunks = 0
+
+    @property
+    def stripes(self) -> int:
+        return len(self.threads)
+
+    def _add_stripe(self):
+        conn = self.open_stripe()
+        self.conns.append(conn)
+        thread = Thread(target=self._send_chunks, args=(conn,))
+        self.threads.append(thread)
+        thread.start()
+
+    def _send_chunks(self, conn: socket.socket):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    send_frame(conn, FRAME_END, serialize_json({}))
+                    return
+                header, payload, buffer = item
+                try:
+                    conn.sendall(header)
+                    conn.sendall(payload)
+                finally:
+                    if buffer is not None:
+                        buffer_pool.release(buffer)
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            # Keep taking chunks, so the reader never blocks on a full queue
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if item[2] is not None:
+                    buffer_pool.release(item[2])
+
+    def _read_chunk(self, read_from, view: memoryview) -> int:
+        n = 0
+        # Pipes hand over at most 64 KiB at a time; fill the whole chunk so
+        # there are fewer, larger frames to reorder
+        while n < MAX_FRAME_SIZE:
+            got = read_from.readinto(view[n:])
+            if not got:
+                break
+            n += got
+        return n
+
+    def copy(self, read_from, conn=None) -> CopyResult:
+        """
+        For `send_snapshot`; `conn` (the control connection) isn't used
+        """
+        for _ in range(self.initial_stripes):
+            self._add_stripe()
+        sent = 0
+        sequence = 0
+        tuning = self.auto and self.stripes < self.max_stripes
+        window_start = monotonic()
+        window_bytes = 0
+        last_rate = None
+        try:
+            while True:
+                # From the pool, and back to it once a sender is done with
+                # it, so every chunk after the first few reuses a buffer
+                buffer = buffer_pool.acquire(MAX_FRAME_SIZE)
+                view = memoryview(buffer)
+                chunk = view[:self._read_chunk(read_from, view[:MAX_FRAME_SIZE])]
+                if not chunk:
+                    buffer_pool.release(buffer)
+                    break
+                codec_id = 0
+                payload = chunk
+                if self.compressor is not None:
+                    compressed = self.compressor.compress(chunk)
+                    if compressed is not None:
+                        codec_id = self.compressor.codec.codec_id
+                        payload = compressed
+                header = (
+                    FRAME_HEADER.pack(FRAME_CHUNK, CHUNK_HEADER.size + len(payload))
+                    + CHUNK_HEADER.pack(sequence, codec_id)
+                )
+                if payload is not chunk:
+                    buffer_pool.release(buffer)
+                    buffer = None
+                if self.error is not None:
+                    if buffer is not None:
+                        buffer_pool.release(buffer)
+                    raise self.error
+                start = perf_counter()
+                self.queue.put((header, payload, buffer))
+                if self.compressor is not None:
+                    # Waiting for a free sender means the network is the
+                    # bottleneck
+                    self.compressor.record_send(perf_counter() - start)
+                if self.meter is not None:
+                    self.meter.update(len(chunk))
+                sent += len(chunk)
+                sequence += 1
+
+                if tuning:
+                    window_bytes += len(chunk)
+                    now = monotonic()
+                    elapsed = now - window_start
+                    if elapsed >= STRIPE_PROBE_INTERVAL:
+                        rate = window_bytes / elapsed
+                        if last_rate is None or rate > last_rate * (1 + STRIPE_GAIN_THRESHOLD):
+                            try:
+                                self._add_stripe()
+                            except (OSError, ProtocolError) as e:
+                                print("Couldn't open another stripe:", repr(e))
+                                tuning = False
+                        else:
+                            tuning = False
+                        if self.stripes >= self.max_stripes:
+                            tuning = False
+                        if not tuning:
+                            print('Settled on {} stripe(s) at {:.1f} MB/s'.format(self.stripes, rate / 1e6))
+                        last_rate = rate
+                        window_start = now
+                        window_bytes = 0
+        finally:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            for stripe_conn in self.conns:
+                stripe_conn.close()
+        if self.error is not None:
+            raise self.error
+        self.chunks = sequence
+        return CopyResult('striped', sent)
+
+class Reassembler:
+    """
+    Server side: puts chunks from all stripes of one transfer back in order
+    """
+    def __init__(self, limit: int = DEFAULT_REORDER_LIMIT):
+        self.limit = limit
+        self.cond = Condition()
+        # Sequence number -> data, for chunks that arrived early
+        self.chunks: Dict[int, bytes] = {}
+        self.buffered = 0
+        self.next_sequence = 0
+        # Number of chunks, once the client says
+        self.total: Optional[int] = None
+        self.error: Optional[BaseException] = None
+        self.conns: List[socket.socket] = []
+
+        self.high_water = 0
+        self.wire_bytes = 0
+        self.decompress_seconds = 0.0
+
+    def add_stripe(self, conn: socket.socket) -> bool:
+        """
+        :return: False if the transfer has already failed
+        """
+        with self.cond:
+            if self.error is not None:
+                return False
+            self.conns.append(conn)
+            return True
+
+    def put(self, sequence: int, data, wire_length: int, decompress_seconds: float = 0.0):
+        with self.cond:
+            while True:
+                if self.error is not None:
+                    raise ConnectionClosed('Striped transfer aborted')
+                # The next chunk is always accepted, or nothing could move
+                if sequence == self.next_sequence or self.buffered + len(data) <= self.limit:
+                    break
+                self.cond.wait()
+            if sequence < self.next_sequence or sequence in self.chunks:
+                raise ProtocolError('Duplicate chunk {}'.format(sequence))
+            self.chunks[sequence] = data
+            self.buffered += len(data)
+            self.high_water = max(self.high_water, self.buffered)
+            self.wire_bytes += wire_length
+            self.decompress_seconds += decompress_seconds
+            self.cond.notify_all()
+
+    def finish(self, total: int):
+        with self.cond:
+            self.total = total
+            self.cond.notify_all()
+
+    def abort(self, error: BaseException):
+        """
+        Fail the transfer, and disconnect the stripes so the client notices
+        """
+        with self.cond:
+            if self.error is None:
+                self.error = error
+            for conn in self.conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.cond.notify_all()
+
+    def drain(self, write_to, meter=None) -> CopyResult:
+        written = 0
+        while True:
+            with self.cond:
+                while True:
+                    if self.error is not None:
+                        raise ConnectionClosed('Stripe failed: {!r}'.format(self.error))
+                    if self.next_sequence in self.chunks:
+                        data = self.chunks.pop(self.next_sequence)
+                        self.buffered -= len(data)
+                        self.next_sequence += 1
+                        self.cond.notify_all()
+                        break
+                    if self.total is not None and self.next_sequence >= self.total:
+                        return CopyResult('striped', written)
+                    self.cond.wait()
+            write_all(write_to, data)
+            written += len(data)
+            if meter is not None:
+                meter.update(len(data))
+
+def receive_stripe(conn: socket.socket, reassembler: Reassembler):
+    """
+    Read CHUNK frames from one stripe until its END frame
+    """
+    try:
+        while True:
+            frame_type, length = recv_frame_header(conn)
+            if frame_type == FRAME_END:
+                recv_json_payload(conn, length)
+                return
+            if frame_type != FRAME_CHUNK:
+                raise ProtocolError('Unexpected frame type {} on stripe'.format(frame_type))
+            if length > CHUNK_HEADER.size + MAX_FRAME_SIZE:
+                raise ProtocolError('Chunk too large: {}'.format(length))
+            frame = recv_exactly(conn, length)
+            sequence, codec_id = CHUNK_HEADER.unpack_from(frame)
+            data = memoryview(frame)[CHUNK_HEADER.size:]
+            decompress_seconds = 0.0
+            if codec_id:
+                start = perf_counter()
+                data = decompress_block(codec_id, data)
+                decompress_seconds = perf_counter() - start
+            reassembler.put(sequence, data, length, decompress_seconds)
+    except (OSError, ProtocolError) as e:
+        reassembler.abort(e)
+
+def receive_striped_end(conn: socket.socket, reassembler: Reassembler) -> dict:
+    """
+    Wait for the END frame on the control connection, and tell `reassembler`
+    how many chunks to expect
+
+    :return: The END frame's summary
+    """
+    try:
+        frame_type, length = recv_frame_header(conn)
+        if frame_type != FRAME_END:
+            raise ProtocolError('Expected END frame, got type {}'.format(frame_type))
+        summary = recv_json_payload(conn, length)
+        reassembler.finish(summary['chunks'])
+        return summary
+    except BaseException as e:
+        reassembler.abort(e)
+        raise
@@ -0,0 +1,74 @@
+"""
+Snapshot naming, and the Subvolume that the snapshots of a directory are
+grouped into. Shared by btrfs_incremental_send and snapshot_catalog.
+"""
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+KEEP_FILE_EXTENSION = '.keep'
+
+SNAPSHOT_DATETIME_FORMAT = '%Y%m%d-%H%M%S%z'
+
+class Subvolume:
+    __slots__ = ['all', 'base', 'bases', 'destination', 'parent', 'extra', 'newest', 'cwd']
+
+    def __init__(self):
+        # All snapshots of this subvolume
+        self.all = []
+        # The snapshot with a '.keep' file for `destination`
+        self.base = None
+        # Destination name -> the snapshot with its '.keep' file; None is
+        # the [server] destination
+        self.bases: Dict[Optional[str], str] = {}
+        self.destination: Optional[str] = None
+        # The '-p' argument to `btrfs send`; the base, unless the server's
+        # inventory says otherwise
+        self.parent = None
+        # Snapshots that are safe to delete after the newest one is
+        # sent elsewhere
+        self.extra = None
+        # Newest snapshot
+        self.newest = None
+
+    def for_destination(self, destination: Optional[str]) -> 'Subvolume':
+        """
+        :return: The same subvolume, with `base` and `parent` set for
+        `destination`. Shares `bases` with this one, so moving a '.keep'
+        file through either is seen by both.
+        """
+        view = Subvolume()
+        view.cwd = self.cwd
+        view.all = self.all
+        view.bases = self.bases
+        view.destination = destination
+        view.base = self.bases.get(destination)
+        view.parent = view.base
+        view.extra = self.extra
+        view.newest = self.newest
+        return view
+
+def keep_file_name(snapshot_name: str, destination: Optional[str] = None) -> str:
+    """
+    :param destination: Name of a [server/NAME] destination, or None for
+    [server], whose '.keep' files have no destination in their names
+    """
+    if destination is None:
+        return snapshot_name + KEEP_FILE_EXTENSION
+    return '{}.{}{}'.format(snapshot_name, destination, KEEP_FILE_EXTENSION)
+
+def parse_keep_file_name(filename: str) -> Tuple[str, Optional[str]]:
+    """
+    Inverse of `keep_file_name`
+
+    :return: Snapshot name, destination name
+    """
+    base = filename[:-len(KEEP_FILE_EXTENSION)]
+    # Timestamps have no dots, so a dot after the '@' starts a destination
+    snapshot, dot, destination = base.rpartition('.')
+    if dot and '@' in snapshot and '@' not in destination:
+        return snapshot, destination
+    return base, None
+
+def parse_datetime(snapshot_name: str) -> datetime:
+    name, timestamp = snapshot_name.split('@')
+    return datetime.strptime(timestamp, SNAPSHOT_DATETIME_FORMAT)
@@ -0,0 +1,140 @@
+"""
+SSLContext caching and handshake accounting.
+
+Building a context means reading and parsing the certificate, key and CA
+files, so both ends build one per process and only rebuild it when one of
+those files changes on disk (e.g. after a certificate renewal). Keeping the
+context around also keeps OpenSSL's session cache, which is what makes TLS
+session resumption work: a client that presents the session from its last
+connection skips the certificate exchange and key agreement.
+"""
+from pathlib import Path
+import ssl
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterable, Optional
+
+from tracing import format_address, tracer
+
+class ReloadingContext:
+    """
+    Holds the SSLContext built by `factory`, rebuilding it when any of
+    `paths` is modified.
+    """
+    def __init__(self, factory: Callable[[], ssl.SSLContext], paths: Iterable[Path]):
+        self.factory = factory
+        self.paths = [Path(path) for path in paths]
+        self.lock = Lock()
+        self.context = factory()
+        self.signature = self._signature()
+        # Number of times the context was rebuilt
+        self.reloads = 0
+
+    def _signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        return signature
+
+    def get(self) -> ssl.SSLContext:
+        signature = self._signature()
+        if signature == self.signature:
+            return self.context
+        with self.lock:
+            if signature != self.signature:
+                try:
+                    context = self.factory()
+                except OSError as e:
+                    # Probably caught in the middle of replacing the files;
+                    # keep using what we have and try again next time
+                    print("Can't reload TLS context:", repr(e))
+                    return self.context
+                print('Reloaded TLS context from', ', '.join(str(path) for path in self.paths))
+                self.context = context
+                self.signature = signature
+                self.reloads += 1
+            return self.context
+
+class HandshakeStats:
+    """
+    Counts full and resumed TLS handshakes, and how long they took
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.full = 0
+        self.resumed = 0
+        self.failed = 0
+        # Handshakes that were timed, and their total duration
+        self.full_timed = 0
+        self.resumed_timed = 0
+        self.full_seconds = 0.0
+        self.resumed_seconds = 0.0
+
+    def record(self, seconds: Optional[float], resumed: bool):
+        """
+        :param seconds: Handshake duration, or None if it wasn't measured
+        """
+        with self.lock:
+            if resumed:
+                self.resumed += 1
+                if seconds is not None:
+                    self.resumed_timed += 1
+                    self.resumed_seconds += seconds
+            else:
+                self.full += 1
+                if seconds is not None:
+                    self.full_timed += 1
+                    self.full_seconds += seconds
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                'full': self.full,
+                'resumed': self.resumed,
+                'failed': self.failed,
+                'full_ms_mean': (
+                    1000 * self.full_seconds / self.full_timed
+                    if self.full_timed else None
+                ),
+                'resumed_ms_mean': (
+                    1000 * self.resumed_seconds / self.resumed_timed
+                    if self.resumed_timed else None
+                ),
+            }
+
+    def __str__(self):
+        summary = self.summary()
+        pieces = []
+        for kind in ['full', 'resumed']:
+            piece = '{} {}'.format(summary[kind], kind)
+            mean = summary[kind + '_ms_mean']
+            if mean is not None:
+                piece += ' ({} ms avg)'.format(round(mean, 2))
+            pieces.append(piece)
+        pieces.append('{} failed'.format(summary['failed']))
+        return ', '.join(pieces)
+
+def timed_handshake(conn: ssl.SSLSocket, stats: HandshakeStats):
+    """
+    Run the handshake on a socket wrapped with
+    `do_handshake_on_connect=False`, recording it in `stats`
+    """
+    with tracer.span('handshake', local=format_address(conn.getsockname())) as span:
+        start = perf_counter()
+        try:
+            conn.do_handshake()
+        except OSError:
+            stats.record_failure()
+            raise
+        stats.record(perf_counter() - start, conn.session_reused)
+        span['peer'] = format_address(conn.getpeername())
+        span['resumed'] = conn.session_reused
@@ -0,0 +1,265 @@
+"""
+Timing each phase of a transfer, and profiling whole runs.
+
+If the [trace] section of the client or server config sets 'file', every
+phase ("span") is appended to it as one JSON line when it ends, e.g.
+
+    {"span": "copy", "transfer": "5f0c9e2a7d4b1e38", "role": "client",
+     "start": 1700000000.5, "seconds": 12.25, "pid": 4242,
+     "thread": "ThreadPoolExecutor-0_0", "bytes": 104857600, ...}
+
+The client makes up an ID for each transfer and sends it to the server
+with the 'send' message, so the spans from both ends of a transfer can be
+joined on "transfer". Spans for a connection (accept, handshake) come
+before any transfer on it, so they have the addresses of both ends instead.
+
+Client spans: mount, catalog, transfer, connect, handshake, admission
+(from asking the server to receive a snapshot until it's ready, including
+time spent queued), copy (with 'send_startup_seconds': from starting
+`btrfs send` until its first byte), result_wait (from the end of the stream
+until the server's result), prune and prune_batch.
+
+Server spans: accept (from accepting a connection until a handler runs),
+handshake, transfer, admission, spool, spawn_receive (starting
+`btrfs receive`), copy (into `btrfs receive`) and receive_wait (for it to
+exit once the stream has ended).
+
+Setting 'profile' to cprofile or sampling (or passing --profile) profiles
+the whole run: until the client is done, or the server stops. The output
+goes in 'profile dir': cProfile stats for `python -m pstats`, merged across
+threads, or the stacks of all threads sampled every 'sample interval'
+seconds, in the folded format that flamegraph.pl and speedscope read.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import cProfile
+import json
+import os
+from pathlib import Path
+import pstats
+import secrets
+import sys
+import threading
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import List, Optional
+
+PROFILE_NONE = 'none'
+PROFILE_CPROFILE = 'cprofile'
+PROFILE_SAMPLING = 'sampling'
+PROFILERS = [PROFILE_NONE, PROFILE_CPROFILE, PROFILE_SAMPLING]
+DEFAULT_PROFILE_DIR = Path('/var/tmp/btrfs-syncd')
+# Seconds between samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Set for the duration of a transfer; a context variable rather than a
+# thread-local, so that each of the asyncio server's connections has its own
+_transfer_id: ContextVar[Optional[str]] = ContextVar('transfer_id', default=None)
+
+def new_transfer_id() -> str:
+    return secrets.token_hex(8)
+
+def current_transfer_id() -> Optional[str]:
+    return _transfer_id.get()
+
+def format_address(address) -> str:
+    """
+    :param address: From getsockname() or getpeername()
+    """
+    return '{}:{}'.format(*address[:2])
+
+class ThreadProfiles:
+    """
+    cProfile only sees the thread that enabled it, so this enables one in
+    every thread started after `start`, and merges them at the end
+    """
+    extension = 'pstats'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.profiles: List[cProfile.Profile] = []
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler at a time, and it sees
+            # every thread
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def _thread_started(self, frame, event, arg):
+        # Called once, for the new thread's first event
+        sys.setprofile(None)
+        self._enable()
+
+    def start(self):
+        threading.setprofile(self._thread_started)
+        self._enable()
+
+    def stop(self, path: Path):
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+        pstats.Stats(*profiles).dump_stats(str(path))
+
+class SamplingProfiler:
+    """
+    Records the stack of every thread every `interval` seconds from a
+    thread of its own; much less overhead than cProfile, and it sees time
+    spent blocked
+    """
+    extension = 'folded'
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+        self.thread: Optional[Thread] = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread = Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self, path: Path):
+        self.stopped.set()
+        self.thread.join()
+        with path.open('w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+class Tracer:
+    def __init__(self):
+        self.lock = Lock()
+        # 'client' or 'server'
+        self.role: Optional[str] = None
+        self.trace_path: Optional[Path] = None
+        self.trace_file = None
+        self.profile = PROFILE_NONE
+        self.profile_dir = DEFAULT_PROFILE_DIR
+        self.sample_interval = DEFAULT_SAMPLE_INTERVAL
+
+    def configure(self, config, role: str, profile: Optional[str] = None):
+        """
+        :param config: Client or server config; reads the optional [trace]
+        section
+        :param profile: From the command line; overrides the config
+        """
+        self.role = role
+        if 'trace' in config:
+            section = config['trace']
+            if 'file' in section:
+                self.trace_path = Path(section['file'])
+            self.profile = section.get('profile', PROFILE_NONE)
+            self.profile_dir = Path(section.get('profile dir', str(DEFAULT_PROFILE_DIR)))
+            self.sample_interval = section.getfloat('sample interval', DEFAULT_SAMPLE_INTERVAL)
+        if profile is not None:
+            self.profile = profile
+        if self.profile not in PROFILERS:
+            raise ValueError('Unknown profiler: {}'.format(self.profile))
+
+    def emit(self, name: str, start: float, seconds: float, transfer_id: Optional[str], fields: dict):
+        if self.trace_path is None:
+            return
+        record = {
+            'span': name,
+            'transfer': transfer_id or _transfer_id.get(),
+            'role': self.role,
+            'start': start,
+            'seconds': seconds,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+        }
+        record.update(fields)
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            try:
+                if self.trace_file is None:
+                    self.trace_path.parent.mkdir(parents=True, exist_ok=True)
+                    self.trace_file = self.trace_path.open('a')
+                self.trace_file.write(line)
+                self.trace_file.flush()
+            except OSError as e:
+                # Not worth failing a transfer over; stop trying
+                print("Can't write trace:", repr(e))
+                self.trace_path = None
+
+    @contextmanager
+    def span(self, name: str, transfer_id: Optional[str] = None, **fields):
+        """
+        `with tracer.span('copy') as span:` around a phase; anything added
+        to `span` (a dict) is included in the record
+
+        :param transfer_id: Defaults to that of the current transfer
+        """
+        start = time()
+        started = monotonic()
+        try:
+            yield fields
+        except BaseException as e:
+            fields['error'] = repr(e)
+            raise
+        finally:
+            self.emit(name, start, monotonic() - started, transfer_id, fields)
+
+    def record(self, name: str, seconds: float, transfer_id: Optional[str] = None, **fields):
+        """
+        A span that was timed elsewhere, ending now
+        """
+        self.emit(name, time() - seconds, seconds, transfer_id, fields)
+
+    @contextmanager
+    def transfer(self, transfer_id: str):
+        """
+        Tag all spans in this context with `transfer_id`
+        """
+        token = _transfer_id.set(transfer_id)
+        try:
+            yield transfer_id
+        finally:
+            _transfer_id.reset(token)
+
+    @contextmanager
+    def profiling(self):
+        """
+        Profile everything in this context, if configured to
+        """
+        if self.profile == PROFILE_NONE:
+            yield
+            return
+        if self.profile == PROFILE_CPROFILE:
+            profiler = ThreadProfiles()
+        else:
+            profiler = SamplingProfiler(self.sample_interval)
+        profiler.start()
+        try:
+            yield
+        finally:
+            path = self.profile_dir / '{}-{}-{}.{}'.format(self.role, os.getpid(), int(time()), profiler.extension)
+            try:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profiler.stop(path)
+                print('Profile written to', path)
+            except OSError as e:
+                print("Can't write profile:", repr(e))
+
+# Shared by everything in this process
+tracer = Tracer()
@@ -0,0 +1,150 @@
+from collections import Counter, deque
+from concurrent.futures import Executor
+from functools import partial
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Mapping, Optional
+
+class TransferResult:
+    __slots__ = ['path_name', 'subvolume_name', 'snapshot', 'success', 'reason', 'size', 'deferred']
+
+    def __init__(
+            self,
+            path_name: str,
+            subvolume_name: Optional[str],
+            snapshot: Optional[str],
+            success: bool,
+            reason: Optional[str] = None,
+            size: Optional[int] = None,
+            deferred: bool = False,
+    ):
+        self.path_name = path_name
+        # None if the failure affected the whole path, e.g. it couldn't
+        # be mounted
+        self.subvolume_name = subvolume_name
+        self.snapshot = snapshot
+        self.success = success
+        self.reason = reason
+        # Size of the send stream, if known
+        self.size = size
+        # Not attempted, to be sent on the next run; not a failure
+        self.deferred = deferred
+
+    def __str__(self):
+        name = self.path_name
+        if self.subvolume_name is not None:
+            name = '{}/{}'.format(self.path_name, self.subvolume_name)
+        if self.success:
+            return '{}: sent {}'.format(name, self.snapshot)
+        if self.deferred:
+            return '{}: DEFERRED to the next run ({})'.format(name, self.reason)
+        return '{}: FAILED ({})'.format(name, self.reason)
+
+class QueuedTransfer:
+    __slots__ = ['path_name', 'subvolume_name', 'snapshot', 'job']
+
+    def __init__(
+            self,
+            path_name: str,
+            subvolume_name: str,
+            snapshot: str,
+            job: Callable[[], TransferResult],
+    ):
+        self.path_name = path_name
+        self.subvolume_name = subvolume_name
+        self.snapshot = snapshot
+        self.job = job
+
+class TransferQueue:
+    """
+    Feeds the transfers for all backup paths into a shared executor, in the
+    order given (the run's plan), keeping at most `limits[path_name]` of
+    each path's transfers in flight at once.
+
+    A transfer is only submitted once its path has a free slot, so a path
+    with a low limit never ties up more than that many of the executor's
+    workers; transfers that are submitted start in order, since the
+    executor's queue is FIFO. No transfer starts after `deadline` (a
+    `time.monotonic()` value); those left are reported as deferred, like the
+    ones the plan defers, and are sent on the next run. Jobs are expected to
+    catch their own exceptions and return a TransferResult.
+    """
+    def __init__(
+            self,
+            executor: Executor,
+            limits: Mapping[str, int],
+            transfers: Iterable[QueuedTransfer],
+            deadline: Optional[float] = None,
+    ):
+        self.executor = executor
+        self.limits = {path_name: max(1, limit) for path_name, limit in limits.items()}
+        self.pending = deque(transfers)
+        self.deadline = deadline
+        self.lock = Lock()
+        self.active = Counter()
+        self.remaining = Counter(transfer.path_name for transfer in self.pending)
+        self.results: Dict[str, List[TransferResult]] = {path_name: [] for path_name in self.limits}
+        self.done: Dict[str, Event] = {path_name: Event() for path_name in self.limits}
+        # Never started because of the deadline
+        self.skipped: List[QueuedTransfer] = []
+
+    def start(self):
+        for path_name, event in self.done.items():
+            if not self.remaining[path_name]:
+                event.set()
+        self._submit_ready()
+
+    def _expired(self) -> bool:
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def _skipped(self, transfer: QueuedTransfer) -> TransferResult:
+        return TransferResult(
+            transfer.path_name,
+            transfer.subvolume_name,
+            transfer.snapshot,
+            False,
+            'time budget ran out before it started',
+            deferred=True,
+        )
+
+    def _run(self, transfer: QueuedTransfer) -> TransferResult:
+        # It may have waited in the executor's queue past the deadline
+        if self._expired():
+            with self.lock:
+                self.skipped.append(transfer)
+            return self._skipped(transfer)
+        return transfer.job()
+
+    def _submit_ready(self):
+        with self.lock:
+            ready = []
+            for transfer in list(self.pending):
+                if self.active[transfer.path_name] < self.limits[transfer.path_name]:
+                    self.pending.remove(transfer)
+                    self.active[transfer.path_name] += 1
+                    ready.append(transfer)
+        for transfer in ready:
+            future = self.executor.submit(self._run, transfer)
+            future.add_done_callback(partial(self._job_done, transfer))
+
+    def _job_done(self, transfer: QueuedTransfer, future):
+        try:
+            result = future.result()
+        except BaseException as e:
+            # Shouldn't happen, but a lost result must not hang wait()
+            result = TransferResult(transfer.path_name, transfer.subvolume_name, transfer.snapshot, False, repr(e))
+        with self.lock:
+            self.results[transfer.path_name].append(result)
+            self.active[transfer.path_name] -= 1
+            self.remaining[transfer.path_name] -= 1
+            finished = not self.remaining[transfer.path_name]
+        if finished:
+            self.done[transfer.path_name].set()
+        self._submit_ready()
+
+    def wait(self, path_name: str) -> List[TransferResult]:
+        """
+        :return: Results of all of `path_name`'s transfers, once they're done
+        """
+        self.done[path_name].wait()
+        return self.results[path_name]